@@ -1,6 +1,11 @@
-from .chat import ChatModel, ChatModelLangchain
+from .chat import get_model_registry
 from .utils import ChatUtils, ConfigManager, SystemPromptManager
-import os, yaml, json
+from .history import get_history_store
+from .summary import get_history_summarizer
+from .context import ContextBuilder
+from .metrics import LLM_FIRST_TOKEN_SECONDS
+from .tracing import get_tracer
+import time
 
 class ModelChatAPI:
     """
@@ -9,22 +14,51 @@ class ModelChatAPI:
     
     def __init__(self, plugin_dir):
         self.plugin_dir = plugin_dir
-        config_path = os.path.join(plugin_dir, 'config.yml')
-        
-        with open(config_path, 'r', encoding='utf-8') as f:
-            self.config = yaml.safe_load(f)
+        self.config_manager = ConfigManager(plugin_dir)
+        self.config = self.config_manager.load_config_file()
+        # 配置文件变化时自动同步
+        self.config_manager.subscribe(self._on_config_changed, target='config')
         
-        # 根据配置决定使用哪个模型类
+        # 与插件主程序共享模型实例池
+        self.model_registry = get_model_registry(plugin_dir)
         if self.config.get('enable_mcp', True):
-            self.chat_model_instance = ChatModelLangchain(plugin_dir)
             print("MCP 已启用")
         else:
-            self.chat_model_instance = ChatModel(plugin_dir)
             print("MCP 已禁用")
             
         self.chat_utils = ChatUtils(plugin_dir)
-        self.config_manager = ConfigManager(plugin_dir)
+        # 请求追踪器（与插件主程序共享）
+        self.tracer = get_tracer(plugin_dir)
+
+    def _on_config_changed(self, config):
+        """配置文件变化回调"""
+        self.config = config
+
+    @property
+    def chat_model_instance(self):
+        """
+        获取当前配置对应的模型实例（配置变化时自动重建）
+        
+        Returns:
+            BaseChatModel: 模型实例
+        """
+        return self.model_registry.get_instance()
     
+    def _create_mock_message(self, user_id, message, group_id=None):
+        """创建一个模拟的消息对象用于API调用"""
+        class MockMessage:
+            def __init__(self, user_id, group_id=None):
+                self.user_id = user_id
+                self.group_id = group_id
+                self.raw_message = ""
+                self.message = message
+
+            async def reply(self, text=""):
+                # API 调用无需回复到 QQ
+                pass
+
+        return MockMessage(user_id, group_id)
+
     async def generate_response(self, user_id, message, group_id=None):
         """
         生成AI回复的主要API接口
@@ -37,22 +71,21 @@ class ModelChatAPI:
         Returns:
             str: AI生成的回复内容
         """
+        with self.tracer.trace("webui.chat", user_id=user_id, group_id=group_id):
+            return await self._generate_response(user_id, message, group_id)
+
+    async def _generate_response(self, user_id, message, group_id=None):
+        """生成回复（由 generate_response 在请求追踪中调用）"""
         # 创建一个模拟的消息对象用于API调用
-        class MockMessage:
-            def __init__(self, user_id, group_id=None):
-                self.user_id = user_id
-                self.group_id = group_id
-                self.raw_message = ""
-                self.message = message
-        
-        mock_msg = MockMessage(user_id, group_id)
+        mock_msg = self._create_mock_message(user_id, message, group_id)
+        chat_model_instance = self.chat_model_instance
         
         # 检查是否被ban或包含违禁词
         if await self.chat_utils.check_ban_and_blocked_words(mock_msg, message):
             return "您或您所在的群组已被禁止使用此功能，或消息包含违禁词。"
         
         # 处理图像输入
-        processed_input = await self.chat_utils.process_image_input(mock_msg, self.chat_model_instance, message)
+        processed_input = await self.chat_utils.process_image_input(mock_msg, chat_model_instance, message)
         if processed_input is None:
             return "输入包含违禁内容"
         
@@ -66,7 +99,7 @@ class ModelChatAPI:
                 reply = processed_input if processed_input is not None else "抱歉，我无法处理这张图片。"
             else:
                 # 否则使用普通模型处理
-                reply = await self.chat_model_instance.useModel(mock_msg, processed_input)
+                reply = await chat_model_instance.useModel(mock_msg, processed_input)
                 
                 # 确保回复不是None
                 if reply is None:
@@ -77,6 +110,48 @@ class ModelChatAPI:
         
         return reply
     
+    async def generate_response_stream(self, user_id, message, group_id=None):
+        """
+        流式生成AI回复，以异步生成器逐段返回回复内容
+        
+        Args:
+            user_id (int): 用户ID
+            message (str): 用户输入的消息
+            group_id (int, optional): 群组ID，如果在群聊中使用
+            
+        Yields:
+            str: AI生成的回复片段（未经格式清理的增量文本）
+        """
+        mock_msg = self._create_mock_message(user_id, message, group_id)
+        chat_model_instance = self.chat_model_instance
+
+        # 检查是否被ban或包含违禁词
+        if await self.chat_utils.check_ban_and_blocked_words(mock_msg, message):
+            yield "您或您所在的群组已被禁止使用此功能，或消息包含违禁词。"
+            return
+
+        # 处理图像输入
+        processed_input = await self.chat_utils.process_image_input(mock_msg, chat_model_instance, message)
+        if processed_input is None:
+            yield "输入包含违禁内容"
+            return
+
+        # 视觉模型的回复直接返回
+        if self.chat_utils._is_image_message(mock_msg):
+            yield processed_input
+            return
+
+        started_at = time.perf_counter()
+        first_chunk = True
+        try:
+            async for chunk in chat_model_instance.useModelStream(mock_msg, processed_input):
+                if first_chunk:
+                    first_chunk = False
+                    LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started_at)
+                yield chunk
+        except Exception as e:
+            yield f"抱歉，处理您的请求时出现了错误: {str(e)}"
+
     def get_user_history(self, user_id):
         """
         获取用户历史对话记录
@@ -112,19 +187,10 @@ class ModelChatAPI:
             bool: 是否删除成功
         """
         try:
-            history_file = os.path.join(self.plugin_dir, 'cache', 'history.json')
-            if os.path.exists(history_file):
-                with open(history_file, 'r', encoding='utf-8') as f:
-                    history_data = json.load(f)
-                
-                user_id_str = str(user_id)
-                if user_id_str in history_data:
-                    del history_data[user_id_str]
-                    
-                    with open(history_file, 'w', encoding='utf-8') as f:
-                        json.dump(history_data, f, ensure_ascii=False, indent=2)
-                    
-                    return True
+            # 通过共享的历史记录存储删除，避免与机器人写入互相覆盖
+            get_history_summarizer(self.plugin_dir).discard(user_id)
+            ContextBuilder.unpin_system_prompt(user_id)
+            get_history_store(self.plugin_dir).delete(user_id)
             return True
         except Exception as e:
             print(f"删除用户历史记录时出错: {e}")
@@ -187,6 +253,36 @@ class ModelChatAPI:
         """
         return self.config_manager.load_history_sessions(allowed_user_ids)
 
+    def list_history_sessions(self, allowed_user_ids=None, cursor=None, limit=50):
+        """
+        分页获取会话列表（仅概要，不含消息正文）
+        
+        Args:
+            allowed_user_ids (list, optional): 允许读取的用户ID列表，如果为None则不限制
+            cursor (str, optional): 上一页返回的 next_cursor
+            limit (int): 每页数量
+            
+        Returns:
+            dict: {'sessions': 会话概要列表, 'next_cursor': 下一页游标}
+        """
+        return self.config_manager.list_history_sessions(allowed_user_ids, cursor, limit)
+
+    def get_user_history_page(self, user_id, since=None, before=None, limit=100):
+        """
+        增量或分页获取用户历史对话记录
+        
+        Args:
+            user_id (int): 用户ID
+            since (float, optional): 只返回该时间戳之后的消息
+            before (float, optional): 只返回该时间戳之前的消息（向前翻页）
+            limit (int): 最多返回的消息数
+            
+        Returns:
+            dict: {'history': 消息列表, 'has_more': 是否还有更多消息（指定 since 时为更新的消息，否则为更早的消息）,
+                   'latest': 本页最后一条消息的时间戳（指定 since 时可作为下一页的 since）}
+        """
+        return self.config_manager.load_history_page(user_id, since, before, limit)
+
     def is_admin(self, user_id):
         """
         检查用户是否为管理员
@@ -210,8 +306,7 @@ class ModelChatAPI:
         """
         try:
             # 重新加载主配置文件
-            with open(self.config_manager.get_config_path(), 'r', encoding='utf-8') as f:
-                self.config = yaml.safe_load(f)
+            self.config = self.config_manager.load_config_file()
             
             # 通知chat_model_instance重新加载配置
             if hasattr(self, 'chat_model_instance'):
@@ -1,8 +1,83 @@
 from ncatbot.core import GroupMessage
 from ncatbot.utils import config
 from .utils import ConfigManager
-import threading
-from typing import Dict, List
+import os, threading
+from collections import deque
+from typing import Dict, Iterable, List
+
+
+class BlockedWordMatcher:
+    """基于 Aho-Corasick 自动机的违禁词匹配器，单次线性扫描即可完成所有违禁词的匹配"""
+
+    def __init__(self, words: Iterable[str]):
+        # 状态转移表、失配指针、以该状态结尾的违禁词、输出链接（最近的可匹配后缀状态）
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._words: List[List[str]] = [[]]
+        self._output: List[int] = [0]
+        self._build(words)
+
+    def _build(self, words: Iterable[str]):
+        """构建字典树与失配指针"""
+        for word in dict.fromkeys(words):
+            if not word:
+                continue
+            state = 0
+            for char in word:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._words.append([])
+                    self._output.append(0)
+                state = next_state
+            self._words[state].append(word)
+
+        # 广度优先计算失配指针
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail_state = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail_state if fail_state != next_state else 0
+                # 输出链接指向最近的包含违禁词的后缀状态
+                self._output[next_state] = fail_state if self._words[fail_state] else self._output[fail_state]
+
+    def _step(self, state: int, char: str) -> int:
+        """状态转移"""
+        while state and char not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(char, 0)
+
+    def search(self, text: str) -> bool:
+        """文本是否包含任意违禁词"""
+        if len(self._goto) == 1:
+            return False
+        state = 0
+        for char in text:
+            state = self._step(state, char)
+            if self._words[state] or self._output[state]:
+                return True
+        return False
+
+    def find_all(self, text: str) -> List[str]:
+        """返回文本中出现的所有违禁词（按首次出现顺序去重）"""
+        matched = {}
+        state = 0
+        for char in text:
+            state = self._step(state, char)
+            hit = state
+            while hit:
+                for word in self._words[hit]:
+                    matched.setdefault(word, None)
+                hit = self._output[hit]
+        return list(matched)
 
 
 class BanManager:
@@ -11,8 +86,33 @@ class BanManager:
         self.config_manager = ConfigManager(plugin_dir)
         self.banlist_file = self.config_manager.get_data_path()
         self.banlist = self._load_banlist()
-        # 添加线程锁以保证并发安全
-        self.lock = threading.Lock()
+        # 基于集合的ban索引与违禁词匹配器（data.json 中仍以列表保存）
+        self._rebuild_indexes()
+        # 添加线程锁以保证并发安全（可重入：保存与变化回调会在持有锁时再次获取）
+        self.lock = threading.RLock()
+        # data.json 变化时（如 WebUI 或手动修改）同步ban列表
+        self.config_manager.subscribe(self._on_data_changed, target='data')
+
+    def _on_data_changed(self, data):
+        """数据文件变化回调"""
+        for key in ["banned_groups", "banned_users", "blocked_words"]:
+            data.setdefault(key, [])
+        with self.lock:
+            self.banlist = data
+            self._rebuild_indexes()
+
+    def _rebuild_indexes(self):
+        """根据ban列表重建索引，违禁词未变化时不重建匹配器"""
+        self.banned_users = set(self.banlist["banned_users"])
+        self.banned_groups = set(self.banlist["banned_groups"])
+        self.blocked_word_set = set(self.banlist["blocked_words"])
+        if tuple(self.banlist["blocked_words"]) != getattr(self, '_matcher_words', None):
+            self._rebuild_word_matcher()
+
+    def _rebuild_word_matcher(self):
+        """根据违禁词列表重建匹配器"""
+        self._matcher_words = tuple(self.banlist["blocked_words"])
+        self.word_matcher = BlockedWordMatcher(self._matcher_words)
 
     def _load_banlist(self) -> Dict[str, List[str]]:
         """加载ban列表"""
@@ -43,41 +143,37 @@ class BanManager:
 
     def is_banned(self, msg: GroupMessage) -> bool:
         """检查用户或群组是否被ban"""
-        # 使用缓存避免频繁读取文件
-        with self.lock:
-            current_banlist = self.banlist
-
-        # 检查用户是否被ban
-        if hasattr(msg, 'user_id') and str(msg.user_id) in current_banlist["banned_users"]:
+        # 检查用户是否被ban（集合查询）
+        if hasattr(msg, 'user_id') and str(msg.user_id) in self.banned_users:
             return True
 
-        # 检查群组是否被ban
-        if hasattr(msg, 'group_id') and str(msg.group_id) in current_banlist["banned_groups"]:
+        # 检查群组是否被ban（集合查询）
+        if hasattr(msg, 'group_id') and str(msg.group_id) in self.banned_groups:
             return True
 
         return False
 
     def check_blocked_words(self, text: str) -> bool:
         """检查文本是否包含违禁词"""
-        # 使用缓存避免频繁读取文件
-        with self.lock:
-            blocked_words = self.banlist["blocked_words"]
+        # 匹配器在违禁词变化时整体替换，读取引用即可
+        return self.word_matcher.search(text)
 
-        for block_word in blocked_words:
-            if block_word in text:
-                return True
-        return False
+    def find_blocked_words(self, text: str) -> List[str]:
+        """获取文本中包含的所有违禁词"""
+        return self.word_matcher.find_all(text)
 
     def add_ban(self, ban_type: str, target: str) -> bool:
         """添加ban项"""
         with self.lock:
             if ban_type == "group":
-                if target not in self.banlist["banned_groups"]:
+                if target not in self.banned_groups:
+                    self.banned_groups.add(target)
                     self.banlist["banned_groups"].append(target)
                     return self._save_banlist()
                 return False
             elif ban_type == "user":
-                if target not in self.banlist["banned_users"]:
+                if target not in self.banned_users:
+                    self.banned_users.add(target)
                     self.banlist["banned_users"].append(target)
                     return self._save_banlist()
                 return False
@@ -86,8 +182,10 @@ class BanManager:
     def add_blocked_word(self, word: str) -> bool:
         """添加违禁词"""
         with self.lock:
-            if word not in self.banlist["blocked_words"]:
+            if word not in self.blocked_word_set:
+                self.blocked_word_set.add(word)
                 self.banlist["blocked_words"].append(word)
+                self._rebuild_word_matcher()
                 return self._save_banlist()
         return False
 
@@ -95,12 +193,14 @@ class BanManager:
         """移除ban项"""
         with self.lock:
             if ban_type == "group":
-                if target in self.banlist["banned_groups"]:
+                if target in self.banned_groups:
+                    self.banned_groups.discard(target)
                     self.banlist["banned_groups"].remove(target)
                     return self._save_banlist()
                 return False
             elif ban_type == "user":
-                if target in self.banlist["banned_users"]:
+                if target in self.banned_users:
+                    self.banned_users.discard(target)
                     self.banlist["banned_users"].remove(target)
                     return self._save_banlist()
                 return False
@@ -109,8 +209,10 @@ class BanManager:
     def remove_blocked_word(self, word: str) -> bool:
         """移除违禁词"""
         with self.lock:
-            if word in self.banlist["blocked_words"]:
+            if word in self.blocked_word_set:
+                self.blocked_word_set.discard(word)
                 self.banlist["blocked_words"].remove(word)
+                self._rebuild_word_matcher()
                 return self._save_banlist()
         return False
 
@@ -191,3 +293,17 @@ class BanManager:
 
             else:
                 return f"指令格式错误。正确格式：{command} group <群号> 或 {command} user <QQ号> 或 {command} word <违禁词>", False
+
+
+# 进程内共享的 BanManager（按插件目录区分），机器人指令、ChatUtils、API 与 WebUI 使用同一实例
+_ban_managers: Dict[str, BanManager] = {}
+_ban_managers_lock = threading.Lock()
+
+
+def get_ban_manager(plugin_dir) -> BanManager:
+    """获取进程内共享的 BanManager"""
+    key = os.path.abspath(plugin_dir)
+    with _ban_managers_lock:
+        if key not in _ban_managers:
+            _ban_managers[key] = BanManager(plugin_dir)
+        return _ban_managers[key]
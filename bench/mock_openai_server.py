@@ -0,0 +1,231 @@
+"""OpenAI 兼容的模拟后端：可配置首 token 延迟、生成速率、流式输出与工具调用，供基准测试使用
+
+单独运行：python bench/mock_openai_server.py --port 8765 --latency 0.2 --token-rate 50
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse, hashlib, json, random, time, uuid
+
+# 生成回复使用的文本片段（每个片段计为 1 个 token）
+REPLY_PIECES = ["好的", "，", "这是", "模拟", "后端", "的", "回复", "。", "测试", "数据"]
+
+
+def estimate_tokens(messages):
+    """按字符数粗略估算提示词 token 数"""
+    total = 0
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        total += len(str(content)) // 2 + 4
+    return total
+
+
+def fake_arguments(schema):
+    """按工具参数的 JSON Schema 生成调用参数"""
+    arguments = {}
+    for name, prop in (schema or {}).get("properties", {}).items():
+        prop_type = prop.get("type")
+        if prop_type in ("integer", "number"):
+            arguments[name] = 1
+        elif prop_type == "boolean":
+            arguments[name] = True
+        else:
+            arguments[name] = "bench"
+    return arguments
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def options(self):
+        return self.server.options  # type: ignore
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data: str):
+        raw = data.encode("utf-8")
+        self.wfile.write(f"{len(raw):x}\r\n".encode("ascii") + raw + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json({"object": "list", "data": [{"id": self.options.model, "object": "model"}]})
+        else:
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+        except ValueError:
+            self._send_json({"error": {"message": "invalid json"}}, 400)
+            return
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self._chat_completions(body)
+        elif self.path.rstrip("/").endswith("/embeddings"):
+            self._embeddings(body)
+        else:
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+    def _rng(self, body):
+        """同一请求内容得到相同的随机序列，保证结果可复现"""
+        digest = hashlib.sha256(json.dumps(body.get("messages", []), sort_keys=True, default=str).encode("utf-8"))
+        return random.Random(f"{self.options.seed}:{digest.hexdigest()}")
+
+    def _pick_tool_call(self, body, rng):
+        """决定本次是否返回工具调用"""
+        tools = body.get("tools") or []
+        messages = body.get("messages") or []
+        if not tools or (messages and messages[-1].get("role") == "tool"):
+            return None
+        if rng.random() >= self.options.tool_call_rate:
+            return None
+        function = rng.choice(tools).get("function", {})
+        return {
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+            "type": "function",
+            "function": {
+                "name": function.get("name", ""),
+                "arguments": json.dumps(fake_arguments(function.get("parameters")), ensure_ascii=False),
+            },
+        }
+
+    def _chat_completions(self, body):
+        options = self.options
+        rng = self._rng(body)
+        time.sleep(max(0.0, options.latency + rng.uniform(-options.jitter, options.jitter)))
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model") or options.model
+        prompt_tokens = estimate_tokens(body.get("messages", []))
+        tool_call = self._pick_tool_call(body, rng)
+        pieces = [] if tool_call else [REPLY_PIECES[i % len(REPLY_PIECES)] for i in range(options.reply_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(pieces) or 8,
+            "total_tokens": prompt_tokens + (len(pieces) or 8),
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        interval = 1.0 / options.token_rate if options.token_rate > 0 else 0.0
+
+        if not body.get("stream"):
+            time.sleep(interval * len(pieces))
+            message = {"role": "assistant", "content": "".join(pieces) if pieces else None}
+            if tool_call:
+                message["tool_calls"] = [tool_call]
+            self._send_json({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_call else "stop"}],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(choices, **extra):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                       "model": model, "choices": choices, **extra}
+            self._send_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n")
+
+        event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        if tool_call:
+            event([{"index": 0, "delta": {"tool_calls": [{"index": 0, **tool_call}]}, "finish_reason": None}])
+        for piece in pieces:
+            time.sleep(interval)
+            event([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+        event([{"index": 0, "delta": {}, "finish_reason": "tool_calls" if tool_call else "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            event([], usage=usage)
+        self._send_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _embeddings(self, body):
+        """返回由文本哈希得到的确定性向量"""
+        inputs = body.get("input", "")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        data = []
+        for index, text in enumerate(inputs):
+            digest = hashlib.sha256(str(text).encode("utf-8")).digest()
+            data.append({"object": "embedding", "index": index,
+                         "embedding": [(byte - 128) / 128 for byte in digest]})
+        self._send_json({"object": "list", "data": data, "model": body.get("model", ""),
+                         "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+
+class MockOpenAIServer:
+    """在后台线程中运行的模拟后端"""
+
+    def __init__(self, host="127.0.0.1", port=0, **options):
+        self.httpd = ThreadingHTTPServer((host, port), MockOpenAIHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.options = build_options(**options)  # type: ignore
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def build_options(latency=0.2, jitter=0.0, token_rate=50.0, reply_tokens=40, tool_call_rate=0.0,
+                  model="mock-model", seed=0):
+    return argparse.Namespace(latency=latency, jitter=jitter, token_rate=token_rate, reply_tokens=reply_tokens,
+                              tool_call_rate=tool_call_rate, model=model, seed=seed)
+
+
+def add_backend_arguments(parser):
+    """模拟后端的命令行参数（基准测试脚本共用）"""
+    parser.add_argument("--latency", type=float, default=0.2, help="首 token 延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机抖动（秒）")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="每秒生成的 token 数，0 表示不限制")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="每次回复的 token 数")
+    parser.add_argument("--tool-call-rate", type=float, default=0.0, help="提供工具时返回工具调用的概率")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的模拟后端")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    server = MockOpenAIServer(args.host, args.port, latency=args.latency, jitter=args.jitter,
+                              token_rate=args.token_rate, reply_tokens=args.reply_tokens,
+                              tool_call_rate=args.tool_call_rate, seed=args.seed)
+    # 输出实际地址，供基准测试脚本读取
+    print(server.base_url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,549 @@
+"""ModelChat 离线基准测试
+
+启动本地的 OpenAI 兼容模拟后端（以及可选的 MCP 桩服务器），用合成的用户群驱动
+ChatModel、ChatModelLangchain、ModelChatAPI 与 WebUI 的 /api/chat（以及各自的流式路径），
+统计吞吐、延迟与首 token 耗时分位数、CPU 与内存占用，结果写入 JSON 文件以便跨版本对比。
+
+用法：
+    python bench/run_bench.py --targets chat_model,chat_model_stream,api,flask_stream --requests 200 --concurrency 16
+    python bench/run_bench.py --mcp --tool-call-rate 0.5 --targets langchain
+    python bench/run_bench.py --compare bench/results/上一次的结果.json --fail-on-regression 10
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from mock_openai_server import add_backend_arguments
+import argparse, asyncio, json, os, platform, random, re, resource, shutil, subprocess, sys, tempfile, threading, time, yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_ROOT = os.path.dirname(BENCH_DIR)
+TARGETS = ("chat_model", "chat_model_stream", "langchain", "langchain_stream", "api", "api_stream", "flask", "flask_stream")
+
+# 回复以这些前缀开头时视为请求失败（模型错误处理与 ChatUtils 的兜底回复）
+ERROR_PREFIXES = (
+    "请求出错了", "抱歉，处理您的请求时出现了错误", "模型API认证失败",
+    "模型服务 500 错误", "LLM 请求失败", "请求超时",
+)
+
+# 合成用户的问题池
+QUESTIONS = [
+    "今天天气怎么样", "帮我查一下明天北京到上海的车次", "给我讲个笑话", "推荐几本科幻小说",
+    "Python 的装饰器是什么", "怎么煮一碗好吃的面", "解释一下什么是量子纠缠", "周末去哪里玩比较好",
+    "帮我写一首关于秋天的诗", "如何提高睡眠质量", "什么是大语言模型", "翻译一下 hello world",
+    "红烧肉怎么做", "介绍一下你自己", "最近有什么好看的电影", "怎么学习英语口语",
+]
+
+
+class BenchMessage:
+    """模拟的 QQ 消息"""
+
+    def __init__(self, user_id, group_id, text):
+        self.user_id = user_id
+        self.group_id = group_id
+        self.raw_message = text
+        self.message = [{"type": "text", "data": {"text": text}}]
+
+    async def reply(self, text=""):
+        pass
+
+
+def build_workload(args):
+    """生成合成用户群与请求序列（相同种子结果相同）"""
+    rng = random.Random(args.seed)
+    group_ids = [900000 + i for i in range(max(1, args.groups))]
+    users = [
+        {"user_id": 10000 + i, "group_id": rng.choice(group_ids) if rng.random() < args.group_ratio else None}
+        for i in range(args.users)
+    ]
+    # 一部分请求是各用户都会问的热门问题，其余为各不相同的问题
+    hot_questions = QUESTIONS[:args.hot_questions]
+    workload = []
+    for _ in range(args.warmup + args.requests):
+        user = rng.choice(users)
+        if hot_questions and rng.random() < args.repeat_ratio:
+            text = rng.choice(hot_questions)
+        else:
+            text = f"{rng.choice(QUESTIONS)}（{rng.randint(1, 10 ** 6)}）"
+        workload.append((user, text))
+    return workload[:args.warmup], workload[args.warmup:]
+
+
+def start_mock_backend(args):
+    """在子进程中启动模拟后端（其 CPU 不计入被测进程），返回 (进程, base_url)"""
+    command = [
+        sys.executable, os.path.join(BENCH_DIR, "mock_openai_server.py"), "--port", "0",
+        "--latency", str(args.latency), "--jitter", str(args.jitter),
+        "--token-rate", str(args.token_rate), "--reply-tokens", str(args.reply_tokens),
+        "--tool-call-rate", str(args.tool_call_rate), "--seed", str(args.seed),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    base_url = process.stdout.readline().strip()
+    if not base_url:
+        process.kill()
+        raise RuntimeError("模拟后端启动失败")
+    return process, base_url
+
+
+def prepare_workspace():
+    """创建临时工作目录，插件可在其中按 plugins.ModelChat 导入"""
+    workspace = tempfile.mkdtemp(prefix="modelchat-bench-")
+    os.makedirs(os.path.join(workspace, "plugins"))
+    os.symlink(PLUGIN_ROOT, os.path.join(workspace, "plugins", "ModelChat"))
+    return workspace
+
+
+def prepare_plugin_dir(workspace, target, args, base_url):
+    """为每个被测对象创建独立的插件目录（配置、数据与聊天记录互不影响）"""
+    plugin_dir = os.path.join(workspace, target)
+    os.makedirs(os.path.join(plugin_dir, "web"))
+    config = {
+        "api_key": "bench",
+        "base_url": base_url,
+        "model": "mock-model",
+        "model_temperature": 0.6,
+        "vision_api_key": "bench",
+        "vision_base_url": base_url,
+        "vision_model": "mock-model",
+        "enable_mcp": args.mcp,
+        "enable_vision": False,
+        "enable_webui": False,
+        "enable_continuous_session": True,
+        "memory_length": args.memory_length,
+        "history_backend": args.history_backend,
+        "llm_timeout": 120,
+        "llm_max_connections": 100,
+    }
+    for item in args.set or []:
+        key, _, value = item.partition("=")
+        config[key.strip()] = yaml.safe_load(value)
+    with open(os.path.join(plugin_dir, "config.yml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f, allow_unicode=True, sort_keys=False)
+    with open(os.path.join(plugin_dir, "data.json"), "w", encoding="utf-8") as f:
+        json.dump({"system_prompt": "你是一个AI助手"}, f, ensure_ascii=False)
+
+    if args.mcp:
+        mcp_config = {
+            "mcpServers": {
+                "bench": {
+                    "transport": "stdio",
+                    "command": sys.executable,
+                    "args": [os.path.join(BENCH_DIR, "stub_mcp_server.py")],
+                    "env": {"BENCH_MCP_LATENCY": str(args.mcp_latency)},
+                }
+            },
+            "toolSettings": {"tools": {"lookup": {"cache_ttl": 300}}},
+        }
+        with open(os.path.join(plugin_dir, "mcp_config.json"), "w", encoding="utf-8") as f:
+            json.dump(mcp_config, f, ensure_ascii=False, indent=2)
+    return plugin_dir
+
+
+def is_error_reply(reply):
+    return not isinstance(reply, str) or reply.startswith(ERROR_PREFIXES)
+
+
+def current_rss_mb():
+    """当前常驻内存（MB）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """进程的峰值常驻内存（MB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, fraction):
+    """线性插值的分位数"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def latency_summary(values):
+    """耗时分布（毫秒）"""
+    return {
+        "mean": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+        "p50": round(percentile(values, 0.50) * 1000, 2),
+        "p95": round(percentile(values, 0.95) * 1000, 2),
+        "p99": round(percentile(values, 0.99) * 1000, 2),
+        "max": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+class Recorder:
+    """记录各请求的总耗时、首 token 耗时与失败数（可在多个线程中使用）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.latencies, self.first_tokens, self.errors = [], [], 0
+
+    def add(self, elapsed, failed, first_token=None):
+        with self.lock:
+            self.latencies.append(elapsed)
+            if first_token is not None:
+                self.first_tokens.append(first_token)
+            self.errors += bool(failed)
+
+
+async def drive_async(call, workload, concurrency, recorder, stream=False):
+    """以固定并发驱动异步调用；stream 为 True 时 call 返回异步生成器，并记录首个分块的耗时"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(user, text):
+        async with semaphore:
+            started_at = time.perf_counter()
+            first_token = None
+            try:
+                if stream:
+                    chunks = []
+                    async for chunk in call(user, text):
+                        if first_token is None:
+                            first_token = time.perf_counter() - started_at
+                        chunks.append(chunk)
+                    reply = "".join(chunks)
+                else:
+                    reply = await call(user, text)
+                failed = is_error_reply(reply)
+            except Exception as e:
+                print(f"请求失败: {e}")
+                failed = True
+            recorder.add(time.perf_counter() - started_at, failed, first_token)
+
+    await asyncio.gather(*(one(user, text) for user, text in workload))
+
+
+async def close_mcp_sessions():
+    """关闭当前事件循环中保持的 MCP 会话，并等待会话任务退出（stdio 子进程随之结束）"""
+    from plugins.ModelChat.tools import close_tool_registries
+
+    close_tool_registries()
+    current = asyncio.current_task()
+    pending = [task for task in asyncio.all_tasks() if task is not current]
+    if pending:
+        await asyncio.wait(pending, timeout=5)
+
+
+def release_plugin_state(plugin_dir):
+    """刷写并关闭进程内共享的聊天记录存储与请求追踪，之后才能删除插件目录"""
+    from plugins.ModelChat.history import close_history_stores
+    from plugins.ModelChat.tracing import get_tracer
+
+    close_history_stores()
+    get_tracer(plugin_dir).close()
+
+
+def run_async_target(target, plugin_dir, warmup, workload, concurrency):
+    """驱动模型类的 useModel / useModelStream 或 ModelChatAPI.generate_response / generate_response_stream"""
+    from plugins.ModelChat.chat import ChatModel, ChatModelLangchain
+    from plugins.ModelChat.api import ModelChatAPI
+
+    stream = target.endswith("_stream")
+    base = target[:-len("_stream")] if stream else target
+
+    async def main():
+        if base == "api":
+            api = ModelChatAPI(plugin_dir)
+            method = api.generate_response_stream if stream else api.generate_response
+
+            def call(user, text):
+                return method(user["user_id"], text, user["group_id"])
+        else:
+            model = ChatModelLangchain(plugin_dir) if base == "langchain" else ChatModel(plugin_dir)
+            method = model.useModelStream if stream else model.useModel
+
+            def call(user, text):
+                return method(BenchMessage(user["user_id"], user["group_id"], text), text)
+
+        recorder = Recorder()
+        try:
+            await drive_async(call, warmup, concurrency, recorder, stream)
+            recorder.reset()
+            return await measure(lambda: drive_async(call, workload, concurrency, recorder, stream), recorder)
+        finally:
+            await close_mcp_sessions()
+
+    return asyncio.run(main())
+
+
+def run_flask_target(target, plugin_dir, warmup, workload, concurrency):
+    """以多线程驱动 WebUI 的 /api/chat 或 /api/chat/stream 路由（Flask 测试客户端，不经过网络）"""
+    from plugins.ModelChat.web.webui import ModelChatWebUI
+
+    stream = target == "flask_stream"
+    webui = ModelChatWebUI(plugin_dir)
+    local = threading.local()
+    recorder = Recorder()
+
+    def get_client():
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = webui.app.test_client()
+            with client.session_transaction() as session:
+                session["authenticated"] = True
+        return client
+
+    def post_chat(client, payload):
+        response = client.post("/api/chat", json=payload)
+        return response.status_code != 200 or is_error_reply((response.get_json() or {}).get("response")), None
+
+    def post_chat_stream(client, payload, started_at):
+        """读取 SSE 响应：记录第一条增量的耗时，以 done 事件中的完整回复判断是否失败"""
+        response = client.post("/api/chat/stream", json=payload, buffered=False)
+        first_token, reply, buffer = None, None, ""
+        try:
+            for data in response.response:
+                buffer += data.decode("utf-8") if isinstance(data, bytes) else data
+                while "\n\n" in buffer:
+                    event, buffer = buffer.split("\n\n", 1)
+                    if first_token is None and event.startswith("data:"):
+                        first_token = time.perf_counter() - started_at
+                    if event.startswith("event: done"):
+                        reply = json.loads(event.split("data: ", 1)[1]).get("response")
+        finally:
+            response.close()
+        return response.status_code != 200 or is_error_reply(reply), first_token
+
+    def one(item):
+        user, text = item
+        payload = {"user_id": user["user_id"], "message": text, "group_id": user["group_id"]}
+        started_at = time.perf_counter()
+        try:
+            if stream:
+                failed, first_token = post_chat_stream(get_client(), payload, started_at)
+            else:
+                failed, first_token = post_chat(get_client(), payload)
+        except Exception as e:
+            print(f"请求失败: {e}")
+            failed, first_token = True, None
+        recorder.add(time.perf_counter() - started_at, failed, first_token)
+
+    def drive(items):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, items))
+
+    try:
+        drive(warmup)
+        recorder.reset()
+
+        async def measured():
+            await asyncio.to_thread(drive, workload)
+
+        return asyncio.run(measure(measured, recorder))
+    finally:
+        webui._run_async(close_mcp_sessions())
+        webui.stop()
+
+
+async def measure(run, recorder):
+    """执行一轮测量，统计墙钟时间、CPU 时间与内存"""
+    rss_before = current_rss_mb()
+    cpu_before = time.process_time()
+    started_at = time.perf_counter()
+    await run()
+    wall = time.perf_counter() - started_at
+    cpu = time.process_time() - cpu_before
+    latencies = recorder.latencies
+    result = {
+        "requests": len(latencies),
+        "errors": recorder.errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else 0.0,
+        "latency_ms": latency_summary(latencies),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_percent": round(cpu / wall * 100, 1) if wall else 0.0,
+        "cpu_ms_per_request": round(cpu / len(latencies) * 1000, 3) if latencies else 0.0,
+        "rss_mb": round(current_rss_mb(), 1),
+        "rss_growth_mb": round(current_rss_mb() - rss_before, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if recorder.first_tokens:
+        # 流式路径：首个分块的耗时
+        result["first_token_ms"] = latency_summary(recorder.first_tokens)
+    return result
+
+
+def plugin_version():
+    """读取插件版本号"""
+    try:
+        with open(os.path.join(PLUGIN_ROOT, "main.py"), encoding="utf-8") as f:
+            match = re.search(r'version\s*=\s*"([^"]+)"', f.read())
+        return match.group(1) if match else ""
+    except OSError:
+        return ""
+
+
+def git_commit():
+    """读取当前提交（不是 git 仓库时为空）"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PLUGIN_ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare_results(previous_path, current, threshold):
+    """与之前的结果对比，输出变化并返回是否出现超过阈值的退化"""
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\n与 {previous_path}（{previous['meta'].get('commit') or previous['meta'].get('version')}）对比：")
+    regressed = False
+    for target, result in current["results"].items():
+        old = previous.get("results", {}).get(target)
+        if not old:
+            continue
+        for label, old_value, new_value, higher_is_better in (
+            ("吞吐 rps", old["throughput_rps"], result["throughput_rps"], True),
+            ("p50 ms", old["latency_ms"]["p50"], result["latency_ms"]["p50"], False),
+            ("p95 ms", old["latency_ms"]["p95"], result["latency_ms"]["p95"], False),
+            ("p99 ms", old["latency_ms"]["p99"], result["latency_ms"]["p99"], False),
+            ("首token p50 ms", old.get("first_token_ms", {}).get("p50"), result.get("first_token_ms", {}).get("p50"), False),
+            ("首token p95 ms", old.get("first_token_ms", {}).get("p95"), result.get("first_token_ms", {}).get("p95"), False),
+            ("CPU ms/请求", old["cpu_ms_per_request"], result["cpu_ms_per_request"], False),
+            ("峰值内存 MB", old["peak_rss_mb"], result["peak_rss_mb"], False),
+        ):
+            if old_value is None or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            worse = -change if higher_is_better else change
+            flag = ""
+            if threshold is not None and worse > threshold:
+                flag = "  <-- 退化"
+                regressed = True
+            print(f"  {target:<17} {label:<14} {old_value:>10} -> {new_value:<10} ({change:+.1f}%){flag}")
+    return regressed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ModelChat 离线基准测试")
+    parser.add_argument("--targets", default=",".join(TARGETS), help=f"被测对象，逗号分隔: {','.join(TARGETS)}")
+    parser.add_argument("--requests", type=int, default=200, help="每个被测对象的请求数")
+    parser.add_argument("--warmup", type=int, default=10, help="预热请求数（不计入结果）")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--users", type=int, default=50, help="合成用户数")
+    parser.add_argument("--groups", type=int, default=5, help="合成群数")
+    parser.add_argument("--group-ratio", type=float, default=0.7, help="群聊用户所占比例")
+    parser.add_argument("--repeat-ratio", type=float, default=0.3, help="热门问题所占比例")
+    parser.add_argument("--hot-questions", type=int, default=5, help="热门问题数")
+    parser.add_argument("--memory-length", type=int, default=10, help="记忆长度")
+    parser.add_argument("--history-backend", default="sharded", help="历史记录存储后端")
+    parser.add_argument("--mcp", action="store_true", help="启用 MCP（LangChain 实现 + MCP 桩服务器）")
+    parser.add_argument("--mcp-latency", type=float, default=0.05, help="MCP 工具延迟（秒）")
+    parser.add_argument("--set", action="append", metavar="KEY=VALUE", help="覆盖插件配置项，可重复使用")
+    parser.add_argument("--output", help="结果文件，默认 bench/results/<时间>.json")
+    parser.add_argument("--compare", help="与之前的结果文件对比")
+    parser.add_argument("--fail-on-regression", type=float, metavar="PERCENT",
+                        help="与 --compare 一同使用：任一指标退化超过该百分比时以非零状态退出")
+    parser.add_argument("--keep-workspace", action="store_true", help="保留临时插件目录（便于查看聊天记录）")
+    # 以下参数仅供内部使用：每个被测对象在独立的子进程中运行
+    parser.add_argument("--worker-target", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-workspace", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-plugin-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-result", help=argparse.SUPPRESS)
+    add_backend_arguments(parser)
+    return parser.parse_args()
+
+
+def run_worker(args):
+    """子进程：测试单个被测对象，结果写入 --worker-result"""
+    sys.path.insert(0, args.worker_workspace)
+    target, plugin_dir = args.worker_target, args.worker_plugin_dir
+    warmup, workload = build_workload(args)
+    try:
+        if target.startswith("flask"):
+            result = run_flask_target(target, plugin_dir, warmup, workload, args.concurrency)
+        else:
+            result = run_async_target(target, plugin_dir, warmup, workload, args.concurrency)
+    finally:
+        # 刷写聊天记录、停止后台线程，之后插件目录才能被删除
+        release_plugin_state(plugin_dir)
+    with open(args.worker_result, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False)
+
+
+def run_target_process(target, workspace, plugin_dir):
+    """在独立的子进程中测试被测对象：内存峰值与事件循环相关的共享状态互不影响"""
+    result_file = os.path.join(workspace, f"{target}.result.json")
+    command = [
+        sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+        "--worker-target", target, "--worker-workspace", workspace,
+        "--worker-plugin-dir", plugin_dir, "--worker-result", result_file,
+    ]
+    if subprocess.call(command) != 0 or not os.path.exists(result_file):
+        raise RuntimeError(f"测试 {target} 失败")
+    with open(result_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    args = parse_args()
+    if args.worker_target:
+        run_worker(args)
+        return
+    targets = [target.strip() for target in args.targets.split(",") if target.strip()]
+    unknown = [target for target in targets if target not in TARGETS]
+    if unknown:
+        sys.exit(f"未知的被测对象: {', '.join(unknown)}")
+
+    backend, base_url = start_mock_backend(args)
+    workspace = prepare_workspace()
+    results = {}
+    try:
+        for target in targets:
+            print(f"正在测试 {target}：{args.requests} 个请求，并发 {args.concurrency}")
+            plugin_dir = prepare_plugin_dir(workspace, target, args, base_url)
+            try:
+                result = run_target_process(target, workspace, plugin_dir)
+            finally:
+                if not args.keep_workspace:
+                    shutil.rmtree(plugin_dir, ignore_errors=True)
+            results[target] = result
+            latency = result["latency_ms"]
+            first_token = f"首 token p50 {result['first_token_ms']['p50']} ms，" if "first_token_ms" in result else ""
+            print(f"  吞吐 {result['throughput_rps']} rps，p50 {latency['p50']} ms，p95 {latency['p95']} ms，"
+                  f"p99 {latency['p99']} ms，{first_token}失败 {result['errors']}，"
+                  f"CPU {result['cpu_ms_per_request']} ms/请求，峰值内存 {result['peak_rss_mb']} MB")
+    finally:
+        backend.terminate()
+        backend.wait()
+        if not args.keep_workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+        else:
+            print(f"临时工作目录: {workspace}")
+
+    report = {
+        "meta": {
+            "version": plugin_version(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(BENCH_DIR, "results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}")
+
+    if args.compare and compare_results(args.compare, report, args.fail_on_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
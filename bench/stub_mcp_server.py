@@ -0,0 +1,29 @@
+"""基准测试用的 MCP 服务器（stdio），提供延迟可配置的只读工具
+
+工具延迟由环境变量 BENCH_MCP_LATENCY（秒）控制，默认 0.05
+"""
+from mcp.server.fastmcp import FastMCP
+import asyncio, hashlib, os
+
+LATENCY = float(os.environ.get("BENCH_MCP_LATENCY", "0.05"))
+
+mcp = FastMCP("bench-stub")
+
+
+@mcp.tool()
+async def echo(text: str) -> str:
+    """原样返回输入文本"""
+    await asyncio.sleep(LATENCY)
+    return text
+
+
+@mcp.tool()
+async def lookup(query: str) -> str:
+    """模拟只读查询（如车次、天气），相同查询返回相同结果"""
+    await asyncio.sleep(LATENCY)
+    digest = hashlib.sha256(query.encode("utf-8")).hexdigest()[:8]
+    return f"{query} 的查询结果: {digest}"
+
+
+if __name__ == "__main__":
+    mcp.run(transport="stdio")
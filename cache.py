@@ -0,0 +1,193 @@
+from .utils import ConfigManager
+from .metrics import metrics
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+import hashlib, json, math, os, re, time
+import threading
+
+# 规范化问题时去掉的结尾标点
+TRAILING_PUNCTUATION = "?？!！。.~～ "
+
+
+def normalize_question(text: str) -> str:
+    """规范化用户问题：合并空白、统一大小写、去掉结尾标点"""
+    text = re.sub(r'\s+', ' ', str(text)).strip().lower()
+    return text.rstrip(TRAILING_PUNCTUATION)
+
+
+def _normalize_vector(vector: List[float]) -> List[float]:
+    """向量归一化，之后余弦相似度即为点积"""
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector] if norm else list(vector)
+
+
+class CacheLookup:
+    """一次缓存查询的结果，未命中时用于在模型回复后写入缓存"""
+
+    def __init__(self, context_key: str, question: str, reply: Optional[str] = None, embedding=None):
+        self.context_key = context_key
+        self.question = question
+        self.reply = reply
+        self.embedding = embedding
+
+    @property
+    def hit(self) -> bool:
+        return self.reply is not None
+
+
+class ResponseCache:
+    """模型回复缓存：精确匹配（系统提示词 + 最近上下文 + 规范化问题）与可选的向量相似度匹配，带 TTL 与 LRU 淘汰"""
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.config_manager = ConfigManager(plugin_dir)
+        # 精确匹配键 -> {"reply", "expires_at", "context_key", "embedding"}
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.lock = threading.Lock()
+        # 命中统计
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def is_enabled_for(self, msg) -> bool:
+        """是否对该消息启用缓存（可按群开启）"""
+        current_config = self.config_manager.load_config_file()
+        if not current_config.get('enable_response_cache', False):
+            return False
+        groups = current_config.get('response_cache_groups', [])
+        if not groups:
+            return True
+        group_id = getattr(msg, 'group_id', None)
+        return group_id is not None and str(group_id) in {str(g) for g in groups}
+
+    @staticmethod
+    def _hash(*parts) -> str:
+        raw = json.dumps(parts, ensure_ascii=False, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def make_context_key(self, model: str, system_prompt: str, history: List[dict]) -> str:
+        """由模型、系统提示词与最近若干条对话生成上下文键"""
+        context_messages = self.config_manager.load_config_file().get('response_cache_context_messages', 2)
+        recent = history[-context_messages:] if context_messages > 0 else []
+        return self._hash(model, system_prompt, [(m.get("role"), m.get("content")) for m in recent])
+
+    def _get_entry(self, key: str) -> Optional[dict]:
+        """获取未过期的条目（调用方需持有锁）"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _find_similar(self, context_key: str, embedding: List[float], threshold: float) -> Optional[dict]:
+        """在同一上下文的条目中查找相似度最高且超过阈值的条目（调用方需持有锁）"""
+        best, best_score = None, threshold
+        now = time.monotonic()
+        for entry in self._entries.values():
+            if entry["context_key"] != context_key or not entry.get("embedding") or entry["expires_at"] < now:
+                continue
+            score = sum(a * b for a, b in zip(entry["embedding"], embedding))
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    async def lookup(self, context_key: str, user_input: str,
+                     embed: Optional[Callable[[str], Awaitable[List[float]]]] = None) -> CacheLookup:
+        """查询缓存：先精确匹配，未命中且开启语义缓存时再按向量相似度查找"""
+        question = normalize_question(user_input)
+        key = self._hash(context_key, question)
+        with self.lock:
+            entry = self._get_entry(key)
+            if entry is not None:
+                self.exact_hits += 1
+                return CacheLookup(context_key, question, entry["reply"])
+
+        current_config = self.config_manager.load_config_file()
+        embedding = None
+        if embed is not None and current_config.get('response_cache_semantic', False):
+            try:
+                embedding = _normalize_vector(await embed(question))
+            except Exception as e:
+                print(f"生成问题向量失败，跳过语义缓存: {e}")
+            if embedding:
+                threshold = current_config.get('response_cache_similarity', 0.92)
+                with self.lock:
+                    entry = self._find_similar(context_key, embedding, threshold)
+                    if entry is not None:
+                        self.semantic_hits += 1
+                        return CacheLookup(context_key, question, entry["reply"], embedding)
+
+        with self.lock:
+            self.misses += 1
+        return CacheLookup(context_key, question, embedding=embedding)
+
+    def store(self, lookup: CacheLookup, reply: str):
+        """写入模型回复"""
+        if not reply or lookup.hit:
+            return
+        current_config = self.config_manager.load_config_file()
+        ttl = current_config.get('response_cache_ttl', 600)
+        max_size = max(1, int(current_config.get('response_cache_size', 512)))
+        key = self._hash(lookup.context_key, lookup.question)
+        with self.lock:
+            self._entries[key] = {
+                "reply": reply,
+                "expires_at": time.monotonic() + ttl,
+                "context_key": lookup.context_key,
+                "embedding": lookup.embedding,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存"""
+        with self.lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """获取命中统计"""
+        with self.lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            }
+
+
+# 进程内共享的回复缓存（按插件目录区分）
+_response_caches: Dict[str, ResponseCache] = {}
+_response_caches_lock = threading.Lock()
+
+
+def get_response_cache(plugin_dir) -> ResponseCache:
+    """获取进程内共享的回复缓存"""
+    key = os.path.abspath(plugin_dir)
+    with _response_caches_lock:
+        if key not in _response_caches:
+            _response_caches[key] = ResponseCache(plugin_dir)
+        return _response_caches[key]
+
+
+def _collect_metrics():
+    """导出回复缓存命中统计"""
+    with _response_caches_lock:
+        caches = list(_response_caches.values())
+    stats = [cache.stats() for cache in caches]
+    return [
+        ("modelchat_response_cache_entries", "gauge", "回复缓存条目数", [({}, sum(s["entries"] for s in stats))]),
+        ("modelchat_response_cache_lookups_total", "counter", "回复缓存查询次数", [
+            ({"result": "exact_hit"}, sum(s["exact_hits"] for s in stats)),
+            ({"result": "semantic_hit"}, sum(s["semantic_hits"] for s in stats)),
+            ({"result": "miss"}, sum(s["misses"] for s in stats)),
+        ]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -1,12 +1,48 @@
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from ncatbot.core import GroupMessage
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage,SystemMessage, AIMessage
-from langchain_mcp_adapters.client import MultiServerMCPClient
 from langgraph.graph import StateGraph, MessagesState, START, END
-from langgraph.prebuilt import ToolNode
-from .utils import ConfigManager,SystemPromptManager
-import json, os, requests, base64,re
+from .utils import ConfigManager,SystemPromptManager,LoopLocal,file_signature
+from .history import get_history_store
+from .image import ImageFetcher
+from .context import ContextBuilder, extract_cached_tokens, prompt_cache_stats
+from .summary import get_history_summarizer
+from .cache import get_response_cache
+from .concurrency import get_single_flight, request_key
+from .tools import get_tool_registry, ToolExecutor
+from .metrics import STAGE_SECONDS, LLM_REQUEST_SECONDS, LLM_TOKENS, VISION_CALLS, HISTORY_IO_SECONDS, MODEL_ERRORS
+from .tracing import span, traced, current_span
+import json, os, re
+import hashlib, threading, time
+import asyncio
+import httpx
+
+# 共享的异步 OpenAI 客户端（每个事件循环一组，复用 HTTP 连接池）
+_async_openai_clients = LoopLocal()
+
+
+def get_async_openai_client(api_key, base_url, config=None):
+    """获取共享的异步 OpenAI 客户端，相同 api_key 与 base_url 复用同一连接池"""
+    config = config or {}
+    max_connections = config.get('llm_max_connections', 100)
+    timeout = config.get('llm_timeout', 120)
+
+    def factory():
+        return AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                ),
+            ),
+        )
+
+    return _async_openai_clients.get((api_key, base_url, max_connections, timeout), factory)
+
 
 class BaseChatModel:
     """聊天模型的基类"""
@@ -16,9 +52,19 @@ class BaseChatModel:
         self.config_manager = ConfigManager(plugin_dir)
         self.config = self.config_manager.load_config_file()
         self.data_config = self.config_manager.load_data()
-        # 初始化历史记录存储
-        self.history_file = os.path.abspath(os.path.join(plugin_dir, './cache/history.json')).replace("\\", "/")
-        self.history = self._load_history()
+        # 异步图片下载器
+        self.image_fetcher = ImageFetcher(plugin_dir)
+        # 按 token 预算裁剪上下文
+        self.context_builder = ContextBuilder(plugin_dir)
+        # 较早对话的滚动摘要（进程内共享）
+        self.summarizer = get_history_summarizer(plugin_dir)
+        # 重复问题的回复缓存（进程内共享）
+        self.response_cache = get_response_cache(plugin_dir)
+
+    @property
+    def history_store(self):
+        """历史记录存储（进程内共享，插件卸载关闭后重新获取新的实例）"""
+        return get_history_store(self.plugin_dir)
 
     def _clean_reply(self, text):
         """清理回复中的Markdown格式符号"""
@@ -33,76 +79,144 @@ class BaseChatModel:
         text = re.sub(r'\n\s*\n', '\n', text)
 
         return text.strip()
-    def _load_history(self):
-        """加载历史记录"""
-        try:
-            if os.path.exists(self.history_file):
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    loaded_history = json.load(f)
-                    # 同步更新实例中的history属性
-                    self.history = loaded_history
-                    return loaded_history
-        except Exception as e:
-            print(f"FUCKING ERROR 加载历史记录出错: {e}")
-        return {}
-
-    def _save_history(self):
-        """保存历史记录"""
-        try:
-            # 确保目录存在
-            history_dir = os.path.dirname(self.history_file)
-            os.makedirs(history_dir, exist_ok=True)
-
-            # 确保文件存在
-            if not os.path.exists(self.history_file):
-                with open(self.history_file, 'w', encoding='utf-8') as f:
-                    json.dump({}, f, ensure_ascii=False, indent=2)  # type: ignore
-
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.history, f, ensure_ascii=False, indent=2)  # type: ignore
-        except Exception as e:
-            print(f"FUCKING ERROR 保存历史记录出错: {e}")
-
     def get_user_history(self, user_id):
         """获取用户的历史记录（公共接口）"""
-        # 确保获取最新的历史记录，从文件重新加载
-        self.history = self._load_history()
-        return self.history.get(str(user_id), [])
+        return self.history_store.get(user_id)
+
     def _get_user_history(self, user_id):
         """获取用户的历史记录"""
-        # 确保获取最新的历史记录，从文件重新加载
-        self.history = self._load_history()
-        return self.history.get(str(user_id), [])
+        with span("history.get"), HISTORY_IO_SECONDS.time(operation="get"):
+            return self.history_store.get(user_id)
+
+    def _get_context_history(self, user_id, system_prompt, user_input):
+        """获取放得进上下文 token 预算的最近历史记录"""
+        history = self._get_user_history(user_id)
+        return self.context_builder.select_history(history, system_prompt, user_input)
 
     def _update_user_history(self, user_id, message):
-        """更新用户的历史记录"""
+        """更新用户的历史记录，返回因超出记忆长度被移除的记录"""
         try:
-            # 确保用户历史记录存在
-            user_id = str(user_id)
-            if user_id not in self.history:
-                self.history[user_id] = []
-
-            self.history[user_id].append(message)
             # 保持历史记录长度在设定范围内，默认为 10 条
             current_config = self.config_manager.load_config_file()
             max_length = current_config.get('memory_length', 10)
-            if len(self.history[user_id]) > max_length:
-                self.history[user_id] = self.history[user_id][-max_length:]
-
-            # 异步保存历史记录，避免阻塞主流程
-            self._save_history()
+            trim_to = None
+            if self.context_builder.is_stable_prefix():
+                # 稳定前缀模式下按块移除较早记录，避免每轮都改变前缀
+                trim_to = max_length - self.context_builder.get_block_size(max_length)
+            # 仅追加并写入该用户的记录
+            with span("history.append"), HISTORY_IO_SECONDS.time(operation="append"):
+                return self.history_store.append(user_id, message, max_length, trim_to)
         except Exception as e:
             print(f"更新用户历史记录时出错: {e}")
+            return []
 
     def _save_conversation_to_history(self, msg, user_input, reply, is_image=False):
         """保存对话到历史记录"""
-        if hasattr(msg, 'user_id'):
+        if not hasattr(msg, 'user_id'):
+            return
+        with span("history.save"), STAGE_SECONDS.time(stage="history_save"):
             # 如果是图片消息，将用户输入标记为"图片"
             user_content = "[用户发送了一张图片]" if is_image else user_input
-            self._update_user_history(msg.user_id, {"role": "user", "content": user_content})
+            evicted = self._update_user_history(msg.user_id, {"role": "user", "content": user_content})
             # 确保回复内容不为空再保存
             if reply:
-                self._update_user_history(msg.user_id, {"role": "assistant", "content": reply})
+                evicted += self._update_user_history(msg.user_id, {"role": "assistant", "content": reply})
+            # 被移除的对话交给后台摘要，不阻塞回复
+            self.summarizer.schedule(msg.user_id, evicted, self._complete_summary)
+
+    def _get_user_summary(self, user_id):
+        """获取用户较早对话的摘要"""
+        return self.summarizer.get_summary(user_id) if user_id is not None else ""
+
+    @staticmethod
+    def _compose_system_prompt(system_prompt, summary):
+        """将对话摘要附加到系统提示词之后"""
+        if not summary:
+            return system_prompt
+        return f"{system_prompt}\n\n以下是与该用户较早对话的摘要，可作为背景参考：\n{summary}"
+
+    def _get_system_prompt(self, user_id):
+        """获取该用户本次请求的系统提示词：系统提示词（稳定前缀模式下固定）+ 对话摘要"""
+        with span("system_prompt.build"):
+            system_prompt = SystemPromptManager(self.plugin_dir).get_system_prompt()
+            system_prompt = self.context_builder.pin_system_prompt(user_id, system_prompt)
+            return self._compose_system_prompt(system_prompt, self._get_user_summary(user_id))
+
+    @traced("response_cache.lookup")
+    async def _lookup_cached_reply(self, msg, user_input):
+        """查询回复缓存，未对该消息启用缓存时返回 None"""
+        if not self.response_cache.is_enabled_for(msg):
+            return None
+        current_config = self.config_manager.load_config_file()
+        user_id = getattr(msg, 'user_id', None)
+        history = self._get_user_history(user_id) if user_id is not None else []
+        context_key = self.response_cache.make_context_key(
+            current_config.get('model'), self._get_system_prompt(user_id), history
+        )
+        embed = self._embed_text if current_config.get('response_cache_embedding_model') else None
+        return await self.response_cache.lookup(context_key, user_input, embed)
+
+    async def _embed_text(self, text):
+        """调用 OpenAI 兼容的向量接口（可指向本地 Ollama/vLLM）生成问题向量"""
+        current_config = self.config_manager.load_config_file()
+        client = get_async_openai_client(
+            current_config.get('response_cache_embedding_api_key') or current_config['api_key'],
+            current_config.get('response_cache_embedding_base_url') or current_config['base_url'],
+            current_config
+        )
+        response = await client.embeddings.create(
+            model=current_config['response_cache_embedding_model'],
+            input=text
+        )
+        return response.data[0].embedding
+
+    def _reply_from_cache(self, msg, user_input, cache_lookup):
+        """命中缓存时返回缓存的回复，并照常记入历史记录"""
+        print("命中回复缓存")
+        self._save_conversation_to_history(msg, user_input, cache_lookup.reply)
+        return cache_lookup.reply
+
+    async def _coalesce(self, key_parts, factory):
+        """相同模型与消息列表的并发请求只向后端发送一次（各用户的历史记录仍分别保存）"""
+        current_config = self.config_manager.load_config_file()
+        if not current_config.get('enable_request_coalescing', True):
+            return await factory()
+        return await get_single_flight().do(request_key(*key_parts), factory)
+
+    def _record_usage(self, usage):
+        """记录接口返回的 token 用量与前缀缓存命中情况"""
+        tokens = extract_cached_tokens(usage)
+        if not tokens:
+            return
+        prompt_tokens, cached_tokens = tokens
+        if isinstance(usage, dict):
+            completion_tokens = usage.get("output_tokens", 0) or 0
+        else:
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        LLM_TOKENS.inc(prompt_tokens, type="prompt")
+        LLM_TOKENS.inc(completion_tokens, type="completion")
+        LLM_TOKENS.inc(cached_tokens, type="cached")
+        llm_span = current_span()
+        if llm_span is not None:
+            llm_span.set_attribute("prompt_tokens", prompt_tokens)
+            llm_span.set_attribute("completion_tokens", completion_tokens)
+            llm_span.set_attribute("cached_tokens", cached_tokens)
+        prompt_cache_stats.record(prompt_tokens, cached_tokens)
+        if self.context_builder.is_stable_prefix():
+            hit_rate = cached_tokens / prompt_tokens * 100 if prompt_tokens else 0
+            print(f"提示词 {prompt_tokens} tokens，命中前缀缓存 {cached_tokens} tokens（{hit_rate:.1f}%）")
+
+    async def _complete_summary(self, messages):
+        """调用模型生成对话摘要（使用 OpenAI 兼容接口，可通过 summary_model 指定更小的模型）"""
+        current_config = self.config_manager.load_config_file()
+        client = get_async_openai_client(current_config['api_key'], current_config['base_url'], current_config)
+        response = await client.chat.completions.create(
+            model=current_config.get('summary_model') or current_config['model'],
+            messages=messages,
+            temperature=0.3,
+            stream=False
+        )
+        return response.choices[0].message.content
 
     def _build_vision_messages(self, image_data: str, prompt: str = "请描述这张图片"):
         """构建图像识别消息列表"""
@@ -124,25 +238,38 @@ class BaseChatModel:
             }
         ]
 
-    def _encode_image_from_url(self, image_url: str) -> str:
+    async def _encode_image_from_url(self, image_url: str) -> str:
         """从URL获取图片并编码为base64"""
         try:
-            response = requests.get(image_url)
-            response.raise_for_status()
-            return base64.b64encode(response.content).decode('utf-8')
+            return await self.image_fetcher.fetch_base64(image_url)
         except Exception as e:
             raise Exception(f"获取或编码图片失败: {str(e)}")
 
+    @staticmethod
+    def _classify_model_error(error_str):
+        """错误分类（用于指标）"""
+        if "401" in error_str or "Unauthorized" in error_str:
+            return "auth"
+        elif "500" in error_str:
+            return "server_error"
+        elif "502" in error_str:
+            return "bad_gateway"
+        elif "timeout" in error_str.lower() or "time out" in error_str.lower():
+            return "timeout"
+        return "other"
+
     def _handle_model_error(self, error):
         """处理模型错误的通用方法"""
         error_str = str(error)
-        if "401" in error_str or "Unauthorized" in error_str:
+        error_class = self._classify_model_error(error_str)
+        MODEL_ERRORS.inc(error=error_class)
+        if error_class == "auth":
             return "模型API认证失败，请检查配置文件"
-        elif "500" in error_str:
+        elif error_class == "server_error":
             return "模型服务 500 错误，服务器内部错误，请检查云端大模型是否具备 MCP 功能"
-        elif "502" in error_str:
+        elif error_class == "bad_gateway":
             return "LLM 请求失败，请检查大模型是否开启"
-        elif "timeout" in error_str.lower() or "time out" in error_str.lower():
+        elif error_class == "timeout":
             return "请求超时，请稍后重试"
         else:
             return f"请求出错了：{error_str}"
@@ -155,12 +282,17 @@ class BaseChatModel:
         """使用模型处理消息"""
         raise NotImplementedError("子类必须实现 useModel 方法")
 
+    async def useModelStream(self, msg: GroupMessage, user_input: str):
+        """使用模型处理消息，以异步生成器逐段返回回复内容（未经清理的增量文本）"""
+        # 默认实现：不支持流式时一次性返回完整回复
+        yield await self.useModel(msg, user_input)
+
     async def clear_user_history(self, user_id: str):
         """清除指定用户的历史记录"""
         user_id = str(user_id)
-        if user_id in self.history:
-            del self.history[user_id]
-            self._save_history()
+        self.summarizer.discard(user_id)
+        self.context_builder.unpin_system_prompt(user_id)
+        if self.history_store.delete(user_id):
             reply = "已清空聊天记录"
         else:
             reply = "没有找到用户的聊天记录"
@@ -172,27 +304,25 @@ class BaseChatModel:
         return reply
 
 
+# Agent 达到限制且没有可用回答时的兜底回复（不写入回复缓存）
+AGENT_FALLBACK_REPLY = "处理时间过长，请稍后再试或换个问法"
+
+
+class AgentState(MessagesState):
+    """Agent 状态：在消息列表之外记录本次请求的工具轮数、累计提示词 token 与起始时间"""
+    tool_rounds: int
+    prompt_tokens: int
+    started_at: float
+    request_start: int
+    system_prompt: str
+
+
 class ChatModelLangchain(BaseChatModel):
     def __init__(self, plugin_dir):
         """使用Langchain初始化参数"""
         super().__init__(plugin_dir)
 
-        # MCP 客户端设置
-        self.mcp_client = None
-        self.mcp_tools = []
-        self.graph = None
-
-        mcp_config_file = os.path.join(plugin_dir, "mcp_config.json")
-        if os.path.exists(mcp_config_file):
-            try:
-                with open(mcp_config_file, "r", encoding="utf-8") as f:
-                    mcp_config = json.load(f).get("mcpServers", {})
-                if mcp_config:
-                    self.mcp_client = MultiServerMCPClient(mcp_config)
-            except Exception as e:
-                print(f"加载 MCP 配置失败: {e}")
-        else:
-            print("未找到 mcp_config.json 文件，MCP 功能将不可用")
+        # MCP 工具与已编译的图由进程内共享的工具注册表管理（见 tools.py）
 
         # 内存
         self.user_histories = {}
@@ -207,6 +337,8 @@ class ChatModelLangchain(BaseChatModel):
             temperature=current_config.get("model_temperature", 0.6),
             openai_api_key=current_config["api_key"],
             openai_api_base=current_config["base_url"],
+            # 稳定前缀模式下流式输出也返回用量，用于统计前缀缓存命中
+            stream_usage=current_config.get("prompt_cache_mode", False),
         )
 
     def _get_vision_client(self):
@@ -220,26 +352,86 @@ class ChatModelLangchain(BaseChatModel):
             openai_api_base=current_config.get("vision_base_url"),
         )
 
+    @traced("mcp.init_graph")
     async def _init_graph(self):
-        """初始化 LangGraph + MCP 工具"""
-        if self.graph:
-            return self.graph
+        """获取共享的 LangGraph + MCP 工具图，工具或模型配置变化时才重新编译"""
+        registry = get_tool_registry(self.plugin_dir)
+        tools = await registry.get_tools()
 
-        # 动态获取配置
         current_config = self.config_manager.load_config_file()
-        
-        tools = []
-        if self.mcp_client:
-            try:
-                tools = await self.mcp_client.get_tools()
-                print(f"已加载 {len(tools)} 个 MCP 工具")
-            except Exception as e:
-                error_str = str(e)
-                if "Missing 'transport' key" in error_str:
-                    print("MCP配置错误: 请在mcp_config.json中为每个服务器配置添加'transport'字段。可选值: 'stdio', 'sse', 'websocket', 'streamable_http'")
-                else:
-                    print(f"MCP 工具加载失败: {e}")
+        graph_key = tuple(current_config.get(key) for key in ("model", "model_temperature", "api_key", "base_url", "prompt_cache_mode"))
+        return registry.get_graph(graph_key, lambda: self._compile_graph(tools, registry))
+
+    async def refresh_tools(self):
+        """主动重新连接 MCP 服务器并刷新工具列表"""
+        registry = get_tool_registry(self.plugin_dir)
+        return await registry.refresh()
 
+    def _get_agent_limits(self):
+        """获取 Agent 限制配置（0 表示不限制）"""
+        current_config = self.config_manager.load_config_file()
+        return {
+            "max_tool_rounds": current_config.get("agent_max_tool_rounds", 5),
+            "max_prompt_tokens": current_config.get("agent_max_prompt_tokens", 0),
+            "timeout": current_config.get("agent_timeout", 90),
+        }
+
+    def _initial_state(self, messages, system_prompt=""):
+        """构建本次请求的初始图状态"""
+        return {
+            "system_prompt": system_prompt,
+            "messages": messages,
+            "tool_rounds": 0,
+            "prompt_tokens": 0,
+            "started_at": time.monotonic(),
+            "request_start": len(messages),
+        }
+
+    def _graph_config(self):
+        """图运行配置：按最大工具轮数设置递归上限，作为兜底"""
+        max_rounds = self._get_agent_limits()["max_tool_rounds"]
+        if max_rounds <= 0:
+            return {}
+        # 每轮工具调用包含 call_model 与 tools 两步，另留出最终回答的余量
+        return {"recursion_limit": max_rounds * 2 + 5}
+
+    @staticmethod
+    def _remaining_time(state, limits):
+        """本次请求剩余的时间，不限制时返回 None"""
+        if limits["timeout"] <= 0:
+            return None
+        return max(0.0, limits["timeout"] - (time.monotonic() - state.get("started_at", time.monotonic())))
+
+    def _count_prompt_tokens(self, response, messages):
+        """获取本次调用的提示词 token 数，接口未返回用量时使用与上下文预算相同的计数器估算"""
+        usage = getattr(response, "usage_metadata", None) or {}
+        if usage.get("input_tokens"):
+            return usage["input_tokens"]
+        counter = self.context_builder.get_counter()
+        return sum(counter.count_message(message.content) for message in messages)
+
+    def _check_agent_limits(self, state):
+        """检查是否达到工具轮数、token 预算或时间限制，返回原因"""
+        limits = self._get_agent_limits()
+        if limits["max_tool_rounds"] > 0 and state.get("tool_rounds", 0) > limits["max_tool_rounds"]:
+            return "工具调用轮数"
+        if limits["max_prompt_tokens"] > 0 and state.get("prompt_tokens", 0) >= limits["max_prompt_tokens"]:
+            return "token 预算"
+        remaining = self._remaining_time(state, limits)
+        if remaining is not None and remaining <= 0:
+            return "超时"
+        return None
+
+    @staticmethod
+    def _best_answer(state):
+        """从本次请求产生的消息中取最后一条有内容的模型回复"""
+        for message in reversed(state["messages"][state.get("request_start", 0):]):
+            if isinstance(message, AIMessage) and isinstance(message.content, str) and message.content.strip():
+                return message.content
+        return AGENT_FALLBACK_REPLY
+
+    def _compile_graph(self, tools, registry):
+        """编译 LangGraph 图"""
         # 获取动态客户端
         client = self._get_client()
         
@@ -247,38 +439,80 @@ class ChatModelLangchain(BaseChatModel):
         model_with_tools = client
         tool_node = None
         if tools:
+            # 并行执行工具调用，带超时与并发限制
+            tool_node = ToolExecutor(tools, registry.tool_servers, registry.tool_settings, registry.result_cache,
+                                     registry.invalidate)
             try:
                 # 尝试绑定，如果失败就退回原始模型
                 model_with_tools = client.bind_tools(tools)
-                tool_node = ToolNode(tools)
             except Exception as e:
                 print(f"模型不支持 tools，使用原始模型: {e}")
                 model_with_tools = client
-                tool_node = ToolNode(tools)
 
-        async def call_model(state: MessagesState):
-            messages = state["messages"]
-            # 在消息列表开头添加系统提示词
-            system_prompt_manager = SystemPromptManager(self.plugin_dir)
-            system_prompt = system_prompt_manager.get_system_prompt()
+        def with_system_prompt(messages, system_prompt=""):
+            # 在消息列表开头添加系统提示词（由请求方按用户构建，附带对话摘要）
+            if not system_prompt:
+                system_prompt = SystemPromptManager(self.plugin_dir).get_system_prompt()
             if not any(isinstance(msg, SystemMessage) for msg in messages):
                 messages = [SystemMessage(content=system_prompt)] + messages
             print(f"{system_prompt}")
-            response = await model_with_tools.ainvoke(messages)
-            return {"messages": [response]}
+            return messages
+
+        async def call_model(state: AgentState):
+            messages = with_system_prompt(state["messages"], state.get("system_prompt", ""))
+            limits = self._get_agent_limits()
+            remaining = self._remaining_time(state, limits)
+            with span("llm.call", node="call_model", round=state.get("tool_rounds", 0)):
+                try:
+                    with LLM_REQUEST_SECONDS.time(kind="chat"):
+                        response = await asyncio.wait_for(model_with_tools.ainvoke(messages), remaining)
+                except asyncio.TimeoutError:
+                    print(f"Agent 单次请求超过 {limits['timeout']} 秒，提前结束")
+                    return {"messages": [AIMessage(content=self._best_answer(state))]}
+
+                self._record_usage(getattr(response, "usage_metadata", None))
+            return {
+                "messages": [response],
+                "prompt_tokens": state.get("prompt_tokens", 0) + self._count_prompt_tokens(response, messages),
+                "tool_rounds": state.get("tool_rounds", 0) + (1 if getattr(response, "tool_calls", None) else 0),
+            }
 
-        def should_continue(state: MessagesState):
+        async def finalize(state: AgentState):
+            """达到限制后不再调用工具，基于已有信息生成最终回答"""
+            limits = self._get_agent_limits()
+            remaining = self._remaining_time(state, limits)
+            if remaining is None or remaining > 0:
+                # 丢弃未执行的工具调用，避免接口因缺少工具结果而报错
+                messages = with_system_prompt(state["messages"][:-1], state.get("system_prompt", "")) + [
+                    SystemMessage(content="工具调用已达到本次请求的上限，请不要再调用工具，直接根据已有信息回答用户。")
+                ]
+                try:
+                    with span("llm.call", node="finalize"):
+                        with LLM_REQUEST_SECONDS.time(kind="chat"):
+                            response = await asyncio.wait_for(client.ainvoke(messages), remaining)
+                        self._record_usage(getattr(response, "usage_metadata", None))
+                    return {"messages": [response]}
+                except Exception as e:
+                    print(f"Agent 生成最终回答失败: {e}")
+            return {"messages": [AIMessage(content=self._best_answer(state))]}
+
+        def should_continue(state: AgentState):
             last_message = state["messages"][-1]
             # 检查是否有工具调用
-            if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-                return "tools" if tool_node else END
+            if hasattr(last_message, "tool_calls") and last_message.tool_calls and tool_node:
+                limit_reason = self._check_agent_limits(state)
+                if limit_reason:
+                    print(f"Agent 达到限制（{limit_reason}），停止调用工具")
+                    return "finalize"
+                return "tools"
             # 如果没有工具调用，直接结束
             return END
 
-        builder = StateGraph(MessagesState)         # type: ignore
+        builder = StateGraph(AgentState)            # type: ignore
         builder.add_node("call_model", call_model)  # type: ignore
         if tool_node:
             builder.add_node("tools", tool_node)
+            builder.add_node("finalize", finalize)  # type: ignore
 
         builder.add_edge(START, "call_model")
         builder.add_conditional_edges(
@@ -286,20 +520,22 @@ class ChatModelLangchain(BaseChatModel):
             should_continue,
             {
                 "tools": "tools" if tool_node else END,
+                "finalize": "finalize" if tool_node else END,
                 END: END,
             }
         )
         if tool_node:
             builder.add_edge("tools", "call_model")
+            builder.add_edge("finalize", END)
 
-        self.graph = builder.compile()
-        return self.graph
+        return builder.compile()
 
+    @traced("vision.recognize")
     async def recognize_image_with_prompt(self, image_url: str, prompt: str = "请描述这张图片"):
         """使用视觉模型识别图片并结合用户问题"""
         try:
             # 获取并编码图片
-            image_data = self._encode_image_from_url(image_url)
+            image_data = await self._encode_image_from_url(image_url)
 
             # 构建包含图片和用户问题的消息
             messages = self._build_vision_messages(image_data, prompt)
@@ -307,59 +543,136 @@ class ChatModelLangchain(BaseChatModel):
             # 动态获取视觉客户端
             vision_client = self._get_vision_client()
 
-            # 调用视觉模型
-            response = vision_client.invoke(messages)
+            # 调用视觉模型（异步调用，避免阻塞事件循环）
+            with LLM_REQUEST_SECONDS.time(kind="vision"):
+                response = await vision_client.ainvoke(messages)
 
             reply = self._clean_reply(response.content)
+            VISION_CALLS.inc(status="ok")
             return reply
         except Exception as e:
+            VISION_CALLS.inc(status="error")
             # 检查是否是认证错误
             error_str = str(e)
             if "401" in error_str or "Unauthorized" in error_str:
                 raise Exception("模型API认证失败，请检查配置文件")
             raise Exception(f"图像识别出错: {error_str}")
 
+    def _build_langchain_messages(self, msg, user_input: str, system_prompt: str = ""):
+        """构建包含历史记录的 LangChain 消息列表"""
+        messages = []
+
+        # 添加历史记录（system message 会在 call_model 中添加，这里仅用于计算预算）
+        if hasattr(msg, 'user_id'):
+            history = self._get_context_history(msg.user_id, system_prompt, user_input)
+            for item in history:
+                if item["role"] == "user":
+                    messages.append(HumanMessage(content=item["content"]))
+                else:
+                    messages.append(AIMessage(content=item["content"]))
+
+        # 添加当前用户输入
+        messages.append(HumanMessage(content=user_input))
+        return messages
+
+    @traced("use_model", backend="langchain")
+    @STAGE_SECONDS.timed(stage="model")
     async def useModel(self, msg: GroupMessage, user_input: str):
         """使用 LangChain + MCP 处理消息"""
         # 重新加载配置
         self.config_manager.reload_config()
         
         try:
+            cache_lookup = await self._lookup_cached_reply(msg, user_input)
+            if cache_lookup is not None and cache_lookup.hit:
+                return self._reply_from_cache(msg, user_input, cache_lookup)
+
             graph = await self._init_graph()
 
             # 构建包含历史记录的消息
-            messages = []
-
-            # 添加历史记录
-            if hasattr(msg, 'user_id'):
-                history = self._get_user_history(msg.user_id)
-                for item in history:
-                    if item["role"] == "user":
-                        # 确保用户消息内容有效
-                        if item.get("content"):
-                            messages.append(HumanMessage(content=item["content"]))
-                    elif item["role"] == "assistant":
-                        # 确保助手消息内容有效
-                        if item.get("content"):
-                            messages.append(AIMessage(content=item["content"]))
-                    # system message 会在 call_model 中添加
-
-            # 添加当前用户输入
-            messages.append(HumanMessage(content=user_input))
-
-            # 传入包含历史记录的 LangChain 消息对象
-            response = await graph.ainvoke(
-                {"messages": messages}  # type: ignore
+            system_prompt = self._get_system_prompt(getattr(msg, 'user_id', None))
+            messages = self._build_langchain_messages(msg, user_input, system_prompt)
+
+            # 传入包含历史记录的 LangChain 消息对象，相同请求并发时只执行一次
+            current_config = self.config_manager.load_config_file()
+            response = await self._coalesce(
+                (
+                    "langchain",
+                    [current_config.get(key) for key in ("model", "model_temperature", "base_url")],
+                    system_prompt,
+                    [(message.type, message.content) for message in messages],
+                ),
+                lambda: graph.ainvoke(
+                    self._initial_state(messages, system_prompt),  # type: ignore
+                    config=self._graph_config()
+                )
             )
 
             reply = self._clean_reply(response["messages"][-1].content)
             self._save_conversation_to_history(msg, user_input, reply)
+            if cache_lookup is not None and reply != AGENT_FALLBACK_REPLY:
+                self.response_cache.store(cache_lookup, reply)
 
         except Exception as e:
             # 使用通用错误处理方法
             reply = self._handle_model_error(e)
         return reply
 
+    async def useModelStream(self, msg: GroupMessage, user_input: str):
+        """使用 LangChain + MCP 流式处理消息，只输出并保存最终回答（不含调用工具前模型输出的文本）"""
+        self.config_manager.reload_config()
+        chunks = []
+        cache_lookup = None
+        try:
+            cache_lookup = await self._lookup_cached_reply(msg, user_input)
+            if cache_lookup is not None and cache_lookup.hit:
+                yield self._reply_from_cache(msg, user_input, cache_lookup)
+                return
+
+            graph = await self._init_graph()
+            # 绑定了工具时，模型在输出结束前无法确定本轮是否调用工具，最终回答从图的最终状态中取出
+            tools_bound = bool(get_tool_registry(self.plugin_dir).tools)
+            system_prompt = self._get_system_prompt(getattr(msg, 'user_id', None))
+            messages = self._build_langchain_messages(msg, user_input, system_prompt)
+
+            final_state = None
+            async for mode, payload in graph.astream(
+                self._initial_state(messages, system_prompt),  # type: ignore
+                config=self._graph_config(),
+                stream_mode=["messages", "values"]
+            ):
+                if mode == "values":
+                    final_state = payload
+                    continue
+                chunk, metadata = payload
+                node = metadata.get("langgraph_node")
+                # finalize 节点不绑定工具，可直接流式输出
+                if node != "finalize" and (node != "call_model" or tools_bound):
+                    continue
+                content = chunk.content if isinstance(chunk.content, str) else ""
+                if content:
+                    chunks.append(content)
+                    yield content
+
+            # 绑定工具时的最终回答与达到限制时的兜底回答不经过流式输出，从最终状态中取出
+            if not chunks and final_state:
+                content = final_state["messages"][-1].content
+                if isinstance(content, str) and content:
+                    chunks.append(content)
+                    yield content
+        except Exception as e:
+            if not chunks:
+                yield self._handle_model_error(e)
+                return
+            print(f"流式回复中断: {e}")
+            # 不完整的回复不写入缓存
+            cache_lookup = None
+
+        reply = self._clean_reply("".join(chunks))
+        self._save_conversation_to_history(msg, user_input, reply)
+        if cache_lookup is not None and reply != AGENT_FALLBACK_REPLY:
+            self.response_cache.store(cache_lookup, reply)
+
 
 class ChatModel(BaseChatModel):
     def __init__(self, config_path):
@@ -367,23 +680,25 @@ class ChatModel(BaseChatModel):
         super().__init__(config_path)
 
     def _get_client(self):
-        """动态获取聊天客户端"""
+        """动态获取聊天客户端（共享连接池的异步客户端）"""
         # 每次调用时重新加载配置
         current_config = self.config_manager.load_config_file()
         
-        return OpenAI(
-            api_key=current_config['api_key'],
-            base_url=current_config['base_url']
+        return get_async_openai_client(
+            current_config['api_key'],
+            current_config['base_url'],
+            current_config
         )
 
     def _get_vision_client(self):
-        """动态获取视觉客户端"""
+        """动态获取视觉客户端（共享连接池的异步客户端）"""
         # 每次调用时重新加载配置
         current_config = self.config_manager.load_config_file()
         
-        return OpenAI(
-            api_key=current_config.get('vision_api_key', current_config['api_key']),
-            base_url=current_config.get('vision_base_url')
+        return get_async_openai_client(
+            current_config.get('vision_api_key', current_config['api_key']),
+            current_config.get('vision_base_url'),
+            current_config
         )
 
     def _build_messages(self, user_input: str, user_id: str = None):
@@ -393,25 +708,22 @@ class ChatModel(BaseChatModel):
         
         messages = []
 
-        # 添加系统提示词
-        system_prompt_manager = SystemPromptManager(self.plugin_dir)
-        system_prompt = system_prompt_manager.get_system_prompt()
+        # 添加系统提示词（附带该用户较早对话的摘要）
+        system_prompt = self._get_system_prompt(user_id)
         messages.append({"role": "system", "content": system_prompt})
 
         if user_id:
-            history = self._get_user_history(user_id)
-            # 过滤掉无效的历史记录
+            # 过滤无效记录并按 token 预算裁剪
+            history = self._get_context_history(user_id, system_prompt, user_input)
             for item in history:
-                if item["role"] == "assistant" and not item.get("content"):
-                    continue
-                if item["role"] == "user" and not item.get("content"):
-                    continue
-                messages.append(item)
+                # 仅保留接口所需字段（存储中附带时间戳）
+                messages.append({"role": item["role"], "content": item["content"]})
 
         # 添加当前用户输入
         messages.append({"role": "user", "content": user_input})
         return messages
 
+    @traced("vision.recognize")
     async def recognize_image_with_prompt(self, image_url: str, prompt: str = "请描述这张图片"):
         """使用视觉模型识别图片并结合用户问题"""
         # 动态加载配置
@@ -419,7 +731,7 @@ class ChatModel(BaseChatModel):
         
         try:
             # 获取并编码图片
-            image_data = self._encode_image_from_url(image_url)
+            image_data = await self._encode_image_from_url(image_url)
 
             # 构建包含图片和用户问题的消息
             messages = self._build_vision_messages(image_data, prompt)
@@ -428,47 +740,198 @@ class ChatModel(BaseChatModel):
             vision_client = self._get_vision_client()
 
             # 调用视觉模型
-            response = vision_client.chat.completions.create(
-                model=current_config.get('vision_model'),
-                messages=messages,
-                temperature=current_config.get('model_temperature', 0.6),
-                stream=False,
-                max_tokens=2048
-            )
+            with LLM_REQUEST_SECONDS.time(kind="vision"):
+                response = await vision_client.chat.completions.create(
+                    model=current_config.get('vision_model'),
+                    messages=messages,
+                    temperature=current_config.get('model_temperature', 0.6),
+                    stream=False,
+                    max_tokens=2048
+                )
 
             reply = self._clean_reply(response.choices[0].message.content.strip())
+            VISION_CALLS.inc(status="ok")
             return reply
         except Exception as e:
+            VISION_CALLS.inc(status="error")
             # 检查是否是认证错误
             error_str = str(e)
             if "401" in error_str or "Unauthorized" in error_str:
                 raise Exception("模型API认证失败，请检查配置文件")
             raise Exception(f"图像识别出错: {error_str}")
 
+    @traced("use_model", backend="openai")
+    @STAGE_SECONDS.timed(stage="model")
     async def useModel(self, msg: GroupMessage, user_input: str):
         """使用模型处理消息，具有记忆能力"""
         # 动态加载配置
         current_config = self.config_manager.load_config_file()
         
         try:
+            cache_lookup = await self._lookup_cached_reply(msg, user_input)
+            if cache_lookup is not None and cache_lookup.hit:
+                return self._reply_from_cache(msg, user_input, cache_lookup)
+
             # 构建消息列表，包含历史记录
             messages = self._build_messages(user_input, msg.user_id if hasattr(msg, 'user_id') else None)
 
             # 动态获取客户端
             client = self._get_client()
 
-            response = client.chat.completions.create(
-                model=current_config['model'],
-                messages=messages,
-                temperature=current_config.get('model_temperature', 0.6),
-                stream=False
+            async def request():
+                with span("llm.call"):
+                    with LLM_REQUEST_SECONDS.time(kind="chat"):
+                        response = await client.chat.completions.create(
+                            model=current_config['model'],
+                            messages=messages,
+                            temperature=current_config.get('model_temperature', 0.6),
+                            stream=False
+                        )
+                    self._record_usage(getattr(response, "usage", None))
+                return response
+
+            # 相同请求并发时只执行一次
+            response = await self._coalesce(
+                (current_config['model'], current_config.get('model_temperature', 0.6), current_config['base_url'], messages),
+                request
             )
             reply = self._clean_reply(response.choices[0].message.content.strip())
 
             # 保存当前对话到历史记录
             self._save_conversation_to_history(msg, user_input, reply, is_image=False)
+            if cache_lookup is not None:
+                self.response_cache.store(cache_lookup, reply)
 
         except Exception as e:
             # 使用通用错误处理方法
             reply = self._handle_model_error(e)
-        return reply
\ No newline at end of file
+        return reply
+
+    async def useModelStream(self, msg: GroupMessage, user_input: str):
+        """使用模型流式处理消息，逐段返回模型生成的增量文本"""
+        # 动态加载配置
+        current_config = self.config_manager.load_config_file()
+        chunks = []
+        cache_lookup = None
+        try:
+            cache_lookup = await self._lookup_cached_reply(msg, user_input)
+            if cache_lookup is not None and cache_lookup.hit:
+                yield self._reply_from_cache(msg, user_input, cache_lookup)
+                return
+
+            # 构建消息列表，包含历史记录
+            messages = self._build_messages(user_input, msg.user_id if hasattr(msg, 'user_id') else None)
+
+            # 动态获取客户端
+            client = self._get_client()
+
+            started_at = time.perf_counter()
+            stream = await client.chat.completions.create(
+                model=current_config['model'],
+                messages=messages,
+                temperature=current_config.get('model_temperature', 0.6),
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            usage = None
+            try:
+                async for chunk in stream:
+                    # 开启 include_usage 后最后一个分块只包含 token 用量
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    content = chunk.choices[0].delta.content
+                    if content:
+                        chunks.append(content)
+                        yield content
+            finally:
+                LLM_REQUEST_SECONDS.observe(time.perf_counter() - started_at, kind="chat")
+            self._record_usage(usage)
+        except Exception as e:
+            if not chunks:
+                yield self._handle_model_error(e)
+                return
+            print(f"流式回复中断: {e}")
+            # 不完整的回复不写入缓存
+            cache_lookup = None
+
+        reply = self._clean_reply("".join(chunks))
+        # 保存当前对话到历史记录
+        self._save_conversation_to_history(msg, user_input, reply, is_image=False)
+        if cache_lookup is not None:
+            self.response_cache.store(cache_lookup, reply)
+
+class ChatModelRegistry:
+    """聊天模型实例池，按配置指纹复用实例，仅在相关配置变化时重建"""
+
+    # 影响模型实例构建的配置项
+    FINGERPRINT_KEYS = (
+        "enable_mcp", "api_key", "base_url", "model", "model_temperature",
+        "vision_api_key", "vision_base_url", "vision_model",
+    )
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.config_manager = ConfigManager(plugin_dir)
+        self._instance = None
+        self._fingerprint = None
+        self.lock = threading.Lock()
+        # data.json 变化时同步到已有实例（如输出过滤词）
+        self.config_manager.subscribe(self._on_data_changed, target='data')
+
+    def _on_data_changed(self, data):
+        """数据文件变化回调"""
+        with self.lock:
+            if self._instance is not None:
+                self._instance.data_config = data
+
+    def _get_fingerprint(self, config):
+        """计算配置指纹（启用 MCP 时包含 mcp_config.json 的文件签名）"""
+        values = [config.get(key) for key in self.FINGERPRINT_KEYS]
+        if config.get('enable_mcp', True):
+            values.append(file_signature(os.path.join(self.plugin_dir, "mcp_config.json")))
+        raw = json.dumps(values, ensure_ascii=False, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _create_instance(self, config):
+        """根据配置创建模型实例"""
+        if config.get('enable_mcp', True):
+            # 使用Langchain实现
+            return ChatModelLangchain(self.plugin_dir)
+        # 使用原始实现（兼容性更好）
+        return ChatModel(self.plugin_dir)
+
+    def get_instance(self):
+        """获取模型实例，配置指纹未变化时复用已有实例"""
+        current_config = self.config_manager.load_config_file()
+        fingerprint = self._get_fingerprint(current_config)
+
+        with self.lock:
+            if self._instance is None or fingerprint != self._fingerprint:
+                self._instance = self._create_instance(current_config)
+                self._fingerprint = fingerprint
+            else:
+                # 复用实例时同步最新配置（配置已缓存，仅在文件变化时重新解析）
+                self._instance.config = current_config
+            return self._instance
+
+    def invalidate(self):
+        """使当前实例失效，下次获取时重建"""
+        with self.lock:
+            self._instance = None
+            self._fingerprint = None
+
+
+# 进程内共享的模型实例池（按插件目录区分）
+_model_registries = {}
+_model_registries_lock = threading.Lock()
+
+
+def get_model_registry(plugin_dir):
+    """获取进程内共享的模型实例池"""
+    key = os.path.abspath(plugin_dir)
+    with _model_registries_lock:
+        if key not in _model_registries:
+            _model_registries[key] = ChatModelRegistry(plugin_dir)
+        return _model_registries[key]
@@ -84,6 +84,13 @@ ADMIN_COMMANDS = [
         "description": "查看输出过滤词列表",
         "examples": ["#list_clear_words"]
     },
+    {
+        "name": "Refresh MCP Tools",
+        "prefix": "#refresh_mcp",
+        "handler": "refresh_mcp_tools",
+        "description": "重新连接 MCP 服务器并刷新工具列表",
+        "examples": ["#refresh_mcp"]
+    },
     {
         "name": "Add Admin",
         "prefix": "#add_admin",
@@ -0,0 +1,263 @@
+from .utils import ConfigManager, LoopLocal
+from .metrics import metrics
+from .tracing import span
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict
+import asyncio, hashlib, heapq, itertools, json, os, time
+
+# 每个事件循环一个请求合并器（Future 不能跨事件循环等待）
+_single_flights = LoopLocal()
+# 每个事件循环一个准入控制器
+_admission_controllers = LoopLocal()
+
+# 请求优先级（数值越小越优先）
+PRIORITY_ADMIN = 0
+PRIORITY_PRIVATE = 1
+PRIORITY_GROUP = 2
+
+
+def request_key(*parts) -> str:
+    """由模型配置与完整消息列表生成请求键"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class SingleFlight:
+    """请求合并：相同键的并发请求只执行一次，其余请求等待同一个结果"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        # 实际执行与被合并的请求数
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]):
+        """执行请求，已有相同请求在进行中时等待其结果"""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            self.executed += 1
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.coalesced += 1
+        # 某个等待方被取消时不影响其他等待方
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task):
+        """请求完成后移除，之后的相同请求会重新执行"""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # 取出异常，避免无人等待时出现未处理异常的警告
+            task.exception()
+
+    def in_flight(self) -> int:
+        """进行中的请求数"""
+        return len(self._calls)
+
+
+def get_single_flight() -> SingleFlight:
+    """获取当前事件循环的请求合并器"""
+    return _single_flights.get("default", SingleFlight)
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入（频率超限或排队已满），异常信息即回复给用户的提示"""
+    pass
+
+
+class TokenBucket:
+    """令牌桶：按每分钟速率补充令牌，最多积累 burst 个"""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self) -> bool:
+        """尝试取出一个令牌"""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def is_full(self) -> bool:
+        """令牌已补满（可以回收该桶）"""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    """模型调用准入控制：全局并发上限、按用户与按群的令牌桶限流、按优先级排队，以及有界队列"""
+
+    # 令牌桶数量超过该值时回收已补满的桶
+    MAX_BUCKETS = 4096
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.config_manager = ConfigManager(plugin_dir)
+        self._active = 0
+        self._queued = 0
+        # 等待中的请求：(优先级, 序号, Future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._user_buckets: Dict[str, TokenBucket] = {}
+        self._group_buckets: Dict[str, TokenBucket] = {}
+        # 统计
+        self.admitted = 0
+        self.rejected_rate = 0
+        self.rejected_busy = 0
+        self.max_queued = 0
+        self.total_wait_seconds = 0.0
+
+    @staticmethod
+    def get_priority(msg, is_admin=False) -> int:
+        """管理员优先，其次私聊，最后群聊"""
+        if is_admin:
+            return PRIORITY_ADMIN
+        if getattr(msg, 'group_id', None) is None:
+            return PRIORITY_PRIVATE
+        return PRIORITY_GROUP
+
+    def _take_token(self, buckets: Dict[str, TokenBucket], key, rate, burst) -> bool:
+        """从对应的令牌桶取令牌，速率为 0 表示不限制"""
+        if key is None or rate <= 0:
+            return True
+        key = str(key)
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.MAX_BUCKETS:
+                for stale_key in [k for k, b in buckets.items() if b.is_full()]:
+                    del buckets[stale_key]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket.try_take()
+
+    async def acquire(self, msg, is_admin=False):
+        """申请一个模型调用名额，无法准入时抛出 AdmissionRejected"""
+        current_config = self.config_manager.load_config_file()
+        max_concurrency = max(1, int(current_config.get('admission_max_concurrency', 4)))
+        max_queue = int(current_config.get('admission_max_queue', 32))
+        queue_timeout = current_config.get('admission_queue_timeout', 60)
+
+        if not is_admin:
+            user_ok = self._take_token(
+                self._user_buckets, getattr(msg, 'user_id', None),
+                current_config.get('admission_user_rate_per_minute', 0),
+                current_config.get('admission_user_burst', 3),
+            )
+            group_ok = user_ok and self._take_token(
+                self._group_buckets, getattr(msg, 'group_id', None),
+                current_config.get('admission_group_rate_per_minute', 0),
+                current_config.get('admission_group_burst', 10),
+            )
+            if not (user_ok and group_ok):
+                self.rejected_rate += 1
+                raise AdmissionRejected(current_config.get('admission_rate_limit_reply', "您的请求过于频繁，请稍后再试"))
+
+        if self._active < max_concurrency and not self._queued:
+            self._active += 1
+            self.admitted += 1
+            return
+
+        if self._queued >= max_queue and not is_admin:
+            self.rejected_busy += 1
+            raise AdmissionRejected(current_config.get('admission_busy_reply', "当前请求较多，请稍后再试"))
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (self.get_priority(msg, is_admin), next(self._sequence), future))
+        self._queued += 1
+        self.max_queued = max(self.max_queued, self._queued)
+        started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(future, queue_timeout if queue_timeout > 0 else None)
+        except asyncio.TimeoutError:
+            self.rejected_busy += 1
+            raise AdmissionRejected(current_config.get('admission_busy_reply', "当前请求较多，请稍后再试"))
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已转交但请求被取消，归还名额
+                self.release()
+            raise
+        finally:
+            if not future.done() or future.cancelled():
+                # 超时或被取消：该请求不再占用队列
+                self._queued -= 1
+        self.total_wait_seconds += time.monotonic() - started_at
+        self.admitted += 1
+
+    def release(self):
+        """释放名额，优先交给排队中优先级最高的请求"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._queued -= 1
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def is_enabled(self) -> bool:
+        """是否启用准入控制"""
+        return self.config_manager.load_config_file().get('enable_admission', False)
+
+    @asynccontextmanager
+    async def slot(self, msg, is_admin=False):
+        """在名额内执行模型调用：async with controller.slot(msg): ...，未启用准入控制时直接执行"""
+        if not self.is_enabled():
+            yield
+            return
+        with span("admission.acquire", queued=self._queued):
+            await self.acquire(msg, is_admin)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        """获取队列深度等统计"""
+        return {
+            "active": self._active,
+            "queued": self._queued,
+            "max_queued": self.max_queued,
+            "admitted": self.admitted,
+            "rejected_rate": self.rejected_rate,
+            "rejected_busy": self.rejected_busy,
+            "total_wait_seconds": self.total_wait_seconds,
+        }
+
+
+def get_admission_controller(plugin_dir) -> AdmissionController:
+    """获取当前事件循环的准入控制器"""
+    return _admission_controllers.get(os.path.abspath(plugin_dir), lambda: AdmissionController(plugin_dir))
+
+
+def _collect_metrics():
+    """导出准入队列与请求合并统计（汇总所有事件循环）"""
+    totals = {}
+    for controller in _admission_controllers.values():
+        for key, value in controller.stats().items():
+            totals[key] = totals.get(key, 0) + value
+    flights = list(_single_flights.values())
+    return [
+        ("modelchat_admission_active", "gauge", "正在执行的模型调用数", [({}, totals.get("active", 0))]),
+        ("modelchat_admission_queued", "gauge", "排队等待的模型调用数", [({}, totals.get("queued", 0))]),
+        ("modelchat_admission_admitted_total", "counter", "准入的模型调用数", [({}, totals.get("admitted", 0))]),
+        ("modelchat_admission_rejected_total", "counter", "未被准入的请求数", [
+            ({"reason": "rate_limit"}, totals.get("rejected_rate", 0)),
+            ({"reason": "busy"}, totals.get("rejected_busy", 0)),
+        ]),
+        ("modelchat_admission_wait_seconds_total", "counter", "排队等待总时长（秒）", [({}, totals.get("total_wait_seconds", 0.0))]),
+        ("modelchat_coalesced_requests_total", "counter", "请求合并统计", [
+            ({"result": "executed"}, sum(flight.executed for flight in flights)),
+            ({"result": "coalesced"}, sum(flight.coalesced for flight in flights)),
+        ]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,251 @@
+from .utils import ConfigManager
+from .metrics import metrics
+from collections import OrderedDict
+from typing import Callable, Dict, List
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken 为可选依赖，未安装时按字符数估算
+    tiktoken = None
+
+# 每条消息的格式开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens_by_chars(text: str) -> int:
+    """按字符估算 token 数：非 ASCII 字符（中文等）每个约 1 个 token，ASCII 字符约 4 个为 1 个 token"""
+    ascii_count = len(text.encode('ascii', 'ignore'))
+    return (len(text) - ascii_count) + (ascii_count + 3) // 4
+
+
+# 可用的分词器：名称 -> 计数函数
+_tokenizers: Dict[str, Callable[[str], int]] = {"char": count_tokens_by_chars}
+_tokenizers_lock = threading.Lock()
+
+
+def register_tokenizer(name: str, count_func: Callable[[str], int]):
+    """注册自定义分词器（如本地模型的 tokenizer），之后可在配置项 context_tokenizer 中使用"""
+    with _tokenizers_lock:
+        _tokenizers[name] = count_func
+        _token_counters.pop(name, None)
+
+
+def _resolve_tokenizer(name: str) -> Callable[[str], int]:
+    """根据名称获取计数函数，支持 auto、char、tiktoken:<编码名> 及已注册的名称"""
+    if name in _tokenizers:
+        return _tokenizers[name]
+    if name == "auto" or name.startswith("tiktoken"):
+        if tiktoken is not None:
+            encoding_name = name.split(":", 1)[1] if ":" in name else "cl100k_base"
+            try:
+                encoding = tiktoken.get_encoding(encoding_name)
+                return lambda text: len(encoding.encode(text, disallowed_special=()))
+            except Exception as e:
+                print(f"加载 tiktoken 编码 {encoding_name} 失败，使用字符估算: {e}")
+        return count_tokens_by_chars
+    print(f"未知的分词器 {name}，使用字符估算")
+    return count_tokens_by_chars
+
+
+class TokenCounter:
+    """带 LRU 缓存的 token 计数器，相同文本只计算一次"""
+
+    def __init__(self, count_func: Callable[[str], int], cache_size: int = 4096):
+        self.count_func = count_func
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, text) -> int:
+        """计算文本的 token 数"""
+        if not isinstance(text, str):
+            text = str(text)
+        with self._lock:
+            cached = self._cache.get(text)
+            if cached is not None:
+                self._cache.move_to_end(text)
+                return cached
+        count = self.count_func(text)
+        with self._lock:
+            self._cache[text] = count
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return count
+
+    def count_message(self, content) -> int:
+        """计算一条消息的 token 数（含格式开销）"""
+        return self.count(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+# 进程内共享的计数器（按分词器名称区分，缓存在各会话间复用）
+_token_counters: Dict[str, TokenCounter] = {}
+# 正在后台加载的分词器名称
+_loading_tokenizers = set()
+
+
+def _needs_loading(name: str) -> bool:
+    """是否为需要在后台加载的分词器（tiktoken 首次使用时会下载编码文件）"""
+    return tiktoken is not None and name not in _tokenizers and (name == "auto" or name.startswith("tiktoken"))
+
+
+def _load_token_counter(name: str):
+    """在后台线程中加载分词器"""
+    count_func = _resolve_tokenizer(name)
+    with _tokenizers_lock:
+        _token_counters.setdefault(name, TokenCounter(count_func))
+        _loading_tokenizers.discard(name)
+
+
+def preload_token_counter(name: str):
+    """在后台线程中加载分词器，不阻塞事件循环（插件加载时调用）"""
+    with _tokenizers_lock:
+        if not _needs_loading(name) or name in _token_counters or name in _loading_tokenizers:
+            return
+        _loading_tokenizers.add(name)
+    threading.Thread(target=_load_token_counter, args=(name,), name="ModelChatTokenizer", daemon=True).start()
+
+
+def get_token_counter(name: str = "char") -> TokenCounter:
+    """获取共享的 token 计数器；需要下载的分词器在后台加载，加载完成前按字符估算"""
+    if _needs_loading(name):
+        with _tokenizers_lock:
+            counter = _token_counters.get(name)
+        if counter is not None:
+            return counter
+        preload_token_counter(name)
+        name = "char"
+    with _tokenizers_lock:
+        if name not in _token_counters:
+            _token_counters[name] = TokenCounter(_resolve_tokenizer(name))
+        return _token_counters[name]
+
+
+def extract_cached_tokens(usage):
+    """从接口返回的用量中取出 (提示词 token 数, 命中前缀缓存的 token 数)，兼容 OpenAI 响应与 LangChain usage_metadata"""
+    if not usage:
+        return None
+    if isinstance(usage, dict):
+        details = usage.get("input_token_details") or {}
+        return usage.get("input_tokens", 0), details.get("cache_read", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) if details is not None else 0
+    return getattr(usage, "prompt_tokens", 0) or 0, cached or 0
+
+
+class PromptCacheStats:
+    """提示词前缀缓存命中统计（进程内累计）"""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, prompt_tokens: int, cached_tokens: int):
+        """记录一次请求的用量"""
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+
+    def snapshot(self) -> dict:
+        """获取当前统计"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "hit_rate": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            }
+
+
+prompt_cache_stats = PromptCacheStats()
+
+
+def _collect_metrics():
+    """导出提示词前缀缓存命中统计"""
+    stats = prompt_cache_stats.snapshot()
+    return [
+        ("modelchat_prompt_cache_requests_total", "counter", "记录了前缀缓存用量的模型请求数", [({}, stats["requests"])]),
+        ("modelchat_prompt_cache_tokens_total", "counter", "提示词 token 数与其中命中前缀缓存的 token 数", [
+            ({"type": "prompt"}, stats["prompt_tokens"]),
+            ({"type": "cached"}, stats["cached_tokens"]),
+        ]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
+
+# 稳定前缀模式下每个用户固定使用的系统提示词：用户ID -> 提示词
+_pinned_prompts: Dict[str, str] = {}
+_pinned_prompts_lock = threading.Lock()
+
+
+class ContextBuilder:
+    """上下文构建器：在 token 预算内装入系统提示词、当前输入以及尽可能多的最近对话"""
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.config_manager = ConfigManager(plugin_dir)
+
+    def is_stable_prefix(self) -> bool:
+        """是否启用稳定前缀模式（便于后端复用前缀 KV 缓存）"""
+        return self.config_manager.load_config_file().get('prompt_cache_mode', False)
+
+    def get_block_size(self, max_length: int = 0) -> int:
+        """稳定前缀模式下滑动窗口每次移动的消息条数"""
+        block_size = max(1, int(self.config_manager.load_config_file().get('prompt_cache_block_size', 6)))
+        if max_length > 0:
+            block_size = min(block_size, max(1, max_length // 2))
+        return block_size
+
+    def pin_system_prompt(self, user_id, system_prompt: str) -> str:
+        """稳定前缀模式下为用户固定系统提示词，修改提示词只影响清空记录后的新会话"""
+        if user_id is None or not self.is_stable_prefix():
+            return system_prompt
+        with _pinned_prompts_lock:
+            return _pinned_prompts.setdefault(str(user_id), system_prompt)
+
+    @staticmethod
+    def unpin_system_prompt(user_id):
+        """解除用户固定的系统提示词（清空聊天记录时调用）"""
+        with _pinned_prompts_lock:
+            _pinned_prompts.pop(str(user_id), None)
+
+    def get_counter(self) -> TokenCounter:
+        """获取当前配置的 token 计数器"""
+        current_config = self.config_manager.load_config_file()
+        return get_token_counter(current_config.get('context_tokenizer', 'char'))
+
+    def select_history(self, history: List[dict], system_prompt: str, user_input: str) -> List[dict]:
+        """从历史记录中选出能放进 token 预算的最近对话（保持原有顺序）"""
+        # 过滤掉无效的历史记录
+        history = [item for item in history if item.get("role") in ("user", "assistant") and item.get("content")]
+
+        current_config = self.config_manager.load_config_file()
+        max_tokens = current_config.get('context_max_tokens', 4096)
+        if max_tokens <= 0:
+            return history
+
+        counter = self.get_counter()
+        # 系统提示词与当前输入始终保留
+        used = counter.count_message(system_prompt or "") + counter.count_message(user_input or "")
+
+        start = len(history)
+        for index in range(len(history) - 1, -1, -1):
+            used += counter.count_message(history[index]["content"])
+            if used > max_tokens:
+                break
+            start = index
+
+        if self.is_stable_prefix() and start > 0:
+            # 按块对齐起点，预算不变时前缀在多轮对话间保持不变（块大小与裁剪历史记录时一致）
+            block_size = self.get_block_size(current_config.get('memory_length', 10))
+            start = min(len(history), -(-start // block_size) * block_size)
+
+        selected = history[start:]
+        # 不以孤立的助手回复开头
+        while selected and selected[0]["role"] != "user":
+            selected = selected[1:]
+        return selected
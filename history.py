@@ -0,0 +1,669 @@
+from .utils import ConfigManager
+from .metrics import HISTORY_IO_SECONDS
+import json, os, re, time, hashlib
+import sqlite3, threading, atexit
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class BaseHistoryStore:
+    """历史记录存储后端的基类"""
+
+    def get(self, user_id) -> List[dict]:
+        """获取用户的历史记录"""
+        raise NotImplementedError("子类必须实现 get 方法")
+
+    def append(self, user_id, message: dict, max_length: Optional[int] = None,
+               trim_to: Optional[int] = None) -> List[dict]:
+        """追加一条历史记录，超出 max_length 时裁剪到 trim_to 条（默认等于 max_length），返回被移除的记录"""
+        raise NotImplementedError("子类必须实现 append 方法")
+
+    def set(self, user_id, messages: List[dict]):
+        """覆盖用户的历史记录"""
+        raise NotImplementedError("子类必须实现 set 方法")
+
+    def delete(self, user_id) -> bool:
+        """删除用户的历史记录，返回是否存在该记录"""
+        raise NotImplementedError("子类必须实现 delete 方法")
+
+    def user_ids(self) -> List[str]:
+        """获取所有存在历史记录的用户ID"""
+        raise NotImplementedError("子类必须实现 user_ids 方法")
+
+    def list_sessions(self, user_ids: Optional[List[str]] = None) -> List[dict]:
+        """列出会话概要（不含消息正文）：user_id、message_count、last_activity、first_user_message"""
+        sessions = []
+        for user_id in (user_ids if user_ids is not None else self.user_ids()):
+            messages = self.get(user_id)
+            if not messages:
+                continue
+            first_user_message = next((m.get("content", "") for m in messages if m.get("role") == "user"), "")
+            sessions.append({
+                "user_id": str(user_id),
+                "message_count": len(messages),
+                "last_activity": messages[-1].get("timestamp", 0),
+                "first_user_message": first_user_message,
+            })
+        return sessions
+
+    def get_summary(self, user_id) -> str:
+        """获取用户较早对话的摘要"""
+        raise NotImplementedError("子类必须实现 get_summary 方法")
+
+    def set_summary(self, user_id, summary: str):
+        """保存用户较早对话的摘要（随历史记录一起删除），空字符串表示删除摘要"""
+        raise NotImplementedError("子类必须实现 set_summary 方法")
+
+    def close(self):
+        """关闭存储后端"""
+        pass
+
+    @staticmethod
+    def _keep_count(max_length: int, trim_to: Optional[int]) -> int:
+        """裁剪后保留的条数"""
+        if trim_to is None:
+            return max_length
+        return max(0, min(trim_to, max_length))
+
+    @staticmethod
+    def _stamp(message: dict) -> dict:
+        """为记录补充时间戳"""
+        if "timestamp" not in message:
+            message = dict(message)
+            message["timestamp"] = time.time()
+        return message
+
+
+class ShardedHistoryStore(BaseHistoryStore):
+    """按用户分片的历史记录存储，每个用户一个文件，写入只涉及该用户的记录"""
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.cache_dir = os.path.join(plugin_dir, 'cache')
+        self.shard_dir = os.path.join(self.cache_dir, 'history')
+        self.legacy_file = os.path.join(self.cache_dir, 'history.json')
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self._migrate_legacy_history()
+
+    def _shard_path(self, user_id) -> str:
+        """获取用户分片文件路径"""
+        user_id = str(user_id)
+        if not re.fullmatch(r'[0-9A-Za-z_-]+', user_id):
+            # 非常规ID使用哈希作为文件名，避免路径注入
+            user_id = "h_" + hashlib.sha1(user_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.shard_dir, f"{user_id}.json")
+
+    def _read_shard(self, user_id) -> Optional[dict]:
+        """读取用户分片"""
+        path = self._shard_path(user_id)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"读取历史记录分片出错: {e}")
+            return None
+
+    def _write_shard(self, user_id, messages: List[dict], summary: str = ""):
+        """原子写入用户分片"""
+        path = self._shard_path(user_id)
+        tmp_path = f"{path}.tmp"
+        shard = {
+            "user_id": str(user_id),
+            "updated_at": time.time(),
+            "messages": messages,
+        }
+        if summary:
+            shard["summary"] = summary
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(shard, f, ensure_ascii=False)  # type: ignore
+        os.replace(tmp_path, path)
+
+    def _migrate_legacy_history(self):
+        """一次性迁移旧版 history.json 到分片存储"""
+        if not os.path.exists(self.legacy_file):
+            return
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                legacy_history = json.load(f)
+            with self.lock:
+                for user_id, messages in legacy_history.items():
+                    if self._read_shard(user_id) is None:
+                        self._write_shard(user_id, [self._stamp(m) for m in messages])
+            os.replace(self.legacy_file, f"{self.legacy_file}.migrated")
+            print(f"已将 {len(legacy_history)} 个用户的历史记录迁移到分片存储")
+        except Exception as e:
+            print(f"迁移旧版历史记录出错: {e}")
+
+    def get(self, user_id) -> List[dict]:
+        shard = self._read_shard(user_id)
+        return shard.get("messages", []) if shard else []
+
+    def append(self, user_id, message: dict, max_length: Optional[int] = None,
+               trim_to: Optional[int] = None) -> List[dict]:
+        with self.lock:
+            shard = self._read_shard(user_id) or {}
+            messages = shard.get("messages", [])
+            messages.append(self._stamp(message))
+            evicted = []
+            if max_length is not None and len(messages) > max_length:
+                keep = self._keep_count(max_length, trim_to)
+                evicted = messages[:len(messages) - keep]
+                messages = messages[len(messages) - keep:]
+            self._write_shard(user_id, messages, shard.get("summary", ""))
+            return evicted
+
+    def set(self, user_id, messages: List[dict]):
+        with self.lock:
+            self._write_shard(user_id, [self._stamp(m) for m in messages], self.get_summary(user_id))
+
+    def delete(self, user_id) -> bool:
+        with self.lock:
+            try:
+                os.remove(self._shard_path(user_id))
+                return True
+            except FileNotFoundError:
+                return False
+
+    def user_ids(self) -> List[str]:
+        user_ids = []
+        for name in os.listdir(self.shard_dir):
+            if not name.endswith('.json'):
+                continue
+            if name.startswith('h_'):
+                # 哈希文件名需从分片内容中取回原始ID
+                shard = self._read_shard_file(os.path.join(self.shard_dir, name))
+                if shard and shard.get("user_id"):
+                    user_ids.append(shard["user_id"])
+            else:
+                user_ids.append(name[:-len('.json')])
+        return user_ids
+
+    def get_summary(self, user_id) -> str:
+        shard = self._read_shard(user_id)
+        return shard.get("summary", "") if shard else ""
+
+    def set_summary(self, user_id, summary: str):
+        with self.lock:
+            shard = self._read_shard(user_id)
+            if shard is None and not summary:
+                # 没有分片时无需为删除摘要创建空文件
+                return
+            self._write_shard(user_id, shard.get("messages", []) if shard else [], summary)
+
+    @staticmethod
+    def _read_shard_file(path) -> Optional[dict]:
+        """按路径读取分片"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+
+class SqliteHistoryStore(BaseHistoryStore):
+    """基于 SQLite 的历史记录存储，按用户ID索引，WAL 模式支持 WebUI 线程与机器人并发读写"""
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.cache_dir = os.path.join(plugin_dir, 'cache')
+        self.db_file = os.path.join(self.cache_dir, 'history.db')
+        self.legacy_file = os.path.join(self.cache_dir, 'history.json')
+        self.shard_dir = os.path.join(self.cache_dir, 'history')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # 每个线程使用独立连接
+        self._local = threading.local()
+        # 所有线程打开的连接（关闭时统一关闭）
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._init_schema()
+        self._migrate_existing_history()
+
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # 连接只在创建它的线程中使用，关闭时可能由其他线程执行
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _init_schema(self):
+        """初始化表结构与索引"""
+        conn = self._connect()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, id);
+            CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages (user_id, created_at);
+            CREATE TABLE IF NOT EXISTS summaries (
+                user_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+
+    def _migrate_existing_history(self):
+        """数据库为空时，一次性导入旧版 history.json 与分片存储中的记录"""
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+            return
+
+        imported = {}
+        try:
+            if os.path.isdir(self.shard_dir):
+                for name in os.listdir(self.shard_dir):
+                    if name.endswith('.json'):
+                        shard = ShardedHistoryStore._read_shard_file(os.path.join(self.shard_dir, name))
+                        if shard and shard.get("user_id"):
+                            imported[shard["user_id"]] = shard.get("messages", [])
+                            if shard.get("summary"):
+                                self.set_summary(shard["user_id"], shard["summary"])
+            if os.path.exists(self.legacy_file):
+                with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                    for user_id, messages in json.load(f).items():
+                        imported.setdefault(str(user_id), messages)
+
+            if imported:
+                for user_id, messages in imported.items():
+                    self.set(user_id, messages)
+                print(f"已将 {len(imported)} 个用户的历史记录迁移到 SQLite")
+            if os.path.exists(self.legacy_file):
+                os.replace(self.legacy_file, f"{self.legacy_file}.migrated")
+        except Exception as e:
+            print(f"迁移历史记录到 SQLite 出错: {e}")
+
+    @staticmethod
+    def _row_to_message(row) -> dict:
+        """数据库行转换为记录"""
+        return {"role": row[0], "content": row[1], "timestamp": row[2]}
+
+    def get(self, user_id) -> List[dict]:
+        rows = self._connect().execute(
+            "SELECT role, content, created_at FROM messages WHERE user_id = ? ORDER BY id",
+            (str(user_id),)
+        ).fetchall()
+        return [self._row_to_message(row) for row in rows]
+
+    def append(self, user_id, message: dict, max_length: Optional[int] = None,
+               trim_to: Optional[int] = None) -> List[dict]:
+        user_id = str(user_id)
+        message = self._stamp(message)
+        conn = self._connect()
+        # IMMEDIATE 事务在开始时即获取写锁，避免并发写入丢失
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO messages (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, message["role"], message.get("content") or "", message["timestamp"])
+            )
+            evicted = []
+            if max_length is not None:
+                keep = self._keep_count(max_length, trim_to)
+                rows = conn.execute(
+                    "SELECT id, role, content, created_at FROM messages WHERE user_id = ? "
+                    "ORDER BY id DESC LIMIT -1 OFFSET ?",
+                    (user_id, keep)
+                ).fetchall()
+                # 总条数为保留条数加上查出的条数，超出上限时才裁剪
+                if rows and keep + len(rows) > max_length:
+                    conn.execute(
+                        "DELETE FROM messages WHERE user_id = ? AND id <= ?",
+                        (user_id, rows[0][0])
+                    )
+                    evicted = [self._row_to_message(row[1:]) for row in reversed(rows)]
+            conn.execute("COMMIT")
+            return evicted
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def set(self, user_id, messages: List[dict]):
+        user_id = str(user_id)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+            conn.executemany(
+                "INSERT INTO messages (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                [(user_id, m["role"], m.get("content") or "", m["timestamp"])
+                 for m in (self._stamp(m) for m in messages)]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, user_id) -> bool:
+        conn = self._connect()
+        conn.execute("DELETE FROM summaries WHERE user_id = ?", (str(user_id),))
+        cursor = conn.execute("DELETE FROM messages WHERE user_id = ?", (str(user_id),))
+        return cursor.rowcount > 0
+
+    def user_ids(self) -> List[str]:
+        rows = self._connect().execute("SELECT DISTINCT user_id FROM messages").fetchall()
+        return [row[0] for row in rows]
+
+    def list_sessions(self, user_ids: Optional[List[str]] = None) -> List[dict]:
+        # 聚合查询，无需读取消息正文
+        query = (
+            "SELECT user_id, COUNT(*), MAX(created_at), "
+            "(SELECT content FROM messages AS first WHERE first.user_id = m.user_id AND first.role = 'user' "
+            "ORDER BY first.id LIMIT 1) "
+            "FROM messages AS m"
+        )
+        params = ()
+        if user_ids is not None:
+            user_ids = [str(user_id) for user_id in user_ids]
+            if not user_ids:
+                return []
+            query += f" WHERE user_id IN ({','.join('?' * len(user_ids))})"
+            params = tuple(user_ids)
+        rows = self._connect().execute(query + " GROUP BY user_id", params).fetchall()
+        return [
+            {"user_id": row[0], "message_count": row[1], "last_activity": row[2], "first_user_message": row[3] or ""}
+            for row in rows
+        ]
+
+    def get_summary(self, user_id) -> str:
+        row = self._connect().execute(
+            "SELECT summary FROM summaries WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        return row[0] if row else ""
+
+    def set_summary(self, user_id, summary: str):
+        if not summary:
+            self._connect().execute("DELETE FROM summaries WHERE user_id = ?", (str(user_id),))
+            return
+        self._connect().execute(
+            "INSERT OR REPLACE INTO summaries (user_id, summary, updated_at) VALUES (?, ?, ?)",
+            (str(user_id), summary, time.time())
+        )
+
+    def close(self):
+        """关闭所有线程打开的连接"""
+        with self._connections_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"关闭历史记录数据库连接出错: {e}")
+        self._local = threading.local()
+
+
+class CachedHistoryStore(BaseHistoryStore):
+    """带 LRU 缓存与延迟写入的历史记录存储，磁盘 I/O 由后台线程批量完成"""
+
+    def __init__(self, backend: BaseHistoryStore, max_users=1024, flush_interval_ms=1000, flush_max_dirty=64):
+        self.backend = backend
+        self.max_users = max(1, int(max_users))
+        self.flush_interval = max(0, int(flush_interval_ms)) / 1000
+        self.flush_max_dirty = max(1, int(flush_max_dirty))
+        # 热点用户的历史记录（按最近使用排序）
+        self._cache: "OrderedDict[str, List[dict]]" = OrderedDict()
+        # 待写入与待删除的用户
+        self._dirty = set()
+        self._deleted = set()
+        # 用户摘要与待写入摘要的用户（清空记录时摘要置空并单独写入，不受之后追加记录的影响）
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._summary_dirty = set()
+        self.lock = threading.RLock()
+        # 保证同一时间只有一次刷写，避免旧数据覆盖新数据
+        self._flush_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._closed = False
+
+        self._flush_thread = None
+        if self.flush_interval > 0:
+            self._flush_thread = threading.Thread(target=self._flush_loop, name="ModelChatHistoryFlusher", daemon=True)
+            self._flush_thread.start()
+        # 进程退出时保证落盘
+        atexit.register(self.close)
+
+    def _load(self, user_id: str) -> List[dict]:
+        """从缓存获取用户记录，未命中时从后端加载"""
+        if user_id in self._cache:
+            self._cache.move_to_end(user_id)
+            return self._cache[user_id]
+        if user_id in self._deleted:
+            messages = []
+        else:
+            with HISTORY_IO_SECONDS.time(operation="backend_get"):
+                messages = self.backend.get(user_id)
+        self._cache[user_id] = messages
+        self._evict()
+        return messages
+
+    def _evict(self):
+        """淘汰最久未使用且已落盘的用户"""
+        if len(self._cache) > self.max_users:
+            for user_id in list(self._cache.keys()):
+                if len(self._cache) <= self.max_users:
+                    break
+                if user_id not in self._dirty and user_id not in self._deleted:
+                    del self._cache[user_id]
+        if len(self._summaries) > self.max_users:
+            for user_id in list(self._summaries.keys()):
+                if len(self._summaries) <= self.max_users:
+                    break
+                if user_id not in self._summary_dirty:
+                    del self._summaries[user_id]
+
+    def _schedule_flush(self):
+        """未配置写入窗口时同步写入，否则唤醒后台线程"""
+        if self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._flush_event.set()
+
+    def _mark_dirty(self, user_id: str):
+        """标记用户待写入"""
+        self._deleted.discard(user_id)
+        self._dirty.add(user_id)
+        if self.flush_interval <= 0:
+            # 未配置写入窗口时同步写入
+            self.flush()
+        elif len(self._dirty) >= self.flush_max_dirty:
+            self._flush_event.set()
+
+    def get(self, user_id) -> List[dict]:
+        with self.lock:
+            return list(self._load(str(user_id)))
+
+    def append(self, user_id, message: dict, max_length: Optional[int] = None,
+               trim_to: Optional[int] = None) -> List[dict]:
+        user_id = str(user_id)
+        with self.lock:
+            messages = self._load(user_id)
+            messages.append(self._stamp(message))
+            evicted = []
+            if max_length is not None and len(messages) > max_length:
+                keep = self._keep_count(max_length, trim_to)
+                evicted = messages[:len(messages) - keep]
+                del messages[:len(messages) - keep]
+            self._mark_dirty(user_id)
+            return evicted
+
+    def set(self, user_id, messages: List[dict]):
+        user_id = str(user_id)
+        with self.lock:
+            self._cache[user_id] = [self._stamp(m) for m in messages]
+            self._cache.move_to_end(user_id)
+            self._mark_dirty(user_id)
+            self._evict()
+
+    def delete(self, user_id) -> bool:
+        user_id = str(user_id)
+        with self.lock:
+            existed = bool(self._load(user_id))
+            self._cache[user_id] = []
+            self._dirty.discard(user_id)
+            self._deleted.add(user_id)
+            # 摘要单独置空：清空后立即有新消息时 _deleted 会被移除，后端的删除不再执行
+            self._summaries[user_id] = ""
+            self._summaries.move_to_end(user_id)
+            self._summary_dirty.add(user_id)
+            self._schedule_flush()
+            return existed
+
+    def user_ids(self) -> List[str]:
+        # 先落盘再从后端列出
+        self.flush()
+        return self.backend.user_ids()
+
+    def list_sessions(self, user_ids: Optional[List[str]] = None) -> List[dict]:
+        # 先落盘再由后端列出（SQLite 后端可直接聚合）
+        self.flush()
+        return self.backend.list_sessions(user_ids)
+
+    def get_summary(self, user_id) -> str:
+        user_id = str(user_id)
+        with self.lock:
+            if user_id in self._summaries:
+                self._summaries.move_to_end(user_id)
+                return self._summaries[user_id]
+            if user_id in self._deleted:
+                summary = ""
+            else:
+                with HISTORY_IO_SECONDS.time(operation="backend_get_summary"):
+                    summary = self.backend.get_summary(user_id)
+            self._summaries[user_id] = summary
+            self._evict()
+            return summary
+
+    def set_summary(self, user_id, summary: str):
+        user_id = str(user_id)
+        with self.lock:
+            self._summaries[user_id] = summary
+            self._summaries.move_to_end(user_id)
+            self._summary_dirty.add(user_id)
+            self._schedule_flush()
+
+    def flush(self):
+        """将缓存中的改动写入后端"""
+        with self._flush_lock:
+            with self.lock:
+                dirty = {user_id: list(self._cache.get(user_id, [])) for user_id in self._dirty}
+                deleted = set(self._deleted)
+                summaries = {user_id: self._summaries.get(user_id, "") for user_id in self._summary_dirty}
+                self._dirty.clear()
+                self._deleted.clear()
+                self._summary_dirty.clear()
+
+            failed_dirty, failed_deleted = set(), set()
+            for user_id in deleted:
+                try:
+                    with HISTORY_IO_SECONDS.time(operation="backend_delete"):
+                        self.backend.delete(user_id)
+                except Exception as e:
+                    print(f"删除历史记录出错: {e}")
+                    failed_deleted.add(user_id)
+            for user_id, messages in dirty.items():
+                try:
+                    with HISTORY_IO_SECONDS.time(operation="backend_set"):
+                        self.backend.set(user_id, messages)
+                except Exception as e:
+                    print(f"写入历史记录出错: {e}")
+                    failed_dirty.add(user_id)
+            # 摘要在记录之后写入，分片后端写入记录时会保留旧摘要
+            failed_summaries = set()
+            for user_id, summary in summaries.items():
+                try:
+                    with HISTORY_IO_SECONDS.time(operation="backend_set_summary"):
+                        self.backend.set_summary(user_id, summary)
+                except Exception as e:
+                    print(f"写入对话摘要出错: {e}")
+                    failed_summaries.add(user_id)
+
+            if failed_dirty or failed_deleted or failed_summaries:
+                # 写入失败的用户留待下次重试（期间未被再次修改时）
+                with self.lock:
+                    for user_id in failed_deleted:
+                        if user_id not in self._dirty:
+                            self._deleted.add(user_id)
+                    self._dirty.update(u for u in failed_dirty if u not in self._deleted)
+                    # 缓存中的摘要始终是最新值，重试时直接写入
+                    self._summary_dirty.update(u for u in failed_summaries if u in self._summaries)
+
+            with self.lock:
+                # 落盘后可淘汰超出容量的用户
+                self._evict()
+
+    def _flush_loop(self):
+        """后台刷写循环：按时间窗口或脏数据数量触发"""
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            self.flush()
+
+    def close(self):
+        """停止后台线程并刷写所有改动"""
+        if self._closed:
+            return
+        self._closed = True
+        self._stop_event.set()
+        self._flush_event.set()
+        if self._flush_thread is not None and self._flush_thread is not threading.current_thread():
+            self._flush_thread.join(timeout=10)
+        self.flush()
+        self.backend.close()
+
+
+# 可用的历史记录存储后端
+HISTORY_BACKENDS = {
+    "sharded": ShardedHistoryStore,
+    "sqlite": SqliteHistoryStore,
+}
+
+# 进程内共享的存储实例（按插件目录区分）
+_history_stores: Dict[str, BaseHistoryStore] = {}
+_history_stores_lock = threading.Lock()
+
+
+def get_history_store(plugin_dir) -> BaseHistoryStore:
+    """获取进程内共享的历史记录存储，后端由配置项 history_backend 决定"""
+    key = os.path.abspath(plugin_dir)
+    with _history_stores_lock:
+        if key not in _history_stores:
+            config = ConfigManager(plugin_dir).load_config_file() or {}
+            backend = config.get('history_backend', 'sharded')
+            if backend not in HISTORY_BACKENDS:
+                print(f"未知的历史记录存储后端 {backend}，使用 sharded")
+                backend = 'sharded'
+            store = HISTORY_BACKENDS[backend](plugin_dir)
+            if config.get('history_cache', True):
+                store = CachedHistoryStore(
+                    store,
+                    max_users=config.get('history_cache_size', 1024),
+                    flush_interval_ms=config.get('history_flush_interval_ms', 1000),
+                    flush_max_dirty=config.get('history_flush_max_dirty', 64),
+                )
+            _history_stores[key] = store
+        return _history_stores[key]
+
+
+def close_history_stores():
+    """刷写并关闭所有共享的历史记录存储（插件卸载时调用）"""
+    with _history_stores_lock:
+        stores = list(_history_stores.values())
+        _history_stores.clear()
+    for store in stores:
+        try:
+            store.close()
+        except Exception as e:
+            print(f"关闭历史记录存储出错: {e}")
@@ -0,0 +1,91 @@
+from .utils import ConfigManager, LoopLocal
+import asyncio, base64, io
+import httpx
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow 为可选依赖，未安装时不进行压缩
+    Image = None
+
+# 共享的图片下载客户端（每个事件循环一个，复用连接池）
+_image_http_clients = LoopLocal()
+
+
+class ImageTooLargeError(Exception):
+    """图片超过大小限制"""
+    pass
+
+
+class ImageFetcher:
+    """异步图片下载器：共享连接池、超时、流式大小限制，以及可选的缩放压缩"""
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.config_manager = ConfigManager(plugin_dir)
+
+    def _get_http_client(self, timeout):
+        """获取当前事件循环的共享 HTTP 客户端"""
+        return _image_http_clients.get(
+            timeout,
+            lambda: httpx.AsyncClient(
+                timeout=timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            )
+        )
+
+    async def _download(self, image_url: str, max_bytes: int, timeout: float) -> bytes:
+        """流式下载图片，超过大小限制时立即中止"""
+        client = self._get_http_client(timeout)
+        async with client.stream("GET", image_url) as response:
+            response.raise_for_status()
+            content_length = response.headers.get("Content-Length")
+            if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                raise ImageTooLargeError(f"图片大小 {content_length} 字节超过限制 {max_bytes} 字节")
+
+            chunks = []
+            received = 0
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                if received > max_bytes:
+                    raise ImageTooLargeError(f"图片大小超过限制 {max_bytes} 字节")
+                chunks.append(chunk)
+            return b"".join(chunks)
+
+    @staticmethod
+    def _downscale(data: bytes, max_side: int, quality: int) -> bytes:
+        """缩放并重新压缩为 JPEG，失败时返回原始数据"""
+        if Image is None or max_side <= 0:
+            return data
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if max(image.size) <= max_side and image.format == "JPEG":
+                    return data
+                image.thumbnail((max_side, max_side))
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                output = io.BytesIO()
+                image.save(output, format="JPEG", quality=quality, optimize=True)
+                compressed = output.getvalue()
+                return compressed if len(compressed) < len(data) else data
+        except Exception as e:
+            print(f"图片压缩失败，使用原图: {e}")
+            return data
+
+    @classmethod
+    def _encode(cls, data: bytes, max_side: int, quality: int) -> str:
+        """压缩并编码为 base64"""
+        data = cls._downscale(data, max_side, quality)
+        return base64.b64encode(data).decode('utf-8')
+
+    async def fetch_base64(self, image_url: str) -> str:
+        """下载图片并编码为 base64"""
+        current_config = self.config_manager.load_config_file()
+        max_bytes = current_config.get('image_max_bytes', 10 * 1024 * 1024)
+        timeout = current_config.get('image_timeout', 15)
+        max_side = current_config.get('image_max_side', 1568)
+        quality = current_config.get('image_jpeg_quality', 85)
+
+        data = await self._download(image_url, max_bytes, timeout)
+        # 压缩与编码属于 CPU 密集操作，放到线程中执行
+        return await asyncio.to_thread(self._encode, data, max_side, quality)
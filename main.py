@@ -1,12 +1,19 @@
 from ncatbot.plugin import BasePlugin, CompatibleEnrollment
 from ncatbot.core import BaseMessage, GroupMessage, PrivateMessage
 from ncatbot.utils import config as bot_config
-from .chat import ChatModel, ChatModelLangchain
-from .utils import ChatUtils, SystemPromptManager, ConfigManager
-from .ban import BanManager
+from .chat import get_model_registry
+from .utils import ChatUtils, SystemPromptManager, ConfigManager, start_config_watcher, stop_config_watcher
+from .ban import get_ban_manager
 from .commands import USER_COMMANDS, ADMIN_COMMANDS, SUPER_ADMIN_ONLY_COMMANDS
+from .history import close_history_stores
+from .tools import close_tool_registries
+from .concurrency import get_admission_controller, AdmissionRejected
+from .metrics import MetricsServer
+from .tracing import get_tracer, span
+from .context import preload_token_counter
 from .web.webui import ModelChatWebUI
-import os,yaml
+import os
+import asyncio
 import threading
 
 bot = CompatibleEnrollment  # 兼容回调函数注册器
@@ -19,8 +26,12 @@ config_manager = ConfigManager(plugin_dir)
 data_config = config_manager.load_data()
 # 创建 ChatUtils 实例
 chat_utils = ChatUtils(plugin_dir)
-# 创建 BanManager 实例
-ban_manager = BanManager(plugin_dir)
+# 获取共享的 BanManager 实例
+ban_manager = get_ban_manager(plugin_dir)
+# 模型实例池（按配置指纹复用模型实例）
+model_registry = get_model_registry(plugin_dir)
+# 请求追踪器
+tracer = get_tracer(plugin_dir)
 
 class ModelChat(BasePlugin):
     name = "ModelChat"
@@ -40,21 +51,18 @@ class ModelChat(BasePlugin):
         # WebUI实例
         self.webui = None
         self.webui_thread = None
+        # 独立端口的指标服务
+        self.metrics_server = None
 
     @property
     def chat_model_instance(self):
-        """动态获取chat_model_instance，根据当前配置决定使用哪种实现"""
-        # 每次获取时都重新加载配置
-        current_config = config_manager.load_config_file()
-        enable_mcp = current_config.get('enable_mcp', True)
+        """获取chat_model_instance，仅在相关配置变化时重建实例"""
+        return model_registry.get_instance()
 
-        # 根据配置动态选择实现
-        if enable_mcp:
-            # 使用Langchain实现
-            return ChatModelLangchain(plugin_dir)
-        else:
-            # 使用原始实现（兼容性更好）
-            return ChatModel(plugin_dir)
+    def _is_admin(self, msg):
+        """是否为管理员或超级管理员（模型调用优先且不受频率限制）"""
+        user_id = str(getattr(msg, 'user_id', ''))
+        return user_id == str(bot_config.root) or user_id in [str(a) for a in self.chat_model.get('admins', [])]
 
     def _check_active_chat(self, msg):
         """检查并处理用户处于持续对话模式的情况"""
@@ -73,6 +81,12 @@ class ModelChat(BasePlugin):
 
         # 从data.json加载admins配置
         self.chat_model['admins'] = data_config.get('admins', [])
+
+        # 定期检查配置文件变化并通知订阅者（重新加载插件时重新启动）
+        start_config_watcher()
+
+        # 在后台加载 token 分词器（tiktoken 可能需要下载编码文件），不阻塞请求
+        preload_token_counter(self.chat_model.get('context_tokenizer', 'char'))
             
         # 注册指令
         self.commands = USER_COMMANDS
@@ -106,6 +120,27 @@ class ModelChat(BasePlugin):
         if self.chat_model.get('enable_webui', False):
             self.start_webui()
 
+        # 启动独立端口的指标服务（配置中启用）
+        if self.chat_model.get('enable_metrics', False) and self.chat_model.get('metrics_port', 0):
+            self.start_metrics_server()
+
+    async def on_unload(self):
+        # 停止 WebUI 服务器
+        if self.webui is not None:
+            self.webui.stop()
+        # 停止指标服务
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        # 刷写尚未落盘的聊天记录
+        close_history_stores()
+        # 关闭保持中的 MCP 会话
+        close_tool_registries()
+        # 停止配置文件检查线程
+        stop_config_watcher()
+        # 写完尚未落盘的请求追踪
+        tracer.close()
+        print(f"{self.name} 插件已卸载")
+
     def start_webui(self):
         """启动WebUI"""
         try:
@@ -127,29 +162,34 @@ class ModelChat(BasePlugin):
         except Exception as e:
             print(f"启动WebUI时出错: {e}")
 
+    def start_metrics_server(self):
+        """在独立端口启动指标服务"""
+        try:
+            self.metrics_server = MetricsServer(
+                host=self.chat_model.get('metrics_host', '127.0.0.1'),
+                port=self.chat_model.get('metrics_port'),
+                token=self.chat_model.get('metrics_token', '')
+            )
+            self.metrics_server.start()
+        except Exception as e:
+            print(f"启动指标服务时出错: {e}")
+
     async def active_chat_handler(self, msg: BaseMessage):
         """处理处于对话模式中的用户消息"""
         # 检查用户是否在对话模式中
         if msg.user_id in self.active_chats:
             user_input = msg.raw_message.strip()
-            
-            # 检查是否被ban或包含违禁词
-            if await chat_utils.check_ban_and_blocked_words(msg, user_input):
-                print("被 ban 或存在违禁词，被移出持续对话模式")
-                # 从活动对话中移除被ban的用户
-                self.active_chats.discard(msg.user_id)
-                return
 
-            print("正在向LLM发送聊天请求[持续模式]")
-            # 处理图像输入
-            processed_input = await chat_utils.process_image_input(msg, self.chat_model_instance, user_input)
-            if processed_input is None:  # 图片包含违禁词
-                return
+            with tracer.trace("qq.active_chat", user_id=msg.user_id, group_id=getattr(msg, 'group_id', None)):
+                # 检查是否被ban或包含违禁词
+                if await chat_utils.check_ban_and_blocked_words(msg, user_input):
+                    print("被 ban 或存在违禁词，被移出持续对话模式")
+                    # 从活动对话中移除被ban的用户
+                    self.active_chats.discard(msg.user_id)
+                    return
 
-            # 生成回复
-            reply = await chat_utils.generate_response(msg, self.chat_model_instance, processed_input)
-
-            await msg.reply(text=reply)
+                print("正在向LLM发送聊天请求[持续模式]")
+                await self._admitted_model_reply(msg, user_input)
 
     async def start_chat(self, msg: BaseMessage):
         """开始持续对话模式"""
@@ -210,26 +250,72 @@ class ModelChat(BasePlugin):
         text = msg.raw_message.strip()
         user_input = text[3:].strip() if text.startswith('#chat') else text[5:].strip()
 
-        # 检查是否被ban或包含违禁词
-        if await chat_utils.check_ban_and_blocked_words(msg, user_input):
-            print("被 ban 或存在违禁词，拒绝发送请求")
-            return
+        with tracer.trace("qq.chat", user_id=msg.user_id, group_id=getattr(msg, 'group_id', None)):
+            # 检查是否被ban或包含违禁词
+            if await chat_utils.check_ban_and_blocked_words(msg, user_input):
+                print("被 ban 或存在违禁词，拒绝发送请求")
+                return
+
+            print("正在向LLM发送聊天请求")
+            await self._admitted_model_reply(msg, user_input)
 
-        print("正在向LLM发送聊天请求")
-        # 处理图像输入
-        processed_input = await chat_utils.process_image_input(msg, self.chat_model_instance, user_input)
-        if processed_input is None:  # 图片包含违禁词
+    async def _admitted_model_reply(self, msg: BaseMessage, user_input):
+        """经过准入控制（并发上限、频率限制、优先级排队）后调用模型并回复，名额只在调用模型期间占用"""
+        admission = get_admission_controller(plugin_dir)
+        current_config = config_manager.load_config_file()
+        sender = None
+        try:
+            async with admission.slot(msg, self._is_admin(msg)):
+                with span("model_registry.get_instance"):
+                    chat_model_instance = self.chat_model_instance
+                # 处理图像输入
+                processed_input = await chat_utils.process_image_input(msg, chat_model_instance, user_input)
+                if processed_input is None:  # 图片包含违禁词
+                    return
+
+                if current_config.get('enable_stream_reply', False):
+                    # 流式回复：分段发送交给单独的任务，生成结束即释放名额，不等待消息发送
+                    queue = asyncio.Queue()
+                    sender = asyncio.create_task(self._send_stream_reply(msg, queue))
+                    try:
+                        async for chunk in chat_utils.generate_response_stream(msg, chat_model_instance, processed_input):
+                            queue.put_nowait(chunk)
+                    finally:
+                        queue.put_nowait(None)
+                else:
+                    # 生成回复
+                    reply = await chat_utils.generate_response(msg, chat_model_instance, processed_input)
+        except AdmissionRejected as e:
+            print(f"请求未被准入: {e}，队列状态: {admission.stats()}")
+            await msg.reply(text=str(e))
             return
 
-        # 生成回复
-        reply = await chat_utils.generate_response(msg, self.chat_model_instance, processed_input)
+        if sender is not None:
+            await sender
+            return
+        await self._send_reply(msg, reply)
 
+    async def _send_stream_reply(self, msg: BaseMessage, queue):
+        """按句子分段发送流式回复"""
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            try:
+                with span("qq.reply", chars=len(chunk)):
+                    await msg.reply(text=chunk)
+            except Exception as e:
+                print(f"发送流式回复出错: {e}")
+
+    async def _send_reply(self, msg: BaseMessage, reply):
+        """发送模型回复"""
         # 确保回复不是None
         if reply is None:
             reply = "抱歉，我没有理解您的意思。"
 
         # 回复消息
-        await msg.reply(text=reply)
+        with span("qq.reply", chars=len(reply)):
+            await msg.reply(text=reply)
 
     async def chat_history(self, msg: BaseMessage):
         # 检查是否被ban
@@ -381,6 +467,24 @@ class ModelChat(BasePlugin):
 
         await chat_utils.handle_list_clear_words(msg, ban_manager)
 
+    async def refresh_mcp_tools(self, msg: GroupMessage):
+        """重新连接 MCP 服务器并刷新工具列表"""
+        # 检查是否处于持续对话模式中
+        if self._check_active_chat(msg):
+            return
+
+        if not self._is_admin(msg):
+            await msg.reply(text="您没有权限执行此操作。")
+            return
+
+        chat_model_instance = self.chat_model_instance
+        if not hasattr(chat_model_instance, "refresh_tools"):
+            await msg.reply(text="未启用 MCP 功能。")
+            return
+
+        tools = await chat_model_instance.refresh_tools()
+        await msg.reply(text=f"已重新加载 {len(tools)} 个 MCP 工具。")
+
     async def add_admin(self, msg: GroupMessage):
         """添加管理员（仅限超级管理员）"""
         # 检查是否处于持续对话模式中
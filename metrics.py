@@ -0,0 +1,260 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Tuple
+import bisect, functools, threading, time
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# Prometheus 文本格式的 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    """转义标签值"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    """格式化标签：{a="1",b="2"}"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """指标基类：按标签值区分序列"""
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError("子类必须实现 _samples 方法")
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        """增加计数"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(self._labels(key))} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class _Timer:
+    """计时上下文：退出时把耗时记入直方图"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started_at = 0.0
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started_at, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    """直方图：按分桶统计观测值分布"""
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各分桶计数, 总和, 总数]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        """记录一次观测值"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels) -> _Timer:
+        """计时：with histogram.time(stage="model"): ..."""
+        return _Timer(self, labels)
+
+    def timed(self, **labels):
+        """装饰异步函数，记录每次调用的耗时"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(float(bound))})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+# 采集函数返回的指标：(名称, 类型, 说明, [(标签, 值)])
+CollectedMetric = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+class MetricsRegistry:
+    """指标注册表：汇总计数器、直方图以及在导出时读取的统计（队列深度、缓存命中等）"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[CollectedMetric]]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        """注册（或获取已注册的）计数器"""
+        return self._register(Counter(name, documentation, labelnames))  # type: ignore
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        """注册（或获取已注册的）直方图"""
+        return self._register(Histogram(name, documentation, labelnames, buckets))  # type: ignore
+
+    def register_collector(self, collector: Callable[[], Iterable[CollectedMetric]]):
+        """注册采集函数，在导出时调用"""
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def render(self) -> str:
+        """导出 Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                collected = list(collector())
+            except Exception as e:
+                print(f"采集指标出错: {e}")
+                continue
+            for name, metric_type, documentation, samples in collected:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+# 进程内共享的指标注册表
+metrics = MetricsRegistry()
+
+# 消息处理流水线各阶段耗时：check（封禁与违禁词）、image（图片处理）、generate（生成回复）、model（模型调用）、history_save（写入历史记录）
+STAGE_SECONDS = metrics.histogram(
+    "modelchat_stage_seconds", "消息处理各阶段耗时（秒）", ("stage",))
+# 模型请求总耗时与首个 token 耗时
+LLM_REQUEST_SECONDS = metrics.histogram(
+    "modelchat_llm_request_seconds", "单次模型请求耗时（秒）", ("kind",))
+LLM_FIRST_TOKEN_SECONDS = metrics.histogram(
+    "modelchat_llm_first_token_seconds", "流式回复首个 token 耗时（秒）")
+LLM_TOKENS = metrics.counter(
+    "modelchat_llm_tokens_total", "模型 token 用量", ("type",))
+VISION_CALLS = metrics.counter(
+    "modelchat_vision_calls_total", "视觉模型调用次数", ("status",))
+TOOL_CALLS = metrics.counter(
+    "modelchat_tool_calls_total", "MCP 工具调用次数", ("tool", "status"))
+TOOL_CALL_SECONDS = metrics.histogram(
+    "modelchat_tool_call_seconds", "MCP 工具调用耗时（秒）", ("tool",))
+# 历史记录读写耗时：get/append 为请求路径上的读写（启用缓存时多为内存操作），backend_* 为实际的磁盘或 SQLite I/O
+HISTORY_IO_SECONDS = metrics.histogram(
+    "modelchat_history_io_seconds", "历史记录读写耗时（秒）", ("operation",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+MODEL_ERRORS = metrics.counter(
+    "modelchat_model_errors_total", "模型调用错误次数", ("error",))
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """独立端口的 /metrics 处理器"""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        token = self.server.token  # type: ignore
+        if token and self.headers.get("Authorization") != f"Bearer {token}":
+            self.send_error(401)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不打印每次抓取的访问日志
+        pass
+
+
+class MetricsServer:
+    """在独立端口提供 /metrics（未启用 WebUI 时使用）"""
+
+    def __init__(self, host="127.0.0.1", port=9464, token=""):
+        self._server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self._server.token = token  # type: ignore
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="ModelChatMetrics", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        host, port = self._server.server_address[:2]
+        print(f"指标服务已启动: http://{host}:{port}/metrics")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
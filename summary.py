@@ -0,0 +1,129 @@
+from .utils import ConfigManager
+from .history import get_history_store
+from typing import Awaitable, Callable, Dict, List
+import asyncio, os, threading
+
+# 摘要模型的系统提示词
+SUMMARY_SYSTEM_PROMPT = (
+    "你是对话摘要助手。请把已有摘要与新增的对话合并成一份简洁的摘要，"
+    "保留用户的身份、偏好、约定和尚未完成的事项，省略寒暄与重复内容，只输出摘要正文。"
+)
+
+
+class HistorySummarizer:
+    """滚动摘要：将超出记忆长度而被移除的对话在后台压缩进每个用户的摘要"""
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.config_manager = ConfigManager(plugin_dir)
+        # 等待摘要的对话：用户ID -> 被移除的记录
+        self._pending: Dict[str, List[dict]] = {}
+        # 正在运行的摘要任务（保持引用，避免任务被回收）
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # 清空记录时递增，丢弃清空前启动的摘要结果
+        self._generations: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def history_store(self):
+        """历史记录存储（进程内共享，插件卸载关闭后重新获取新的实例）"""
+        return get_history_store(self.plugin_dir)
+
+    def is_enabled(self) -> bool:
+        """是否启用滚动摘要"""
+        return self.config_manager.load_config_file().get('enable_summary', False)
+
+    def get_summary(self, user_id) -> str:
+        """获取用户的对话摘要"""
+        if not self.is_enabled():
+            return ""
+        try:
+            return self.history_store.get_summary(user_id)
+        except Exception as e:
+            print(f"读取对话摘要出错: {e}")
+            return ""
+
+    def schedule(self, user_id, evicted: List[dict], complete: Callable[[List[dict]], Awaitable[str]]):
+        """登记被移除的对话，攒够一批后在后台生成摘要，不阻塞当前回复"""
+        if not evicted or not self.is_enabled():
+            return
+        user_id = str(user_id)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        batch_size = self.config_manager.load_config_file().get('summary_batch_size', 4)
+        with self.lock:
+            pending = self._pending.setdefault(user_id, [])
+            pending.extend({"role": m["role"], "content": m.get("content", "")} for m in evicted)
+            if len(pending) < batch_size or user_id in self._tasks:
+                return
+            self._tasks[user_id] = loop.create_task(self._run(user_id, complete))
+
+    async def _run(self, user_id: str, complete):
+        """依次处理该用户待摘要的对话"""
+        try:
+            while True:
+                with self.lock:
+                    turns = self._pending.pop(user_id, None)
+                    generation = self._generations.get(user_id, 0)
+                if not turns:
+                    break
+                try:
+                    await self._summarize(user_id, turns, complete, generation)
+                except Exception as e:
+                    print(f"生成对话摘要出错: {e}")
+        finally:
+            with self.lock:
+                self._tasks.pop(user_id, None)
+
+    async def _summarize(self, user_id: str, turns: List[dict], complete, generation: int):
+        """合并已有摘要与新增对话"""
+        current_config = self.config_manager.load_config_file()
+        max_chars = current_config.get('summary_max_chars', 300)
+        previous = await asyncio.to_thread(self.history_store.get_summary, user_id)
+
+        dialogue = "\n".join(
+            f"{'用户' if turn['role'] == 'user' else '助手'}: {turn['content']}"
+            for turn in turns if turn.get("content")
+        )
+        messages = [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": (
+                f"已有摘要：\n{previous or '（无）'}\n\n"
+                f"新增对话：\n{dialogue}\n\n"
+                f"请输出更新后的摘要，不超过 {max_chars} 字。"
+            )},
+        ]
+        summary = (await complete(messages) or "").strip()
+        if summary:
+            await asyncio.to_thread(self._store_summary, user_id, summary[:max_chars * 2], generation)
+
+    def _store_summary(self, user_id: str, summary: str, generation: int):
+        """写入摘要；持有锁检查，避免与清空聊天记录交错时写回过期的摘要"""
+        with self.lock:
+            if self._generations.get(user_id, 0) != generation:
+                # 生成期间聊天记录已被清空
+                return
+            self.history_store.set_summary(user_id, summary)
+
+    def discard(self, user_id):
+        """丢弃用户尚未处理的对话与进行中的摘要结果（清空聊天记录时调用）"""
+        user_id = str(user_id)
+        with self.lock:
+            self._pending.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+
+# 进程内共享的摘要器（按插件目录区分）
+_summarizers: Dict[str, HistorySummarizer] = {}
+_summarizers_lock = threading.Lock()
+
+
+def get_history_summarizer(plugin_dir) -> HistorySummarizer:
+    """获取进程内共享的滚动摘要器"""
+    key = os.path.abspath(plugin_dir)
+    with _summarizers_lock:
+        if key not in _summarizers:
+            _summarizers[key] = HistorySummarizer(plugin_dir)
+        return _summarizers[key]
@@ -0,0 +1,9 @@
+"""测试公共配置：插件使用相对导入，在临时目录中以 plugins.ModelChat 的形式导入（与 bench 相同）"""
+import os, sys, tempfile
+
+PLUGIN_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_workspace = tempfile.mkdtemp(prefix="modelchat-tests-")
+os.makedirs(os.path.join(_workspace, "plugins"))
+os.symlink(PLUGIN_ROOT, os.path.join(_workspace, "plugins", "ModelChat"))
+sys.path.insert(0, _workspace)
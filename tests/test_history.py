@@ -0,0 +1,38 @@
+from plugins.ModelChat.history import CachedHistoryStore, ShardedHistoryStore, SqliteHistoryStore
+import pytest
+
+
+@pytest.fixture(params=[ShardedHistoryStore, SqliteHistoryStore])
+def backend(request, tmp_path):
+    store = request.param(str(tmp_path))
+    yield store
+    store.close()
+
+
+def test_clear_then_append_drops_summary(backend):
+    # 写入窗口足够长，由测试显式刷写
+    store = CachedHistoryStore(backend, flush_interval_ms=60000)
+    store.append("42", {"role": "user", "content": "你好"})
+    store.set_summary("42", "S1")
+    store.flush()
+    assert backend.get_summary("42") == "S1"
+
+    # 清空后在下次刷写前立即有新消息
+    store.delete("42")
+    store.append("42", {"role": "user", "content": "新的对话"})
+    store.flush()
+
+    assert store.get_summary("42") == ""
+    assert backend.get_summary("42") == ""
+    assert [m["content"] for m in backend.get("42")] == ["新的对话"]
+    store.close()
+
+
+def test_summary_is_cached(backend):
+    store = CachedHistoryStore(backend, flush_interval_ms=60000)
+    store.set_summary("7", "S1")
+    # 刷写前即可读到，且不会写出空分片
+    assert store.get_summary("7") == "S1"
+    store.flush()
+    assert backend.get_summary("7") == "S1"
+    store.close()
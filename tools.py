@@ -0,0 +1,349 @@
+from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
+from langchain_core.messages import ToolMessage
+from .utils import LoopLocal, file_signature
+from .metrics import metrics, TOOL_CALLS, TOOL_CALL_SECONDS
+from .tracing import span
+from contextlib import AsyncExitStack
+from collections import OrderedDict
+import anyio, asyncio, json, os, time
+
+# 每个事件循环一个工具注册表（MCP 会话绑定在创建它的事件循环上）
+_tool_registries = LoopLocal()
+
+# MCP 会话已断开（如服务器进程退出）时工具调用抛出的异常
+SESSION_LOST_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)
+
+
+class MCPToolRegistry:
+    """MCP 工具注册表：连接一次 MCP 服务器并保持会话，仅在 mcp_config.json 变化或主动刷新时重新加载工具"""
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.mcp_config_file = os.path.join(plugin_dir, "mcp_config.json")
+        self.loop = asyncio.get_running_loop()
+        self.tools = []
+        # 工具名 -> 所属 MCP 服务器名
+        self.tool_servers = {}
+        # mcp_config.json 中的 toolSettings（超时、并发等）
+        self.tool_settings = {}
+        # 每次重新加载工具后递增，用于使已编译的图失效
+        self.version = 0
+        self._signature = None
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self._stop_event = None
+        self._session_task = None
+        # 已编译的 LangGraph 图：键 -> 图
+        self._graphs = {}
+        # 只读工具的结果缓存（所有会话共享）
+        self.result_cache = ToolResultCache()
+
+    def _load_mcp_config(self):
+        """读取 mcp_config.json"""
+        if not os.path.exists(self.mcp_config_file):
+            print("未找到 mcp_config.json 文件，MCP 功能将不可用")
+            return {}
+        try:
+            with open(self.mcp_config_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"加载 MCP 配置失败: {e}")
+            return {}
+
+    def _reset(self):
+        """丢弃已加载的工具与编译的图，下次获取工具时重新连接"""
+        self._loaded = False
+        self._signature = None
+        self.tools = []
+        self.tool_servers = {}
+        self._graphs.clear()
+
+    async def _hold_sessions(self, servers, ready, stop_event):
+        """在独立任务中建立并保持 MCP 会话，直到收到停止信号（会话必须在同一任务中进入与退出）"""
+        try:
+            client = MultiServerMCPClient(servers)
+            async with AsyncExitStack() as stack:
+                tools = []
+                tool_servers = {}
+                for server_name in servers:
+                    try:
+                        session = await stack.enter_async_context(client.session(server_name))
+                        server_tools = await load_mcp_tools(session)
+                    except Exception as e:
+                        error_str = str(e)
+                        if "Missing 'transport' key" in error_str:
+                            print("MCP配置错误: 请在mcp_config.json中为每个服务器配置添加'transport'字段。可选值: 'stdio', 'sse', 'websocket', 'streamable_http'")
+                        else:
+                            print(f"MCP 服务器 {server_name} 工具加载失败: {e}")
+                        continue
+                    for tool in server_tools:
+                        tool_servers[tool.name] = server_name
+                    tools.extend(server_tools)
+
+                ready.set_result((tools, tool_servers))
+                await stop_event.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                print(f"MCP 会话异常断开，下次请求时重新连接: {e}")
+        finally:
+            if self._stop_event is stop_event:
+                # 会话已退出（正常关闭或异常断开），已加载的工具不再可用
+                self._reset()
+
+    async def _stop_sessions(self):
+        """关闭当前持有的 MCP 会话"""
+        if self._session_task is None:
+            return
+        self._stop_event.set()
+        try:
+            await self._session_task
+        except Exception as e:
+            print(f"关闭 MCP 会话出错: {e}")
+        self._session_task = None
+        self._stop_event = None
+
+    async def get_tools(self, force_refresh=False):
+        """获取 MCP 工具列表，配置未变化时直接复用已加载的工具"""
+        signature = file_signature(self.mcp_config_file)
+        if self._loaded and not force_refresh and signature == self._signature:
+            return self.tools
+
+        async with self._lock:
+            if self._loaded and not force_refresh and signature == self._signature:
+                return self.tools
+
+            await self._stop_sessions()
+            mcp_config = self._load_mcp_config()
+            servers = mcp_config.get("mcpServers", {})
+            tools, tool_servers = [], {}
+            if servers:
+                ready = self.loop.create_future()
+                self._stop_event = asyncio.Event()
+                self._session_task = self.loop.create_task(self._hold_sessions(servers, ready, self._stop_event))
+                try:
+                    tools, tool_servers = await ready
+                    print(f"已加载 {len(tools)} 个 MCP 工具")
+                except Exception as e:
+                    print(f"MCP 工具加载失败: {e}")
+                    await self._stop_sessions()
+
+            self.tools = tools
+            self.tool_servers = tool_servers
+            self.tool_settings = mcp_config.get("toolSettings", {})
+            self.result_cache = ToolResultCache(self.tool_settings.get("cache_size", 256))
+            self._signature = signature
+            self._loaded = True
+            self.version += 1
+            self._graphs.clear()
+            return self.tools
+
+    async def refresh(self):
+        """主动重新连接 MCP 服务器并刷新工具列表"""
+        return await self.get_tools(force_refresh=True)
+
+    def get_graph(self, key, builder):
+        """获取已编译的图，不存在时调用 builder 编译（同一工具版本与模型配置下所有会话共享）"""
+        key = (self.version, key)
+        graph = self._graphs.get(key)
+        if graph is None:
+            graph = self._graphs[key] = builder()
+        return graph
+
+    def invalidate(self):
+        """会话已断开时调用，下次获取工具时重新连接"""
+        self._reset()
+
+    def close(self):
+        """关闭 MCP 会话（可在任意线程调用）"""
+        if self._stop_event is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+        self._reset()
+
+
+class ToolResultCache:
+    """工具结果缓存：按工具名与规范化参数缓存结果，带 TTL 与 LRU 淘汰"""
+
+    def __init__(self, max_size=256):
+        self.max_size = max(1, int(max_size))
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(tool_name, args):
+        """生成缓存键（参数按键排序后序列化）"""
+        try:
+            normalized = json.dumps(args, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        except (TypeError, ValueError):
+            normalized = repr(args)
+        return tool_name, normalized
+
+    def get(self, key):
+        """读取未过期的缓存结果"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        """写入缓存结果"""
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存"""
+        self._entries.clear()
+
+
+class ToolExecutor:
+    """工具执行节点：同一轮的多个工具调用并行执行，按服务器限制并发，按工具设置超时，单个工具失败不影响其他工具"""
+
+    def __init__(self, tools, tool_servers=None, tool_settings=None, result_cache=None, on_session_lost=None):
+        self.tools_by_name = {tool.name: tool for tool in tools}
+        self.tool_servers = tool_servers or {}
+        self.tool_settings = tool_settings or {}
+        self.result_cache = result_cache
+        # MCP 会话断开时的回调（通知注册表重新连接）
+        self.on_session_lost = on_session_lost
+        self._semaphores = {}
+
+    def _get_server_settings(self, server_name):
+        """获取服务器级设置"""
+        return self.tool_settings.get("servers", {}).get(server_name, {})
+
+    def _get_timeout(self, tool_name, server_name):
+        """获取工具超时时间（工具 > 服务器 > 默认）"""
+        tool_settings = self.tool_settings.get("tools", {}).get(tool_name, {})
+        if "timeout" in tool_settings:
+            return tool_settings["timeout"]
+        server_settings = self._get_server_settings(server_name)
+        if "timeout" in server_settings:
+            return server_settings["timeout"]
+        return self.tool_settings.get("default_timeout", 30)
+
+    def _get_cache_ttl(self, tool_name):
+        """获取工具结果缓存时间，未配置时不缓存"""
+        if self.result_cache is None:
+            return 0
+        return self.tool_settings.get("tools", {}).get(tool_name, {}).get("cache_ttl", 0)
+
+    def _get_semaphore(self, server_name):
+        """获取服务器并发信号量"""
+        if server_name not in self._semaphores:
+            limit = self._get_server_settings(server_name).get(
+                "max_concurrency", self.tool_settings.get("default_max_concurrency", 4)
+            )
+            self._semaphores[server_name] = asyncio.Semaphore(max(1, int(limit)))
+        return self._semaphores[server_name]
+
+    @staticmethod
+    def _error_message(tool_call, error):
+        """构建结构化的错误结果"""
+        return ToolMessage(
+            content=json.dumps(error, ensure_ascii=False),
+            tool_call_id=tool_call["id"],
+            name=tool_call["name"],
+            status="error",
+        )
+
+    async def _run_tool(self, tool_call):
+        """执行单个工具调用"""
+        tool_name = tool_call["name"]
+        tool = self.tools_by_name.get(tool_name)
+        if tool is None:
+            TOOL_CALLS.inc(tool=tool_name, status="unknown_tool")
+            return self._error_message(tool_call, {"error": "unknown_tool", "tool": tool_name})
+
+        cache_ttl = self._get_cache_ttl(tool_name)
+        if cache_ttl > 0:
+            cache_key = self.result_cache.make_key(tool_name, tool_call.get("args", {}))
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                TOOL_CALLS.inc(tool=tool_name, status="cached")
+                content, artifact = cached
+                return ToolMessage(content=content, artifact=artifact, tool_call_id=tool_call["id"], name=tool_name)
+
+        server_name = self.tool_servers.get(tool_name)
+        timeout = self._get_timeout(tool_name, server_name)
+        try:
+            async with self._get_semaphore(server_name):
+                with TOOL_CALL_SECONDS.time(tool=tool_name):
+                    result = await asyncio.wait_for(tool.ainvoke({**tool_call, "type": "tool_call"}), timeout)
+        except asyncio.TimeoutError:
+            TOOL_CALLS.inc(tool=tool_name, status="timeout")
+            print(f"MCP 工具 {tool_name} 执行超时（{timeout} 秒）")
+            return self._error_message(tool_call, {
+                "error": "timeout",
+                "tool": tool_name,
+                "timeout": timeout,
+                "message": f"工具执行超过 {timeout} 秒未返回，请基于已有信息回答",
+            })
+        except SESSION_LOST_ERRORS as e:
+            TOOL_CALLS.inc(tool=tool_name, status="error")
+            print(f"MCP 服务器 {server_name} 会话已断开，下次请求时重新连接: {e!r}")
+            if self.on_session_lost is not None:
+                self.on_session_lost()
+            return self._error_message(tool_call, {"error": "session_lost", "tool": tool_name, "message": "工具服务暂时不可用"})
+        except Exception as e:
+            TOOL_CALLS.inc(tool=tool_name, status="error")
+            print(f"MCP 工具 {tool_name} 执行失败: {e}")
+            return self._error_message(tool_call, {"error": "tool_error", "tool": tool_name, "message": str(e)})
+
+        if not isinstance(result, ToolMessage):
+            content = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
+            result = ToolMessage(content=content, tool_call_id=tool_call["id"], name=tool_name)
+        TOOL_CALLS.inc(tool=tool_name, status="error" if result.status == "error" else "ok")
+        # 只缓存成功的结果
+        if cache_ttl > 0 and result.status != "error":
+            self.result_cache.set(cache_key, (result.content, result.artifact), cache_ttl)
+        return result
+
+    async def _run_tool_traced(self, tool_call):
+        """执行单个工具调用并记录到请求追踪"""
+        with span("tool.call", tool=tool_call["name"]) as tool_span:
+            result = await self._run_tool(tool_call)
+            if tool_span is not None:
+                tool_span.set_attribute("status", result.status)
+            return result
+
+    async def __call__(self, state):
+        """并行执行最后一条消息中的所有工具调用"""
+        tool_calls = getattr(state["messages"][-1], "tool_calls", None) or []
+        with span("agent.tools", count=len(tool_calls)):
+            results = await asyncio.gather(*(self._run_tool_traced(tool_call) for tool_call in tool_calls))
+        return {"messages": list(results)}
+
+
+def get_tool_registry(plugin_dir) -> MCPToolRegistry:
+    """获取当前事件循环共享的 MCP 工具注册表"""
+    return _tool_registries.get(os.path.abspath(plugin_dir), lambda: MCPToolRegistry(plugin_dir))
+
+
+def close_tool_registries():
+    """关闭所有事件循环中的 MCP 会话并移除注册表（插件卸载时调用，重新加载后重新连接）"""
+    for registry in _tool_registries.clear():
+        registry.close()
+
+
+def _collect_metrics():
+    """导出工具结果缓存命中统计（汇总所有事件循环）"""
+    registries = list(_tool_registries.values())
+    return [
+        ("modelchat_tool_cache_lookups_total", "counter", "工具结果缓存查询次数", [
+            ({"result": "hit"}, sum(registry.result_cache.hits for registry in registries)),
+            ({"result": "miss"}, sum(registry.result_cache.misses for registry in registries)),
+        ]),
+    ]
+
+
+metrics.register_collector(_collect_metrics)
@@ -0,0 +1,291 @@
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+import atexit, contextvars, functools, json, os, queue, threading, time
+
+# 当前请求中正在执行的 span（随 asyncio 任务的上下文传递）
+_current_span: contextvars.ContextVar = contextvars.ContextVar("modelchat_current_span", default=None)
+
+# OTLP 中的 span 类型（INTERNAL）与状态码（OK / ERROR）
+OTLP_SPAN_KIND_INTERNAL = 1
+OTLP_STATUS_OK = 1
+OTLP_STATUS_ERROR = 2
+
+
+def _otlp_value(value) -> dict:
+    """转换为 OTLP 的 AnyValue"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 在 OTLP/JSON 中以字符串表示
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": "" if value is None else str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> List[dict]:
+    """转换为 OTLP 的 KeyValue 列表"""
+    return [{"key": str(key), "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+class Span:
+    """调用链路中的一段：名称、起止时间、属性与子 span"""
+
+    def __init__(self, trace, name: str, parent: Optional["Span"] = None, attributes: Optional[dict] = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.children: List[Span] = []
+        self.status = "ok"
+        self.error = None
+        self.start_time = time.time()
+        self._started_at = time.perf_counter()
+        self.duration = None
+        if parent is not None:
+            parent.children.append(self)
+
+    def set_attribute(self, key: str, value):
+        """设置属性"""
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        """记录异常"""
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        """结束 span"""
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._started_at
+
+    def to_otlp(self) -> dict:
+        """转换为 OTLP/JSON 的 Span"""
+        start_ns = int(self.start_time * 1e9)
+        record = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": OTLP_SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int((self.duration or 0.0) * 1e9)),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": OTLP_STATUS_ERROR if self.status == "error" else OTLP_STATUS_OK},
+        }
+        if self.parent is not None:
+            record["parentSpanId"] = self.parent.span_id
+        if self.error:
+            record["status"]["message"] = self.error
+        return record
+
+    def to_tree(self) -> dict:
+        """转换为带子节点的耗时分解"""
+        node = {"name": self.name, "durationMs": round((self.duration or 0.0) * 1000, 3)}
+        if self.attributes:
+            node["attributes"] = self.attributes
+        if self.error:
+            node["error"] = self.error
+        if self.children:
+            node["children"] = [child.to_tree() for child in self.children]
+        return node
+
+
+class Trace:
+    """一次请求的完整调用链路"""
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List[Span] = []
+
+    def start_span(self, name: str, parent: Optional[Span] = None, attributes: Optional[dict] = None) -> Span:
+        span = Span(self, name, parent, attributes)
+        self.spans.append(span)
+        return span
+
+    def to_otlp(self) -> dict:
+        """转换为一条 OTLP/JSON 导出请求（ExportTraceServiceRequest），可由 OpenTelemetry Collector 的 otlpjsonfile 接收器读取"""
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": "ModelChat"})},
+                "scopeSpans": [{
+                    "scope": {"name": "ModelChat.tracing"},
+                    "spans": [s.to_otlp() for s in self.spans],
+                }],
+            }]
+        }
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """在当前请求的调用链路中记录一段耗时，未处于请求中（或未启用追踪）时不做任何事"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.trace.start_span(name, parent, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def traced(name: str, **attributes):
+    """装饰异步函数，将每次调用记录为一个 span"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span() -> Optional[Span]:
+    """获取当前 span（未处于请求中时为 None）"""
+    return _current_span.get()
+
+
+class Tracer:
+    """请求追踪：为每个请求建立 span 树，写入 JSONL 文件，超过慢请求阈值时输出完整的耗时分解"""
+
+    def __init__(self, plugin_dir):
+        # 局部导入
+        from .utils import ConfigManager
+
+        self.plugin_dir = plugin_dir
+        self.config_manager = ConfigManager(plugin_dir)
+        self.lock = threading.Lock()
+        # 待写入的 (文件路径, 行)，由后台线程写入，不阻塞事件循环
+        self._queue: "queue.Queue" = queue.Queue()
+        self._writer = None
+        # 进程退出时写完剩余的记录
+        atexit.register(self.close)
+
+    def _resolve_path(self, path: str) -> str:
+        return path if os.path.isabs(path) else os.path.join(self.plugin_dir, path)
+
+    @contextmanager
+    def trace(self, name: str, **attributes):
+        """追踪一个请求（根 span），已处于请求中时作为子 span 记录"""
+        if _current_span.get() is not None:
+            with span(name, **attributes) as child:
+                yield child
+            return
+        if not self.config_manager.load_config_file().get('enable_tracing', False):
+            yield None
+            return
+
+        root = Trace().start_span(name, None, attributes)
+        token = _current_span.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            root.end()
+            self._export(root)
+
+    def _append_line(self, path: str, line: str):
+        """交给后台线程追加写入 JSONL 文件"""
+        with self.lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="ModelChatTraceWriter", daemon=True)
+                self._writer.start()
+        self._queue.put((self._resolve_path(path), line))
+
+    def _write_loop(self):
+        """后台写入循环：合并队列中已有的记录后按文件批量追加"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write_batch(batch)
+                    return
+                batch.append(item)
+            self._write_batch(batch)
+
+    @staticmethod
+    def _write_batch(batch):
+        lines_by_path: Dict[str, List[str]] = {}
+        for path, line in batch:
+            lines_by_path.setdefault(path, []).append(line)
+        for path, lines in lines_by_path.items():
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write("".join(line + "\n" for line in lines))
+            except Exception as e:
+                print(f"写入请求追踪出错: {e}")
+
+    def close(self):
+        """写完队列中的记录并停止后台线程"""
+        with self.lock:
+            writer, self._writer = self._writer, None
+        if writer is not None and writer.is_alive():
+            self._queue.put(None)
+            writer.join(timeout=10)
+
+    def _export(self, root: Span):
+        """写入调用链路，慢请求额外输出耗时分解"""
+        current_config = self.config_manager.load_config_file()
+        try:
+            trace_file = current_config.get('tracing_file', 'cache/traces.jsonl')
+            if trace_file:
+                self._append_line(trace_file, json.dumps(root.trace.to_otlp(), ensure_ascii=False, default=str))
+
+            threshold = current_config.get('tracing_slow_threshold', 10)
+            if threshold and root.duration >= threshold:
+                print(f"慢请求 {root.name} 耗时 {root.duration:.2f} 秒（trace {root.trace.trace_id}）：\n{format_span_tree(root)}")
+                slow_file = current_config.get('tracing_slow_file', 'cache/slow_requests.jsonl')
+                if slow_file:
+                    self._append_line(slow_file, json.dumps({
+                        "traceId": root.trace.trace_id,
+                        "time": root.start_time,
+                        "durationMs": round(root.duration * 1000, 3),
+                        "spans": root.to_tree(),
+                    }, ensure_ascii=False, default=str))
+        except Exception as e:
+            print(f"写入请求追踪出错: {e}")
+
+
+def format_span_tree(root: Span, indent: int = 1) -> str:
+    """以缩进文本输出 span 树"""
+    lines = []
+
+    def walk(node: Span, depth: int):
+        error = f" [{node.error}]" if node.error else ""
+        lines.append(f"{'  ' * depth}{node.name} {(node.duration or 0.0) * 1000:.1f}ms{error}")
+        for child in node.children:
+            walk(child, depth + 1)
+
+    walk(root, indent)
+    return "\n".join(lines)
+
+
+# 进程内共享的追踪器（按插件目录区分）
+_tracers: Dict[str, Tracer] = {}
+_tracers_lock = threading.Lock()
+
+
+def get_tracer(plugin_dir) -> Tracer:
+    """获取进程内共享的请求追踪器"""
+    key = os.path.abspath(plugin_dir)
+    with _tracers_lock:
+        if key not in _tracers:
+            _tracers[key] = Tracer(plugin_dir)
+        return _tracers[key]
@@ -1,13 +1,217 @@
 from ncatbot.core import BaseMessage
 from ncatbot.utils import config as bot_config
-import json, yaml, os
+from .metrics import STAGE_SECONDS, LLM_FIRST_TOKEN_SECONDS
+from .tracing import span, traced
+import json, yaml, os, copy, re
+import asyncio, threading, time, weakref
+
+# 流式回复的句子边界（中英文句末标点或换行）
+SENTENCE_BOUNDARY = re.compile(r'[。！？!?；;\n]+|\.(?=\s)')
+
+# 进程内共享的文件解析缓存：路径 -> (文件签名, 解析结果)
+_file_cache = {}
+# 文件变化订阅者：路径 -> 回调列表
+_file_subscribers = {}
+_file_cache_lock = threading.RLock()
+# 有订阅者的文件：路径 -> (ConfigManager, 订阅目标)，由后台线程定期检查文件变化
+_watched_files = {}
+_config_watcher = None
+
+# 检查配置文件变化的间隔（秒）
+CONFIG_WATCH_INTERVAL = 2
+
+
+def file_signature(path):
+    """获取文件签名（修改时间与大小），文件不存在时返回 None"""
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+class LoopLocal:
+    """按事件循环隔离的对象缓存（异步客户端、连接池等不能跨事件循环复用）"""
+
+    def __init__(self):
+        self._values = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        """获取当前事件循环中 key 对应的对象，不存在时用 factory 创建"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            values = self._values.get(loop)
+            if values is None:
+                values = self._values[loop] = {}
+            if key not in values:
+                values[key] = factory()
+            return values[key]
+
+    def values(self):
+        """获取所有事件循环中的对象"""
+        with self._lock:
+            return [value for values in list(self._values.values()) for value in values.values()]
+
+    def clear(self):
+        """移除所有事件循环中的对象，返回被移除的对象"""
+        with self._lock:
+            values = [value for values in list(self._values.values()) for value in values.values()]
+            self._values = weakref.WeakKeyDictionary()
+            return values
+
+
+class BackgroundLoop:
+    """后台常驻事件循环：同步代码（如 WSGI 线程）把协程提交到同一个事件循环执行，复用异步客户端与连接池"""
+
+    def __init__(self, name="ModelChatLoop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro, timeout=None):
+        """在后台事件循环中执行协程并等待结果"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def iterate(self, async_gen):
+        """逐项驱动异步生成器，供同步的流式响应使用（迭代提前结束时关闭生成器）"""
+        try:
+            while True:
+                try:
+                    item = self.run(async_gen.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield item
+        finally:
+            self.run(async_gen.aclose())
+
+    def stop(self):
+        """停止后台事件循环"""
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+
+class ConfigWatcher:
+    """后台线程定期检查有订阅者的配置文件与数据文件，手动修改文件后无需等待其他读取即可通知订阅者"""
+
+    def __init__(self, interval=CONFIG_WATCH_INTERVAL):
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ModelChatConfigWatcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            with _file_cache_lock:
+                watched = list(_watched_files.values())
+            for manager, target in watched:
+                try:
+                    manager.check_for_changes((target,))
+                except Exception as e:
+                    print(f"检查配置文件变化出错: {e}")
+
+    def stop(self):
+        """停止后台线程"""
+        self._stop_event.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+
+
+def start_config_watcher():
+    """存在订阅者且检查线程未运行时启动（订阅时与插件加载时调用）"""
+    global _config_watcher
+    with _file_cache_lock:
+        if _config_watcher is None and _watched_files:
+            _config_watcher = ConfigWatcher()
+
+
+def stop_config_watcher():
+    """停止配置文件检查线程（插件卸载时调用）"""
+    global _config_watcher
+    with _file_cache_lock:
+        watcher, _config_watcher = _config_watcher, None
+    if watcher is not None:
+        watcher.stop()
+
 
 class ConfigManager:
     """配置管理器"""
     def __init__(self, plugin_dir):
         self.plugin_dir = plugin_dir
-        self.config_path = os.path.join(plugin_dir, 'config.yml')
-        self.data_path = os.path.join(plugin_dir, 'data.json')
+        self.config_path = os.path.abspath(os.path.join(plugin_dir, 'config.yml'))
+        self.data_path = os.path.abspath(os.path.join(plugin_dir, 'data.json'))
+
+    def _load_cached(self, path, parser):
+        """读取文件解析结果，仅在文件修改时间或大小变化时重新解析"""
+        signature = file_signature(path)
+        with _file_cache_lock:
+            cached = _file_cache.get(path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+            with span("config.parse", file=os.path.basename(path)):
+                value = parser()
+            _file_cache[path] = (signature, value)
+        # 首次加载之后的变化才通知订阅者
+        if cached is not None:
+            self._notify(path, value)
+        return value
+
+    def _store_cached(self, path, value):
+        """进程内写入文件后直接更新缓存并通知订阅者"""
+        with _file_cache_lock:
+            _file_cache[path] = (file_signature(path), value)
+        self._notify(path, value)
+
+    def _notify(self, path, value):
+        """通知文件变化"""
+        with _file_cache_lock:
+            callbacks = list(_file_subscribers.get(path, []))
+        for callback in callbacks:
+            try:
+                callback(copy.deepcopy(value))
+            except Exception as e:
+                print(f"配置变化回调出错: {e}")
+
+    def _get_watch_path(self, target):
+        """获取订阅目标对应的文件路径"""
+        if target == 'config':
+            return self.config_path
+        if target == 'data':
+            return self.data_path
+        raise ValueError(f"未知的订阅目标: {target}")
+
+    def subscribe(self, callback, target='config'):
+        """订阅配置变化，target 可选 config（config.yml）或 data（data.json），回调参数为最新内容"""
+        path = self._get_watch_path(target)
+        with _file_cache_lock:
+            _file_subscribers.setdefault(path, []).append(callback)
+            _watched_files.setdefault(path, (self, target))
+        start_config_watcher()
+
+    def unsubscribe(self, callback, target='config'):
+        """取消订阅配置变化"""
+        path = self._get_watch_path(target)
+        with _file_cache_lock:
+            callbacks = _file_subscribers.get(path, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def check_for_changes(self, targets=('config', 'data')):
+        """检查配置文件与数据文件是否变化，变化时通知订阅者（由 ConfigWatcher 定期检查有订阅者的文件）"""
+        if 'config' in targets:
+            self._load_cached(self.config_path, self._parse_config_file)
+        if 'data' in targets:
+            self._load_cached(self.data_path, self._parse_data)
         
     def get_config_path(self):
         """获取配置文件路径"""
@@ -18,10 +222,14 @@ class ConfigManager:
         return self.data_path
         
     def load_config_file(self):
-        """加载配置文件"""
+        """加载配置文件（文件未变化时使用缓存）"""
+        return copy.deepcopy(self._load_cached(self.config_path, self._parse_config_file))
+
+    def _parse_config_file(self):
+        """解析配置文件"""
         try:
             with open(self.config_path, 'r', encoding='utf-8') as f:
-                return yaml.safe_load(f)
+                return yaml.safe_load(f) or {}
         except Exception as e:
             print(f"加载配置文件出错: {e}")
             return {}
@@ -40,7 +248,6 @@ class ConfigManager:
                 # 检查每一行是否包含需要更新的键
                 for key, value in updates.items():
                     # 匹配键的正则表达式（考虑可能的空格）
-                    import re
                     pattern = r'^(\s*)' + re.escape(key) + r'(\s*):(.*?)(#.*)?$'
                     match = re.match(pattern, line)
                     if match:
@@ -65,6 +272,9 @@ class ConfigManager:
             # 写回文件
             with open(self.config_path, 'w', encoding='utf-8') as f:
                 f.writelines(updated_lines)
+
+            # 刷新缓存并通知订阅者
+            self._store_cached(self.config_path, self._parse_config_file())
                 
             return True
         except Exception as e:
@@ -72,7 +282,11 @@ class ConfigManager:
             return False
 
     def load_data(self):
-        """加载JSON数据文件"""
+        """加载JSON数据文件（文件未变化时使用缓存）"""
+        return copy.deepcopy(self._load_cached(self.data_path, self._parse_data))
+
+    def _parse_data(self):
+        """解析JSON数据文件"""
         default_data = {
             "banned_groups": [],
             "banned_users": [],
@@ -102,20 +316,20 @@ class ConfigManager:
         try:
             with open(self.data_path, 'w', encoding='utf-8') as f:
                 json.dump(data, f, ensure_ascii=False, indent=2) # type: ignore
+            # 刷新缓存并通知订阅者
+            self._store_cached(self.data_path, self._parse_data())
         except Exception as e:
             print(f"保存数据文件出错: {e}")
 
     def load_history_sessions(self, allowed_user_ids=None):
-        """从历史记录文件中加载会话数据"""
+        """从历史记录存储中加载会话数据"""
+        # 局部导入
+        from .history import get_history_store
+
         sessions = {}
-        history_file = os.path.join(self.plugin_dir, 'cache', 'history.json')
         
         try:
-            if os.path.exists(history_file):
-                with open(history_file, 'r', encoding='utf-8') as f:
-                    history_data = json.load(f)
-            else:
-                history_data = {}
+            history_store = get_history_store(self.plugin_dir)
             
             # 确定要处理的用户ID列表
             user_ids_to_process = []
@@ -124,18 +338,19 @@ class ConfigManager:
                 user_ids_to_process = [str(uid) for uid in allowed_user_ids]
             else:
                 # 处理所有用户ID
-                user_ids_to_process = list(history_data.keys())
+                user_ids_to_process = history_store.user_ids()
             
             # 处理用户ID列表
             for user_id_str in user_ids_to_process:
-                if user_id_str in history_data and len(history_data[user_id_str]) > 0:
+                user_history = history_store.get(user_id_str)
+                if len(user_history) > 0:
                     # 如果有历史记录，创建会话
                     messages = []
-                    for msg in history_data[user_id_str]:
+                    for msg in user_history:
                         messages.append({
                             'content': msg['content'],
                             'sender': 'user' if msg['role'] == 'user' else 'bot',
-                            'timestamp': ''  # 我们没有时间戳信息
+                            'timestamp': msg.get('timestamp', '')
                         })
                     
                     # 生成会话名称（使用第一条消息）
@@ -160,6 +375,75 @@ class ConfigManager:
             print(f"加载历史会话数据时出错: {e}")
             return sessions
 
+    @staticmethod
+    def _session_name(first_user_message):
+        """用第一条用户消息生成会话名称"""
+        if not first_user_message:
+            return "历史会话"
+        return first_user_message[:15] + "..." if len(first_user_message) > 15 else first_user_message
+
+    def list_history_sessions(self, allowed_user_ids=None, cursor=None, limit=50):
+        """分页列出会话概要（不含消息正文），按最后活动时间倒序，cursor 为上一页返回的 next_cursor"""
+        from .history import get_history_store
+
+        user_ids = [str(uid) for uid in allowed_user_ids] if allowed_user_ids is not None else None
+        items = get_history_store(self.plugin_dir).list_sessions(user_ids)
+        # 排序键：(最后活动时间倒序, 用户ID)
+        items.sort(key=lambda item: (-item["last_activity"], item["user_id"]))
+
+        if cursor:
+            try:
+                last_activity, user_id = cursor.split("|", 1)
+                cursor_key = (-float(last_activity), user_id)
+                items = [item for item in items if (-item["last_activity"], item["user_id"]) > cursor_key]
+            except ValueError:
+                print(f"无效的会话分页游标: {cursor}")
+
+        page = items[:limit]
+        next_cursor = None
+        if len(items) > limit and page:
+            next_cursor = f"{page[-1]['last_activity']!r}|{page[-1]['user_id']}"
+
+        sessions = []
+        for item in page:
+            user_id = int(item["user_id"]) if item["user_id"].isdigit() else item["user_id"]
+            sessions.append({
+                'id': f"session_{user_id}",
+                'name': self._session_name(item["first_user_message"]),
+                'userId': user_id,
+                'lastActivity': item["last_activity"],
+                'messageCount': item["message_count"],
+            })
+        return {'sessions': sessions, 'next_cursor': next_cursor}
+
+    def load_history_page(self, user_id, since=None, before=None, limit=100):
+        """按时间戳增量或分页读取用户消息：since 返回该时间之后最早的 limit 条（has_more 表示还有更新的消息，
+        可用 latest 继续向后获取），否则返回最近的 limit 条（before 限定在该时间之前，has_more 表示还有更早的消息）"""
+        from .history import get_history_store
+
+        messages = get_history_store(self.plugin_dir).get(user_id)
+        if since is not None:
+            messages = [m for m in messages if m.get('timestamp', 0) > since]
+        if before is not None:
+            messages = [m for m in messages if m.get('timestamp', 0) < before]
+
+        has_more = limit > 0 and len(messages) > limit
+        if has_more:
+            # 增量获取时从游标之后的最早消息开始，避免落后较多的客户端丢失中间的消息
+            messages = messages[:limit] if since is not None and before is None else messages[-limit:]
+        return {
+            'history': [
+                {
+                    'content': m.get('content', ''),
+                    'sender': 'user' if m['role'] == 'user' else 'bot',
+                    'timestamp': m.get('timestamp', 0),
+                }
+                for m in messages
+            ],
+            'has_more': has_more,
+            'latest': messages[-1].get('timestamp', 0) if messages else since,
+        }
+
     def reload_config(self):
         """重新加载配置文件"""
         try:
@@ -252,11 +536,12 @@ class ChatUtils:
     def __init__(self, plugin_dir):
         """初始化工具类"""
         # 局部导入
-        from .ban import BanManager
+        from .ban import get_ban_manager
         
         self.plugin_dir = plugin_dir
         self.config_manager = ConfigManager(plugin_dir)
-        self.ban_manager = BanManager(plugin_dir)
+        # 与插件主程序共享同一个 BanManager
+        self.ban_manager = get_ban_manager(plugin_dir)
         self.system_prompt_manager = SystemPromptManager(plugin_dir)
 
     def extract_command_arg(self, text, command_prefix):
@@ -266,6 +551,8 @@ class ChatUtils:
             return text[len(command_prefix):].strip()
         return text.strip()
 
+    @traced("check_ban_and_blocked_words")
+    @STAGE_SECONDS.timed(stage="check")
     async def check_ban_and_blocked_words(self, msg: BaseMessage, user_input: str = ""):
         """检查是否被ban或包含违禁词"""
         # 检查是否被ban
@@ -280,6 +567,8 @@ class ChatUtils:
 
         return False
 
+    @traced("process_image_input")
+    @STAGE_SECONDS.timed(stage="image")
     async def process_image_input(self, msg: BaseMessage, chat_model_instance, user_input: str):
         """处理图像输入"""
         image_url = None
@@ -310,14 +599,20 @@ class ChatUtils:
 
         return user_input
 
+    def _is_image_message(self, msg: BaseMessage):
+        """判断消息是否包含图片"""
+        return (hasattr(msg, 'message') and
+                isinstance(msg.message, list) and
+                any(isinstance(segment, dict) and segment.get("type") == "image"
+                    for segment in msg.message))
+
+    @traced("generate_response")
+    @STAGE_SECONDS.timed(stage="generate")
     async def generate_response(self, msg: BaseMessage, chat_model_instance, user_input: str):
         """生成模型回复"""
         try:
             # 如果user_input已经是视觉模型的回复，则直接返回
-            if (hasattr(msg, 'message') and 
-                isinstance(msg.message, list) and 
-                any(isinstance(segment, dict) and segment.get("type") == "image" 
-                    for segment in msg.message)):
+            if self._is_image_message(msg):
                 return user_input if user_input is not None else "抱歉，我无法处理这张图片。"
 
             # 否则使用普通模型处理
@@ -332,6 +627,53 @@ class ChatUtils:
 
         return reply
 
+    @staticmethod
+    def _find_sentence_cut(text: str, min_chars: int):
+        """查找长度不小于 min_chars 的最后一个句子边界，没有时返回 0"""
+        cut = 0
+        for match in SENTENCE_BOUNDARY.finditer(text):
+            if match.end() >= min_chars:
+                cut = match.end()
+        return cut
+
+    async def generate_response_stream(self, msg: BaseMessage, chat_model_instance, user_input: str, min_chars=None):
+        """流式生成模型回复，按句子边界分段返回（每段已清理格式符号）"""
+        # 视觉模型的回复直接返回
+        if self._is_image_message(msg):
+            yield user_input if user_input is not None else "抱歉，我无法处理这张图片。"
+            return
+
+        if min_chars is None:
+            min_chars = self.config_manager.load_config_file().get('stream_min_chunk_chars', 30)
+
+        buffer = ""
+        has_output = False
+        started_at = time.perf_counter()
+        first_token_at = None
+        try:
+            async for delta in chat_model_instance.useModelStream(msg, user_input):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    LLM_FIRST_TOKEN_SECONDS.observe(first_token_at - started_at)
+                buffer += delta
+                cut = self._find_sentence_cut(buffer, min_chars)
+                if cut:
+                    piece = chat_model_instance._clean_reply(buffer[:cut])
+                    buffer = buffer[cut:]
+                    if piece:
+                        has_output = True
+                        yield piece
+
+            tail = chat_model_instance._clean_reply(buffer)
+            if tail:
+                yield tail
+            elif not has_output:
+                yield "抱歉，我没有理解您的意思。"
+        except Exception as e:
+            yield f"抱歉，处理您的请求时出现了错误: {str(e)}"
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - started_at, stage="generate")
+
     def is_admin(self, user_id, admins_list):
         """检查用户是否为管理员或超级管理员"""
         return str(user_id) in admins_list or str(user_id) == bot_config.root
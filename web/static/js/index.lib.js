@@ -126,31 +126,138 @@ function renderMarkdownToHtml(text) {
 
 
 // ==========================
-// 加载历史会话（从后端 /api/sessions）
+// 加载历史会话列表（从后端 /api/sessions 分页获取概要，滚动到列表底部时加载下一页，消息正文在切换会话时按需加载）
+// ==========================
+let sessionCursor = null;
+let sessionsLoading = false;
+
+async function loadSessionPage() {
+    const query = sessionCursor ? `?cursor=${encodeURIComponent(sessionCursor)}` : '';
+    const response = await fetch(`/api/sessions${query}`, { cache: 'no-cache' });
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || '未知错误');
+
+    (data.sessions || []).forEach(summary => {
+        if (sessions[summary.id]) return;
+        sessions[summary.id] = {
+            id: summary.id,
+            name: summary.name,
+            userId: summary.userId,
+            messageCount: summary.messageCount,
+            createdAt: new Date(summary.lastActivity * 1000).toISOString(),
+            // null 表示消息尚未加载
+            messages: null,
+            lastTimestamp: null
+        };
+    });
+    sessionCursor = data.next_cursor;
+}
+
+async function loadMoreSessions() {
+    if (!sessionCursor || sessionsLoading) return;
+    sessionsLoading = true;
+    try {
+        await loadSessionPage();
+        updateSessionList();
+    } catch (error) {
+        console.error('加载更多会话失败:', error);
+    } finally {
+        sessionsLoading = false;
+    }
+    // 列表尚未填满可视区域时继续加载
+    if (sessionList && sessionList.scrollHeight <= sessionList.clientHeight) loadMoreSessions();
+}
+
+async function loadHistorySessions() {
+    try {
+        sessionsLoading = true;
+        await loadSessionPage();
+        sessionsLoading = false;
+
+        const sessionIds = Object.keys(sessions);
+        if (sessionIds.length === 0) {
+            createNewSession();
+        } else {
+            switchSession(sessionIds[0]);
+        }
+        if (sessionList && sessionList.scrollHeight <= sessionList.clientHeight) loadMoreSessions();
+    } catch (error) {
+        sessionsLoading = false;
+        console.error('加载历史会话失败:', error);
+        if (Object.keys(sessions).length === 0) {
+            createNewSession();
+        }
+    }
+}
+
 // ==========================
-function loadHistorySessions() {
-    fetch('/api/sessions')
-        .then(response => response.json())
-        .then(data => {
-            if (data.sessions) {
-                sessions = data.sessions;
-                if (Object.keys(sessions).length === 0) {
-                    createNewSession();
-                } else {
-                    const firstSessionId = Object.keys(sessions)[0];
-                    currentSessionId = firstSessionId;
-                    currentUserId = sessions[firstSessionId].userId;
-                }
-                updateSessionList();
-                renderMessages();
-            }
-        })
-        .catch(error => {
-            console.error('加载历史会话失败:', error);
-            if (Object.keys(sessions).length === 0) {
-                createNewSession();
-            }
-        });
+// 获取一页会话消息（since 向后获取新消息，before 向前获取更早的消息）
+// ==========================
+async function fetchHistoryPage(userId, params) {
+    const query = new URLSearchParams(params).toString();
+    const response = await fetch(`/api/history/${userId}${query ? `?${query}` : ''}`, { cache: 'no-cache' });
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || '未知错误');
+    return data;
+}
+
+// ==========================
+// 加载会话消息：首次加载最近一页，之后从 lastTimestamp 起逐页获取新消息
+// ==========================
+async function syncSessionMessages(sessionId) {
+    const session = sessions[sessionId];
+    if (!session || session.userId == null) return;
+
+    if (session.messages === null || session.lastTimestamp === null) {
+        // 更早的消息在滚动到顶部时加载
+        const data = await fetchHistoryPage(session.userId, {});
+        session.messages = (data.history || []).map(message => ({ ...message, synced: true }));
+        session.hasOlder = Boolean(data.has_more);
+        if (data.latest != null) session.lastTimestamp = data.latest;
+    } else {
+        let fresh = [];
+        let hasMore = true;
+        while (hasMore) {
+            const data = await fetchHistoryPage(session.userId, { since: session.lastTimestamp });
+            const history = data.history || [];
+            fresh = fresh.concat(history);
+            if (data.latest != null) session.lastTimestamp = data.latest;
+            hasMore = Boolean(data.has_more) && history.length > 0;
+        }
+        if (fresh.length === 0) return;
+        // 本地尚未与服务端确认的消息由服务端记录替换
+        session.messages = session.messages.filter(message => message.synced).concat(
+            fresh.map(message => ({ ...message, synced: true }))
+        );
+    }
+    session.messageCount = session.messages.length;
+}
+
+// ==========================
+// 向前加载更早的消息（滚动到聊天区域顶部时调用），保持当前可见位置
+// ==========================
+async function loadOlderMessages(sessionId) {
+    const session = sessions[sessionId];
+    if (!session || !session.hasOlder || session.loadingOlder || !session.messages) return;
+    const oldest = session.messages.find(message => message.synced);
+    if (!oldest) return;
+
+    session.loadingOlder = true;
+    try {
+        const data = await fetchHistoryPage(session.userId, { before: oldest.timestamp });
+        const history = (data.history || []).map(message => ({ ...message, synced: true }));
+        session.messages = history.concat(session.messages);
+        session.hasOlder = Boolean(data.has_more) && history.length > 0;
+        if (currentSessionId === sessionId && history.length > 0 && chatContainer) {
+            const distanceFromBottom = chatContainer.scrollHeight - chatContainer.scrollTop;
+            renderMessages();
+            chatContainer.scrollTop = chatContainer.scrollHeight - distanceFromBottom;
+        }
+    } catch (error) {
+        console.error('加载更早的消息失败:', error);
+    } finally {
+        session.loadingOlder = false;
+    }
 }
 
 if (newSessionBtn) {
@@ -186,6 +293,7 @@ function createNewSession() {
         id: sessionId,
         name: '新会话',
         messages: [],
+        lastTimestamp: 0,
         userId: newUserId,
         createdAt: new Date().toISOString()
     };
@@ -216,6 +324,8 @@ function updateSessionList() {
         if (session.messages && session.messages.length > 0) {
             const lastMessage = session.messages[session.messages.length - 1];
             preview = lastMessage.content.length > 20 ? lastMessage.content.substring(0, 20) + '...' : lastMessage.content;
+        } else if (session.messages === null && session.messageCount) {
+            preview = `${session.messageCount} 条消息`;
         }
 
         sessionItem.innerHTML = `
@@ -269,6 +379,16 @@ function switchSession(sessionId) {
         currentUserId = sessions[sessionId].userId;
         renderMessages();
         updateSessionList();
+
+        // 按需加载（或增量同步）该会话的消息
+        syncSessionMessages(sessionId)
+            .then(() => {
+                if (currentSessionId === sessionId) {
+                    renderMessages();
+                    updateSessionList();
+                }
+            })
+            .catch(error => console.error('加载会话消息失败:', error));
     }
 }
 
@@ -399,7 +519,95 @@ function addMessageToChat(message, sender, saveToSession = true) {
 }
 
 // ==========================
-// 发送消息到后端 /api/chat
+// 创建流式输出的机器人消息气泡，返回用于增量更新的函数
+// ==========================
+function createStreamingBotMessage() {
+    if (!chatContainer) return { update: () => {} };
+
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'chat-bubble bot-bubble';
+    messageDiv.innerHTML = `
+        <div class="flex items-start">
+            <i class="fas fa-robot mr-2 mt-1"></i>
+            <div class="markdown-body" style="max-width: 100%;"></div>
+        </div>`;
+    chatContainer.appendChild(messageDiv);
+    const body = messageDiv.querySelector('.markdown-body');
+
+    return {
+        update(text) {
+            body.innerHTML = renderMarkdownToHtml(text);
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+        },
+        remove() {
+            messageDiv.remove();
+        }
+    };
+}
+
+// ==========================
+// 解析 Server-Sent Events 数据流，逐条回调 (event, data)
+// ==========================
+function parseEventBlocks(buffer, onEvent) {
+    // 解析缓冲区中完整的事件，返回尚未结束的部分
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const rawEvent = buffer.substring(0, boundary);
+        buffer = buffer.substring(boundary + 2);
+
+        let eventName = 'message';
+        let dataText = '';
+        rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event:')) eventName = line.substring(6).trim();
+            else if (line.startsWith('data:')) dataText += line.substring(5).trim();
+        });
+        if (dataText) onEvent(eventName, JSON.parse(dataText));
+    }
+    return buffer;
+}
+
+async function readEventStream(response, onEvent) {
+    if (!response.body || typeof TextDecoder === 'undefined') {
+        // 浏览器不支持流式读取时，等待响应结束后一次性解析（请求已被服务端处理，不能重新发送）
+        parseEventBlocks((await response.text()) + '\n\n', onEvent);
+        return;
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer = parseEventBlocks(buffer + decoder.decode(value, { stream: true }), onEvent);
+    }
+}
+
+// ==========================
+// 非流式发送到 /api/chat（仅在服务端没有流式接口时使用）
+// ==========================
+async function sendMessageWithoutStream(payload) {
+    const response = await fetch('/api/chat', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: payload
+    });
+    const data = await response.json();
+    if (typingIndicator) typingIndicator.style.display = 'none';
+
+    if (response.ok) {
+        // 后端返回的 data.response 可能包含 Markdown
+        addMessageToChat(data.response, 'bot');
+    } else if (response.status === 401) {
+        window.location.href = '/login';
+    } else {
+        addMessageToChat(`错误: ${data.error || '未知错误'}`, 'bot');
+    }
+}
+
+// ==========================
+// 发送消息到后端 /api/chat/stream（流式渲染），服务端没有该接口时回退到 /api/chat
 // ==========================
 async function sendMessage() {
     if (!messageInput) return;
@@ -414,26 +622,60 @@ async function sendMessage() {
     if (typingIndicator) typingIndicator.style.display = 'block';
     if (chatContainer) chatContainer.scrollTop = chatContainer.scrollHeight;
 
+    const payload = JSON.stringify({
+        user_id: sessions[currentSessionId].userId,
+        message: message
+    });
+
     try {
-        const response = await fetch('/api/chat', {
+        const response = await fetch('/api/chat/stream', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                user_id: sessions[currentSessionId].userId,
-                message: message
-            })
+            body: payload
         });
 
-        const data = await response.json();
-        if (typingIndicator) typingIndicator.style.display = 'none';
-
-        if (response.ok) {
-            // 后端返回的 data.response 可能包含 Markdown
-            addMessageToChat(data.response, 'bot');
-        } else if (response.status === 401) {
+        if (response.status === 401) {
             window.location.href = '/login';
+            return;
+        }
+
+        if (response.status === 404 || response.status === 405) {
+            // 只在接口不存在时回退；其他错误说明请求可能已被处理，重新发送会重复回复并写入两次历史记录
+            await sendMessageWithoutStream(payload);
+        } else if (!response.ok) {
+            const data = await response.json().catch(() => ({}));
+            if (typingIndicator) typingIndicator.style.display = 'none';
+            addMessageToChat(`错误: ${data.error || `请求失败（${response.status}）`}`, 'bot');
         } else {
-            addMessageToChat(`错误: ${data.error || '未知错误'}`, 'bot');
+            // 流式渲染：收到首个片段后隐藏输入提示并逐步更新气泡
+            let streamed = '';
+            let bubble = null;
+            let finalReply = null;
+            let streamError = null;
+
+            await readEventStream(response, (eventName, data) => {
+                if (eventName === 'done') {
+                    finalReply = data.response;
+                } else if (eventName === 'error') {
+                    streamError = data.error;
+                } else if (data.delta) {
+                    if (!bubble) {
+                        if (typingIndicator) typingIndicator.style.display = 'none';
+                        bubble = createStreamingBotMessage();
+                    }
+                    streamed += data.delta;
+                    bubble.update(streamed);
+                }
+            });
+
+            if (typingIndicator) typingIndicator.style.display = 'none';
+            if (bubble) bubble.remove();
+            if (streamError) {
+                addMessageToChat(`错误: ${streamError}`, 'bot');
+            } else {
+                // 以服务端清理后的最终结果替换流式内容并保存到会话
+                addMessageToChat(finalReply !== null ? finalReply : streamed, 'bot');
+            }
         }
     } catch (error) {
         if (typingIndicator) typingIndicator.style.display = 'none';
@@ -455,6 +697,7 @@ async function clearHistory() {
         const data = await response.json();
         if (response.ok) {
             sessions[currentSessionId].messages = [];
+            sessions[currentSessionId].lastTimestamp = null;
             renderMessages();
             addMessageToChat('会话历史已清除', 'bot');
         } else {
@@ -699,6 +942,18 @@ if (settingsForm) {
 // 页面事件绑定（按钮、输入回车等）
 // ==========================
 if (sendButton) sendButton.addEventListener('click', sendMessage);
+if (sessionList) {
+    sessionList.addEventListener('scroll', () => {
+        // 接近列表底部时加载下一页会话
+        if (sessionList.scrollTop + sessionList.clientHeight >= sessionList.scrollHeight - 50) loadMoreSessions();
+    });
+}
+if (chatContainer) {
+    chatContainer.addEventListener('scroll', () => {
+        // 滚动到顶部时加载更早的消息
+        if (chatContainer.scrollTop < 50 && currentSessionId) loadOlderMessages(currentSessionId);
+    });
+}
 if (messageInput) {
     messageInput.addEventListener('keypress', (e) => {
         if (e.key === 'Enter' && !e.shiftKey) {
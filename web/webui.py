@@ -1,14 +1,53 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, make_response
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, make_response, stream_with_context
 from plugins.ModelChat.api import ModelChatAPI
+from plugins.ModelChat.utils import BackgroundLoop, ConfigManager
+from plugins.ModelChat.metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 from ncatbot.utils import config as bot_config
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
 from functools import wraps
 import os, threading, webbrowser, asyncio, hashlib, secrets, json
 
+try:
+    from waitress.server import create_server as create_waitress_server
+except ImportError:  # 未安装 waitress 时使用线程数受限的 werkzeug 服务器
+    create_waitress_server = None
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """支持 HTTP/1.1 长连接的请求处理器"""
+    protocol_version = "HTTP/1.1"
+
+
+class BoundedThreadedWSGIServer(ThreadedWSGIServer):
+    """工作线程数受限的 werkzeug 多线程服务器，线程用尽时新连接在监听队列中等待"""
+
+    def __init__(self, host, port, app, handler=None, max_threads=8):
+        super().__init__(host, port, app, handler=handler)
+        self._thread_slots = threading.BoundedSemaphore(max(1, int(max_threads)))
+
+    def process_request(self, request, client_address):
+        self._thread_slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._thread_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._thread_slots.release()
+
 
 class ModelChatWebUI:
     def __init__(self, plugin_dir):
         self.plugin_dir = plugin_dir
         self.api = ModelChatAPI(plugin_dir)
+        self.config_manager = ConfigManager(plugin_dir)
+        # 常驻事件循环：所有请求的协程都提交到这里执行，复用模型客户端、连接池与 MCP 会话
+        self.background_loop = BackgroundLoop("ModelChatWebUILoop")
+        self._server = None
         self.app = Flask(__name__,
                          template_folder=os.path.join(plugin_dir, 'web', 'templates'),
                          static_folder=os.path.join(plugin_dir, 'web', 'static'))
@@ -93,6 +132,22 @@ class ModelChatWebUI:
         response.status_code = status_code
         return response
 
+    def _conditional_json_response(self, data):
+        """带 ETag 的JSON响应，内容未变化时返回 304"""
+        response = jsonify(data)
+        response.add_etag()
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    @staticmethod
+    def _float_arg(name):
+        """读取浮点型查询参数，缺省或无效时返回 None"""
+        value = request.args.get(name)
+        try:
+            return float(value) if value not in (None, '') else None
+        except ValueError:
+            return None
+
     def _redirect_response(self, endpoint):
         """统一重定向响应格式"""
         if request.is_json:
@@ -113,6 +168,21 @@ class ModelChatWebUI:
             else:
                 return self._json_response({'error': message}, status_code)
 
+    def _run_async(self, coro):
+        """在常驻事件循环中执行协程并等待结果"""
+        return self.background_loop.run(coro)
+
+    def _iterate_async(self, async_gen):
+        """在常驻事件循环中逐项驱动异步生成器，供同步的 Flask 响应使用"""
+        return self.background_loop.iterate(async_gen)
+
+    def _sse_event(self, data, event=None):
+        """格式化 Server-Sent Events 消息"""
+        payload = json.dumps(data, ensure_ascii=False)
+        if event:
+            return f"event: {event}\ndata: {payload}\n\n"
+        return f"data: {payload}\n\n"
+
     def _setup_routes(self):
         @self.app.route('/check_first_login')
         def check_first_login():
@@ -235,11 +305,36 @@ class ModelChatWebUI:
             group_id = data.get('group_id')
 
             try:
-                response = asyncio.run(self.api.generate_response(user_id, message, group_id))
+                response = self._run_async(self.api.generate_response(user_id, message, group_id))
                 return self._json_response({'response': response})
             except Exception as e:
                 return self._json_response({'error': str(e)}, 500)
 
+        @self.app.route('/api/chat/stream', methods=['POST'])
+        @self._require_auth
+        def chat_stream():
+            data = request.json
+            user_id = data.get('user_id', 0)
+            message = data.get('message', '')
+            group_id = data.get('group_id')
+
+            def generate():
+                chunks = []
+                try:
+                    for chunk in self._iterate_async(self.api.generate_response_stream(user_id, message, group_id)):
+                        chunks.append(chunk)
+                        yield self._sse_event({'delta': chunk})
+                    # 最终结果与历史记录一致，经过格式清理
+                    reply = self.api.chat_model_instance._clean_reply(''.join(chunks))
+                    yield self._sse_event({'response': reply}, event='done')
+                except Exception as e:
+                    yield self._sse_event({'error': str(e)}, event='error')
+
+            response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+
         @self.app.route('/api/system_prompt', methods=['GET'])
         @self._require_auth
         def get_system_prompt():
@@ -264,8 +359,12 @@ class ModelChatWebUI:
         @self._require_auth
         def get_history(user_id):
             try:
-                history = self.api.get_user_history(user_id)
-                return self._json_response({'history': history})
+                # since：只返回该时间戳之后的新消息；before：向前翻页
+                limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+                page = self.api.get_user_history_page(
+                    user_id, self._float_arg('since'), self._float_arg('before'), limit
+                )
+                return self._conditional_json_response(page)
             except Exception as e:
                 return self._json_response({'error': str(e)}, 500)
 
@@ -274,6 +373,8 @@ class ModelChatWebUI:
         def clear_history(user_id):
             try:
                 result = self.api.clear_user_history(user_id)
+                if asyncio.iscoroutine(result):
+                    result = self._run_async(result)
                 return self._json_response({'result': result})
             except Exception as e:
                 return self._json_response({'error': str(e)}, 500)
@@ -302,11 +403,24 @@ class ModelChatWebUI:
             try:
                 # 只获取 10000 - 10099 范围内的用户ID
                 allowed_user_ids = list(range(10000, 10100))
-                sessions = self.api.get_history_sessions(allowed_user_ids)
-                return self._json_response({'sessions': sessions})
+                # 只返回会话概要，消息正文通过 /api/history 按需获取
+                limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+                page = self.api.list_history_sessions(allowed_user_ids, request.args.get('cursor'), limit)
+                return self._conditional_json_response(page)
             except Exception as e:
                 return self._json_response({'error': str(e)}, 500)
 
+        @self.app.route('/metrics', methods=['GET'])
+        def get_metrics():
+            # 供 Prometheus 抓取，不使用登录会话，可通过 metrics_token 校验
+            current_config = self.config_manager.load_config_file()
+            if not current_config.get('enable_metrics', False):
+                return Response('metrics disabled\n', status=404, mimetype='text/plain')
+            token = current_config.get('metrics_token', '')
+            if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+                return Response('unauthorized\n', status=401, mimetype='text/plain')
+            return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
         @self.app.route('/api/config', methods=['GET'])
         @self._require_auth
         def get_config():
@@ -387,4 +501,46 @@ class ModelChatWebUI:
         if open_browser and not debug:
             threading.Timer(1.25, lambda: webbrowser.open(f'http://{host}:{port}')).start()
 
-        self.app.run(host=host, port=port, debug=debug)
\ No newline at end of file
+        if debug:
+            self.app.run(host=host, port=port, debug=debug)
+            return
+
+        self._server = self._create_server(host, port)
+        if hasattr(self._server, 'serve_forever'):
+            self._server.serve_forever()
+        else:
+            self._server.run()
+
+    def _create_server(self, host, port):
+        """创建生产环境 WSGI 服务器：优先使用 waitress，否则使用线程数受限的 werkzeug 服务器"""
+        current_config = self.config_manager.load_config_file()
+        server_type = current_config.get('webui_server', 'auto')
+        threads = current_config.get('webui_threads', 8)
+        keepalive_timeout = current_config.get('webui_keepalive_timeout', 30)
+
+        if server_type in ('auto', 'waitress') and create_waitress_server is not None:
+            print(f"WebUI 使用 waitress 服务器，工作线程数: {threads}")
+            return create_waitress_server(
+                self.app, host=host, port=port,
+                threads=threads, channel_timeout=keepalive_timeout
+            )
+        if server_type == 'waitress':
+            print("未安装 waitress，WebUI 使用 werkzeug 多线程服务器")
+
+        # 空闲的长连接在超时后关闭
+        handler = type('ModelChatRequestHandler', (KeepAliveRequestHandler,), {'timeout': keepalive_timeout})
+        print(f"WebUI 使用 werkzeug 多线程服务器，工作线程数: {threads}")
+        return BoundedThreadedWSGIServer(host, port, self.app, handler=handler, max_threads=threads)
+
+    def stop(self):
+        """停止 WebUI 服务器与常驻事件循环"""
+        if self._server is not None:
+            try:
+                if hasattr(self._server, 'shutdown'):
+                    self._server.shutdown()
+                else:
+                    self._server.close()
+            except Exception as e:
+                print(f"停止 WebUI 服务器出错: {e}")
+            self._server = None
+        self.background_loop.stop()
\ No newline at end of file